@@ -0,0 +1,58 @@
+"""This module compares the encoding and decoding time of a block in the flat format (`Block.encode`) with the CBOR
+format used before (`Block.serialize_cbor`, every transaction encoded separately). The block contains MAX_TXN_COUNT
+transactions with a content of 200 bytes each.
+
+Usage: python pichain_block_format_benchmark.py
+"""
+
+import time
+
+from piChain.messages import Block, Transaction
+from piChain.config import MAX_TXN_COUNT
+
+# size of the content of a transaction in bytes
+TXN_SIZE = 200
+# number of times each measurement is repeated
+REPETITIONS = 10
+
+
+def create_block():
+    txs = [Transaction(1, ('put key%s ' % i).ljust(TXN_SIZE, 'v'), i) for i in range(MAX_TXN_COUNT)]
+    block = Block(0, 1, txs, 1)
+    block.depth = MAX_TXN_COUNT
+    block.creator_state = 0
+    return block
+
+
+def decode(msg):
+    """Decode a block including its transactions (which are decoded lazily)."""
+    return Block.unserialize(msg).txs
+
+
+def measure(f, arg):
+    """
+    Returns:
+        float: min time in seconds needed to call `f` with `arg`.
+    """
+    timings = []
+    for _ in range(REPETITIONS):
+        start = time.perf_counter()
+        f(arg)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    block = create_block()
+    flat = block.encode()
+    cbor = block.serialize_cbor()
+
+    print('block with %s transactions of %s bytes:' % (MAX_TXN_COUNT, TXN_SIZE))
+    print('flat: encode = %6.2f ms, decode = %6.2f ms, size = %s bytes' %
+          (measure(Block.encode, block) * 1000, measure(decode, flat) * 1000, len(flat)))
+    print('cbor: encode = %6.2f ms, decode = %6.2f ms, size = %s bytes' %
+          (measure(Block.serialize_cbor, block) * 1000, measure(decode, cbor) * 1000, len(cbor)))
+
+
+if __name__ == "__main__":
+    main()
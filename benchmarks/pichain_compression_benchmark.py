@@ -0,0 +1,76 @@
+"""This module measures the bandwidth saved by compressing BLK and RSB messages (see COMPRESSION in config.py) versus the
+CPU time spent on the compression by the sender and the decompression by the receivers, for each zlib level. The
+blocks contain MAX_TXN_COUNT commands of the distributed database example (`put <key> <value>`).
+
+Usage: python pichain_compression_benchmark.py
+"""
+
+import random
+import time
+
+from piChain.messages import Block, Transaction, RespondBlockMessage
+from piChain.PaxosNetwork import compress_frame, decompress_frame
+from piChain.config import MAX_TXN_COUNT, RECOVERY_BLOCKS_COUNT
+
+# number of times each measurement is repeated
+REPETITIONS = 5
+# max size of a decompressed message (see `Connection.MAX_LENGTH`)
+MAX_LENGTH = 10000000
+
+
+def create_block(seq, value_size):
+    """
+    Args:
+        seq (int): sequence number of the block.
+        value_size (int): size of the value of each put command in bytes.
+
+    Returns:
+        Block: block with MAX_TXN_COUNT put commands with random keys and values.
+    """
+    rnd = random.Random(seq)
+    txs = []
+    for i in range(MAX_TXN_COUNT):
+        value = ''.join(rnd.choice('abcdefghijklmnopqrstuvwxyz0123456789') for _ in range(value_size))
+        txs.append(Transaction(1, 'put k%s_%s %s' % (rnd.randrange(100), rnd.randrange(1000), value),
+                               seq * MAX_TXN_COUNT + i))
+    block = Block(0, 1, txs, seq)
+    block.depth = seq * MAX_TXN_COUNT
+    block.creator_state = 0
+    return block
+
+
+def measure(f, arg):
+    """
+    Returns:
+        float: min time in seconds needed to call `f` with `arg`.
+    """
+    timings = []
+    for _ in range(REPETITIONS):
+        start = time.perf_counter()
+        f(arg)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def report(name, data):
+    print('%s: %s bytes' % (name, len(data)))
+    print('%6s %12s %8s %14s %16s %14s' % ('level', 'size', 'saved', 'compress', 'decompress', 'MB/s (comp)'))
+    for level in [1, 3, 6, 9]:
+        compressed = compress_frame(data, level)
+        t_compress = measure(lambda d: compress_frame(d, level), data)
+        t_decompress = measure(lambda d: decompress_frame(d, MAX_LENGTH), compressed)
+        print('%6s %12s %7.1f%% %11.2f ms %13.2f ms %14.1f' %
+              (level, len(compressed), 100 * (1 - len(compressed) / len(data)), t_compress * 1000,
+               t_decompress * 1000, len(data) / t_compress / 1e6))
+    print()
+
+
+def main():
+    report('BLK (short values)', create_block(1, 1).serialize())
+    report('BLK (values of 100 random chars)', create_block(1, 100).serialize())
+    blocks = [create_block(i, 1) for i in range(1, RECOVERY_BLOCKS_COUNT + 2)]
+    report('RSB (%s blocks, short values)' % len(blocks), RespondBlockMessage(blocks).serialize())
+
+
+if __name__ == "__main__":
+    main()
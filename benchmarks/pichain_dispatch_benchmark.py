@@ -0,0 +1,137 @@
+"""This module measures the cost of dispatching a received message per message type: the time `Connection.stringReceived`
+needs in addition to decoding the message. It compares the dispatch tables (`Connection.handlers`,
+`ConnectionManager.message_types`) with the if/elif chains on the decoded message type used before.
+
+Usage: python pichain_dispatch_benchmark.py
+"""
+
+import logging
+import timeit
+
+from piChain.PaxosNetwork import Connection, ConnectionManager
+from piChain.messages import RequestBlockMessage, Transaction, TransactionBatchMessage, Block, RespondBlockMessage, \
+    PaxosMessage, PongMessage, AckCommitMessage
+
+# number of messages dispatched per measurement
+MESSAGE_COUNT = 100000
+
+logger = logging.getLogger('piChain.PaxosNetwork')
+
+
+class Manager(ConnectionManager):
+    """Connection manager whose receive methods do nothing."""
+    def receive_request_blocks_message(self, req, sender):
+        pass
+
+    def receive_transaction(self, txn):
+        pass
+
+    def receive_transactions(self, txs):
+        pass
+
+    def receive_block(self, block):
+        pass
+
+    def receive_respond_blocks_message(self, resp):
+        pass
+
+    def receive_paxos_message(self, message, sender):
+        pass
+
+    def receive_pong_message(self, message, peer_node_id):
+        pass
+
+    def receive_ack_commit_message(self, message):
+        pass
+
+
+def previous_string_received(connection, string):
+    """`Connection.stringReceived` as implemented before the dispatch tables (messages handled by the connection itself
+    are omitted)."""
+    msg_type = string[:3].decode()
+
+    if msg_type == 'HEL':
+        pass
+    elif msg_type == 'ACK':
+        pass
+    elif msg_type == 'PIN':
+        pass
+    elif msg_type == 'ZLB':
+        pass
+    else:
+        previous_parse_msg(connection.connection_manager, msg_type, string, connection)
+
+
+def previous_parse_msg(self, msg_type, msg, sender):
+    """`ConnectionManager.parse_msg` as implemented before the dispatch tables."""
+    if msg_type != 'PON':
+        logger.debug('parse_msg called with msg_type = %s', msg_type)
+    if msg_type == 'RQB':
+        obj = RequestBlockMessage.unserialize(msg)
+        self.receive_request_blocks_message(obj, sender)
+    elif msg_type == 'TXN':
+        obj = Transaction.unserialize(msg)
+        self.receive_transaction(obj)
+    elif msg_type == 'TXB':
+        obj = TransactionBatchMessage.unserialize(msg)
+        self.receive_transactions(obj.txs)
+    elif msg_type == 'BLK':
+        obj = Block.unserialize(msg)
+        self.receive_block(obj)
+    elif msg_type == 'RSB':
+        obj = RespondBlockMessage.unserialize(msg)
+        self.receive_respond_blocks_message(obj)
+    elif msg_type == 'PAM':
+        obj = PaxosMessage.unserialize(msg)
+        self.receive_paxos_message(obj, sender)
+    elif msg_type == 'PON':
+        obj = PongMessage.unserialize(msg)
+        self.receive_pong_message(obj, sender.peer_node_id)
+    elif msg_type == 'ACM':
+        obj = AckCommitMessage.unserialize(msg)
+        self.receive_ack_commit_message(obj)
+
+
+def create_messages():
+    """
+    Returns:
+        list: (decoder, message) per message type, the messages are small s.t the dispatch cost is not hidden.
+    """
+    txn = Transaction(1, 'put k12_345 v', 1)
+    block = Block(1, 0, [txn], 1)
+    pam = PaxosMessage('TRY_OK', 1)
+    pam.prop_block = block.block_id
+    return [(RequestBlockMessage.unserialize, RequestBlockMessage(block.block_id).serialize()),
+            (Transaction.unserialize, txn.serialize()),
+            (TransactionBatchMessage.unserialize, TransactionBatchMessage([txn, txn]).serialize()),
+            (Block.unserialize, block.serialize()),
+            (RespondBlockMessage.unserialize, RespondBlockMessage([block]).serialize()),
+            (PaxosMessage.unserialize, pam.serialize()),
+            (PongMessage.unserialize, PongMessage(1.0).serialize()),
+            (AckCommitMessage.unserialize, AckCommitMessage(block.block_id).serialize())]
+
+
+def cost(f):
+    """
+    Returns:
+        float: time in nanoseconds per call of `f`.
+    """
+    return min(timeit.repeat(f, number=MESSAGE_COUNT, repeat=5)) / MESSAGE_COUNT * 1e9
+
+
+def main():
+    # the level piChain sets for its loggers (see PaxosNetwork.py), no handler is configured
+    logger.setLevel(logging.DEBUG)
+    manager = Manager(0, {'0': {'ip': '127.0.0.1', 'port': 7982}})
+    connection = Connection(manager)
+
+    print('%-5s %12s %18s %20s' % ('type', 'decode (ns)', 'dispatch (ns)', 'previous (ns)'))
+    for decoder, msg in create_messages():
+        decode = cost(lambda: decoder(msg))
+        dispatch = cost(lambda: connection.stringReceived(msg)) - decode
+        previous = cost(lambda: previous_string_received(connection, msg)) - decode
+        print('%-5s %12.0f %18.0f %20.0f' % (msg[:3].decode(), decode, dispatch, previous))
+
+
+if __name__ == "__main__":
+    main()
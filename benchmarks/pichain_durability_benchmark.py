@@ -0,0 +1,156 @@
+"""This module measures the throughput and the commit latency of a cluster of `NODE_COUNT` nodes for each durability
+mode ('sync_on_vote', 'sync_on_commit' and 'async'). In each round the quick node creates `TXN_COUNT` transactions,
+creates a block containing them and the nodes commit it. The nodes run in this process: their messages are serialized
+and delivered through a queue instead of the network, and time is simulated. Thus the wall clock time spent is the
+local processing time of all nodes including the disk writes.
+
+Note: with more than one node the acknowledgements of a commit (ACM) are received after the block has been committed,
+i.e the genesis block change (deletion of the blocks below the committed block) happens after the commit as in a real
+cluster.
+
+Usage: python pichain_durability_benchmark.py [round_count]
+Note: The blocktree databases are created inside a temporary directory.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import time
+import logging
+import contextlib
+from collections import deque
+
+from twisted.internet import task
+
+os.environ['HOME'] = tempfile.mkdtemp()
+
+from piChain.PaxosLogic import Node  # noqa: E402
+from piChain.blocktree import SYNC_ON_VOTE, SYNC_ON_COMMIT, ASYNC  # noqa: E402
+from piChain.config import ACCUMULATION_TIME  # noqa: E402
+
+logging.disable(logging.CRITICAL)
+
+ROUND_COUNT = 200
+# number of transactions per block
+TXN_COUNT = 10
+# number of nodes in the cluster
+NODE_COUNT = 3
+
+
+class LocalNetwork:
+    """Delivers the messages of nodes running in the same process. The messages are serialized and queued, they are
+    delivered in the order they were sent by `run`.
+
+    Args:
+        nodes (list): the nodes, the index of a node is its id.
+
+    Attributes:
+        nodes (list): see Args.
+        queue (deque): (receiver, serialized message, sender) of the messages not yet delivered.
+    """
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.queue = deque()
+        for node in nodes:
+            node.broadcast = self.broadcaster(node)
+            node.respond = self.responder(node)
+
+    def broadcaster(self, node):
+        def broadcast(obj, msg_type):
+            data = obj.serialize()
+            for receiver in self.nodes:
+                if receiver is not node:
+                    self.queue.append((receiver, data, node))
+            if msg_type == 'TXN':
+                node.receive_transaction(obj)
+            elif msg_type == 'TXB':
+                node.receive_transactions(obj.txs)
+        return broadcast
+
+    def responder(self, node):
+        def respond(obj, sender):
+            self.queue.append((sender, obj.serialize(), node))
+        return respond
+
+    def run(self):
+        """Deliver the queued messages (and the ones sent while handling them) until the queue is empty."""
+        while self.queue:
+            receiver, data, sender = self.queue.popleft()
+            with receiver.coalesce_writes():
+                receiver.parse_msg(data[:3], data, sender)
+
+
+def count_synced_writes(blocktree):
+    """Count the synced writes of `blocktree` in its attribute `synced_writes`."""
+    blocktree.synced_writes = 0
+    write = blocktree.write
+
+    def counting_write(ops, sync=False):
+        if sync:
+            blocktree.synced_writes += 1
+        return write(ops, sync)
+    blocktree.write = counting_write
+
+
+def measure(durability, round_count):
+    """
+    Args:
+        durability (str): durability mode of the nodes.
+        round_count (int): number of blocks to commit.
+
+    Returns:
+        tuple: throughput (transactions per second) and mean commit latency (seconds).
+    """
+    shutil.rmtree(os.path.expanduser('~/.pichain'), ignore_errors=True)
+    peers = {str(i): {'ip': '127.0.0.1', 'port': 7982 + i} for i in range(NODE_COUNT)}
+    clock = task.Clock()
+    nodes = [Node(i, peers, durability=durability) for i in range(NODE_COUNT)]
+    for node in nodes:
+        node.reactor = clock
+        count_synced_writes(node.blocktree)
+    network = LocalNetwork(nodes)
+    quick_node = nodes[0]
+
+    latencies = []
+    # the nodes print the committed blocks (used by the integration tests)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        for i in range(round_count):
+            round_start = time.perf_counter()
+            committed = [len(node.blocktree.committed_blocks) for node in nodes]
+            synced_writes = [node.blocktree.synced_writes for node in nodes]
+            for j in range(TXN_COUNT):
+                quick_node.make_txn('put k%s v%s' % (j, i))
+            clock.advance(ACCUMULATION_TIME)
+            network.run()
+            latencies.append(time.perf_counter() - round_start)
+
+            # every node committed the block of this round (and synced it to disk unless the mode is async)
+            for k, node in enumerate(nodes):
+                assert len(node.blocktree.committed_blocks) == committed[k] + 1
+                assert node.blocktree.committed_block.block_id == quick_node.blocktree.head_block.block_id
+                if durability != ASYNC:
+                    assert node.blocktree.synced_writes > synced_writes[k]
+        if durability == ASYNC:
+            # the data is only safe once flushed
+            for node in nodes:
+                node.blocktree.flush(sync=True)
+        elapsed = time.perf_counter() - start
+
+    for node in nodes:
+        node.blocktree.db.close()
+    return round_count * TXN_COUNT / elapsed, sum(latencies) / len(latencies)
+
+
+def main():
+    round_count = int(sys.argv[1]) if len(sys.argv) > 1 else ROUND_COUNT
+    print('%s nodes, %s blocks with %s transactions each:' % (NODE_COUNT, round_count, TXN_COUNT))
+    for durability in [SYNC_ON_VOTE, SYNC_ON_COMMIT, ASYNC]:
+        throughput, latency = measure(durability, round_count)
+        print('%-15s throughput = %8.0f txn/s, commit latency = %.3f ms' % (durability, throughput, latency * 1000))
+    shutil.rmtree(os.path.expanduser('~/.pichain'), ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""This module measures the cost of a fork switch (`Node.move_to_block`) at MAX_TXN_COUNT scale: A node holding a backlog
+of MAX_TXN_COUNT pending transactions switches to a block on another fork containing MAX_TXN_COUNT transactions which
+are queued behind the backlog. For comparison the same removal is done on a plain list (the data structure `new_txs`
+used to be).
+
+Note: The blocktree is kept in memory (storage backend 'memory') s.t disk writes are not part of the measurement.
+"""
+
+import time
+import logging
+
+from twisted.internet import task
+
+from piChain.PaxosLogic import Node, GENESIS
+from piChain.messages import Block, Transaction
+from piChain.txpool import TransactionQueue
+from piChain.storage import MEMORY
+from piChain.config import MAX_TXN_COUNT
+
+logging.disable(logging.CRITICAL)
+
+# number of times each measurement is repeated
+REPETITIONS = 3
+
+
+def create_txns():
+    """
+    Returns:
+        tuple: list of transactions in the backlog and list of transactions in the target block.
+    """
+    backlog = [Transaction(1, 'put k%s v' % i, i) for i in range(MAX_TXN_COUNT)]
+    block_txs = [Transaction(2, 'put k%s v' % i, i) for i in range(MAX_TXN_COUNT)]
+    return backlog, block_txs
+
+
+def setup_node():
+    """Create a node with pending transactions and two forks below the genesis block. The head block is on the first
+    fork, the second fork contains MAX_TXN_COUNT of the pending transactions.
+
+    Returns:
+        tuple: node and the block on the second fork.
+    """
+    peers = {'0': {'ip': '127.0.0.1', 'port': 7982}}
+    node = Node(0, peers, storage_backend=MEMORY)
+    node.reactor = task.Clock()
+
+    backlog, block_txs = create_txns()
+    for txn in backlog + block_txs:
+        node.known_txs.add(txn.txn_id)
+    node.new_txs = TransactionQueue(backlog + block_txs)
+
+    head = Block(0, GENESIS.block_id, [Transaction(0, 'put a v', 1)], 1)
+    node.blocktree.add_block(head)
+    node.blocktree.head_block = head
+
+    target = Block(1, GENESIS.block_id, block_txs, 2)
+    node.blocktree.add_block(target)
+    return node, target
+
+
+def measure_move_to_block():
+    timings = []
+    for _ in range(REPETITIONS):
+        node, target = setup_node()
+        start = time.perf_counter()
+        node.move_to_block(target)
+        timings.append(time.perf_counter() - start)
+        node.blocktree.db.close()
+    return min(timings)
+
+
+def measure_list_removal():
+    """Removal of the transactions of the target block from a backlog stored in a list (previous implementation)."""
+    timings = []
+    for _ in range(REPETITIONS):
+        backlog, block_txs = create_txns()
+        new_txs = backlog + block_txs
+        start = time.perf_counter()
+        for tx in block_txs:
+            if tx in new_txs:
+                new_txs.remove(tx)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    print('fork switch with %s pending transactions:' % MAX_TXN_COUNT)
+    print('move_to_block (TransactionQueue): %.4f s' % measure_move_to_block())
+    print('removal from list (previous):     %.4f s' % measure_list_removal())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""This module measures the encoding and decoding throughput of paxos messages per message type, for the binary format
+(`PaxosMessage.serialize`) and the CBOR format used before (`PaxosMessage.serialize_cbor`).
+
+Usage: python pichain_paxos_message_benchmark.py
+"""
+
+import timeit
+
+from piChain.messages import PaxosMessage
+
+# number of messages encoded and decoded per measurement
+MESSAGE_COUNT = 100000
+
+
+def create_messages():
+    """
+    Returns:
+        list: one message per message type with the fields set the protocol sets.
+    """
+    try_msg = PaxosMessage('TRY', 1)
+    try_msg.new_block = 1 | (100 << 16)
+    try_msg.last_committed_block = 2 | (99 << 16)
+
+    try_ok = PaxosMessage('TRY_OK', 1)
+    try_ok.prop_block = 2 | (99 << 16)
+    try_ok.supp_block = 1 | (98 << 16)
+
+    propose = PaxosMessage('PROPOSE', 1)
+    propose.new_block = 1 | (100 << 16)
+    propose.com_block = 1 | (100 << 16)
+
+    propose_ack = PaxosMessage('PROPOSE_ACK', 1)
+    propose_ack.com_block = 1 | (100 << 16)
+
+    commit = PaxosMessage('COMMIT', 1)
+    commit.com_block = 1 | (100 << 16)
+    return [try_msg, try_ok, propose, propose_ack, commit]
+
+
+def throughput(f):
+    """
+    Returns:
+        float: calls of `f` per second.
+    """
+    return MESSAGE_COUNT / min(timeit.repeat(f, number=MESSAGE_COUNT, repeat=3))
+
+
+def main():
+    print('%-12s %14s %14s %14s %14s' % ('msg/s', 'encode', 'decode', 'encode (cbor)', 'decode (cbor)'))
+    for msg in create_messages():
+        data = msg.serialize()
+        data_cbor = msg.serialize_cbor()
+        print('%-12s %14.0f %14.0f %14.0f %14.0f' % (msg.msg_type, throughput(msg.serialize),
+                                                     throughput(lambda: PaxosMessage.unserialize(data)),
+                                                     throughput(msg.serialize_cbor),
+                                                     throughput(lambda: PaxosMessage.unserialize(data_cbor))))
+    print('size: %s bytes (cbor: %s bytes)' % (len(data), len(data_cbor)))
+
+
+if __name__ == "__main__":
+    main()
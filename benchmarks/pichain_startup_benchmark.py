@@ -0,0 +1,82 @@
+"""This module measures the startup time of a node (construction of `Blocktree` and `Node`) for databases containing
+10k, 100k and 1M blocks. For comparison the time needed to decode all stored blocks (what a node used to do at
+startup) is measured too.
+
+Usage: python pichain_startup_benchmark.py [block_count ...]
+Note: The databases are created inside a temporary directory.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import time
+import logging
+
+os.environ['HOME'] = tempfile.mkdtemp()
+
+from piChain.PaxosLogic import Node, GENESIS  # noqa: E402
+from piChain.blocktree import Blocktree, HEADER_PREFIX, META_PREFIX, LAYOUT_VERSION  # noqa: E402
+from piChain.messages import Block, Transaction  # noqa: E402
+
+logging.disable(logging.CRITICAL)
+
+BLOCK_COUNTS = [10000, 100000, 1000000]
+# number of transactions per block
+TXN_COUNT = 10
+
+
+def create_db(block_count):
+    """Write a chain of `block_count` blocks to the database of node 0."""
+    bt = Blocktree(0)
+    parent = GENESIS
+    with bt.db.write_batch() as wb:
+        for i in range(1, block_count + 1):
+            txs = [Transaction(0, 'put k%s v' % j, i * TXN_COUNT + j) for j in range(TXN_COUNT)]
+            b = Block(0, parent.block_id, txs, i)
+            b.depth = parent.depth + TXN_COUNT
+            block_id_bytes = str(b.block_id).encode()
+            wb.put(block_id_bytes, b.serialize())
+            wb.put(HEADER_PREFIX + block_id_bytes, b.serialize_header())
+            parent = b
+        wb.put(META_PREFIX + b'head_block', str(parent.block_id).encode())
+        wb.put(META_PREFIX + b'counter', str(block_count).encode())
+        wb.put(META_PREFIX + b'version', str(LAYOUT_VERSION).encode())
+    bt.db.close()
+
+
+def measure_startup():
+    peers = {'0': {'ip': '127.0.0.1', 'port': 7982}}
+    start = time.perf_counter()
+    node = Node(0, peers)
+    elapsed = time.perf_counter() - start
+    node.blocktree.db.close()
+    return elapsed
+
+
+def measure_full_decode():
+    """Decode every stored block including its transactions (startup cost before block headers were stored
+    separately)."""
+    bt = Blocktree(0)
+    start = time.perf_counter()
+    for key, value in bt.db:
+        if key.isdigit():
+            # the transactions are decoded lazily, access them to decode the whole block
+            Block.unserialize(value).txs
+    elapsed = time.perf_counter() - start
+    bt.db.close()
+    return elapsed
+
+
+def main():
+    block_counts = [int(arg) for arg in sys.argv[1:]] or BLOCK_COUNTS
+    for block_count in block_counts:
+        shutil.rmtree(os.path.expanduser('~/.pichain'), ignore_errors=True)
+        create_db(block_count)
+        print('%s blocks: startup = %.3f s, decoding all blocks = %.3f s' %
+              (block_count, measure_startup(), measure_full_decode()))
+    shutil.rmtree(os.path.expanduser('~/.pichain'), ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
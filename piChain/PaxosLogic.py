@@ -5,15 +5,19 @@ It implements the Node class which represents a piChain node and specifies how i
 import random
 import logging
 import time
-import json
+import functools
+from collections import OrderedDict
 
-from twisted.internet.task import deferLater
+from twisted.internet.task import deferLater, LoopingCall
 
 from piChain.PaxosNetwork import ConnectionManager
-from piChain.blocktree import Blocktree
+from piChain.blocktree import Blocktree, Compactor, ASYNC
+from piChain.txpool import TransactionQueue, TransactionFilter
 from piChain.messages import PaxosMessage, Block, RequestBlockMessage, RespondBlockMessage, Transaction, \
-    AckCommitMessage
-from piChain.config import ACCUMULATION_TIME, MAX_COMMIT_TIME, MAX_TXN_COUNT, TESTING, RECOVERY_BLOCKS_COUNT
+    AckCommitMessage, TransactionBatchMessage, RequestTransactionsMessage, RespondTransactionsMessage
+from piChain.config import ACCUMULATION_TIME, MAX_COMMIT_TIME, MAX_TXN_COUNT, TESTING, RECOVERY_BLOCKS_COUNT, \
+    DURABILITY, ASYNC_FLUSH_INTERVAL, STORAGE_BACKEND, STORAGE_DIR, TXN_BATCH_TIME, TXN_BATCH_SIZE, TXN_FORWARDING, \
+    TXN_FORWARD_TIMEOUT
 
 
 # variables representing the state of a node
@@ -23,6 +27,9 @@ SLOW = 2
 
 EPSILON = 0.001
 
+# max number of compact blocks waiting for missing transactions
+MAX_PENDING_COMPACT_BLOCKS = 16
+
 # genesis block
 GENESIS = Block(-1, None, [], 0)
 GENESIS.depth = 0
@@ -34,6 +41,18 @@ if not TESTING:
     logging.disable(logging.DEBUG)
 
 
+def atomic(method):
+    """Decorator for methods of Node that handle a message or a timer callback: all writes to disk done during the call
+    are collected and written as a single atomic batch once the method returns. The messages sent during the call are
+    written to the network afterwards (see `ConnectionManager.coalesce_writes`).
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.coalesce_writes(), self.blocktree.write_batch():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class Node(ConnectionManager):
     """This class represents a piChain node. It is a subclass of the ConnectionManager class defined in the networking
     module. This allows to directly call functions like broadcast and respond from the networking module and to override
@@ -42,13 +61,27 @@ class Node(ConnectionManager):
     Args:
         node_index (int): the index of this node into the peers dictionary. The entry defines its ip address and port.
         peers_dict (dict): a dict containing the (ip, port) pairs for all nodes (see examples folder for its structure).
+        durability (str): 'sync_on_vote', 'sync_on_commit' or 'async' (see DURABILITY in config.py).
+        storage_backend (str): 'leveldb', 'sqlite' or 'memory' (see STORAGE_BACKEND in config.py).
+        storage_dir (str): directory containing the storage of the node (see STORAGE_DIR in config.py).
 
     Attributes:
         state (int): 0,1 or 2 corresponds to QUICK, MEDIUM or SLOW.
         blocktree (Blocktree): The blocktree which this node owns.
-        known_txs (set): all txs seen so far. Set of txn ids.
-        new_txs (list): txs not yet in a block, behaving like a queue.
+        known_txs (TransactionFilter): all txs seen so far. Set of txn ids with bounded memory.
+        new_txs (TransactionQueue): txs not yet in a block, behaving like a queue.
         oldest_txn (Transaction): txn which started a timeout.
+        txn_batch (list): txs created by this node that are not yet broadcast (see TXN_BATCH_TIME in config.py).
+        txn_batch_call (IDelayedCall): broadcasts `txn_batch` once TXN_BATCH_TIME is over, None if not scheduled.
+        txn_forwarding (bool): if True txs are forwarded to the quick node only (see TXN_FORWARDING in config.py).
+        quick_node_id (int): id of the node believed to be QUICK (creator of the latest block created by a quick node),
+            None if unknown.
+        forwarded_txs (dict): Maps from txn_id to the forwarded txs which have not been seen in a block yet.
+        pending_compact_blocks (OrderedDict): Maps from block_id to [message, txs, missing, waiting, timeout] of compact
+            blocks waiting for the transactions at the positions `missing` in `txs`. `waiting` is a list of
+            (PaxosMessage, sender) referring to the block, they are handled once the block is complete or has been
+            received by other means. `timeout` (IDelayedCall) falls back to requesting the whole block (message, txs and
+            missing are None from then on, see `request_full_block`).
         s_max_block_depth (int):  depth of deepest block seen in round 1 (like T_max).
         s_prop_block (Block): stored block from a valid propose message.
         s_supp_block (Block): block supporting proposed block (like T_store).
@@ -67,8 +100,11 @@ class Node(ConnectionManager):
         slow_timeout (float): fix patience of a slow node (u.a.r only set once).
         n (int): total numberof nodes.
         retry_commit_timeout_queued (bool): is there a timeout in queue that will retry to commit.
+        flush_loop (LoopingCall): periodically syncs the writes to disk if durability is 'async'.
+        compactor (Compactor): compacts the storage in the background after blocks have been deleted.
     """
-    def __init__(self, node_index, peers_dict):
+    def __init__(self, node_index, peers_dict, durability=DURABILITY, storage_backend=STORAGE_BACKEND,
+                 storage_dir=STORAGE_DIR):
 
         super().__init__(node_index, peers_dict)
 
@@ -78,12 +114,21 @@ class Node(ConnectionManager):
         if self.id == 0:
             self.state = QUICK
 
-        self.blocktree = Blocktree(node_index)
+        self.blocktree = Blocktree(node_index, durability=durability, storage_backend=storage_backend,
+                                   storage_dir=storage_dir)
+        self.flush_loop = LoopingCall(self.blocktree.flush, True)
+        self.compactor = Compactor(self.blocktree)
 
         # Transaction variables
-        self.known_txs = set()
-        self.new_txs = []
+        self.known_txs = TransactionFilter()
+        self.new_txs = TransactionQueue()
         self.oldest_txn = None
+        self.txn_batch = []
+        self.txn_batch_call = None
+        self.pending_compact_blocks = OrderedDict()
+        self.txn_forwarding = TXN_FORWARDING
+        self.quick_node_id = None
+        self.forwarded_txs = {}
 
         # node acting as server
         self.s_max_block_depth = 0
@@ -112,16 +157,17 @@ class Node(ConnectionManager):
         self.n = len(self.peers)
 
         # load server variables (after crash)
-        for key, value in self.blocktree.db:
-            if key == b's_max_block_depth':
-                self.s_max_block_depth = int(value.decode())
-            elif key == b's_prop_block':
-                block = self.blocktree.nodes.get(int(value.decode()))
-                self.s_prop_block = block
-            elif key == b's_supp_block':
-                block = self.blocktree.nodes.get(int(value.decode()))
-                self.s_supp_block = block
-
+        s_max_block_depth = self.blocktree.get_meta(b's_max_block_depth')
+        if s_max_block_depth is not None:
+            self.s_max_block_depth = s_max_block_depth
+        s_prop_block = self.blocktree.get_meta(b's_prop_block')
+        if s_prop_block is not None:
+            self.s_prop_block = self.blocktree.nodes.get(s_prop_block)
+        s_supp_block = self.blocktree.get_meta(b's_supp_block')
+        if s_supp_block is not None:
+            self.s_supp_block = self.blocktree.nodes.get(s_supp_block)
+
+    @atomic
     def receive_paxos_message(self, message, sender):
         """React on a received paxos `message`. This method implements the main functionality of the paxos algorithm.
 
@@ -130,9 +176,18 @@ class Node(ConnectionManager):
             sender (Connection): Connection instance of the sender (None if sender is this Node).
         """
         logger.debug('receive message type = %s', message.msg_type)
+        if self.pending_compact_blocks:
+            for block_id in (message.new_block, message.com_block, message.prop_block, message.supp_block,
+                             message.last_committed_block):
+                pending = self.pending_compact_blocks.get(block_id)
+                if pending is not None:
+                    # the block is still missing transactions
+                    pending[3].append((message, sender))
+                    return
+
         if message.msg_type == 'TRY':
             # make sure last commited block of sender is also committed by this node
-            if message.last_committed_block not in self.blocktree.committed_blocks:
+            if message.last_committed_block not in self.blocktree.committed_block_ids:
                 last_committed_block = self.get_block(message.last_committed_block)
                 if last_committed_block is None:
                     return
@@ -154,7 +209,7 @@ class Node(ConnectionManager):
                 self.s_max_block_depth = new_block.depth
 
                 # write changes to disk (add s_max_block_depth)
-                self.blocktree.db.put(b's_max_block_depth', str(self.s_max_block_depth).encode())
+                self.blocktree.put_meta(b's_max_block_depth', self.s_max_block_depth)
 
                 # create a TRY_OK message
                 try_ok = PaxosMessage('TRY_OK', message.request_seq)
@@ -162,10 +217,7 @@ class Node(ConnectionManager):
                     try_ok.prop_block = self.s_prop_block.block_id
                 if self.s_supp_block is not None:
                     try_ok.supp_block = self.s_supp_block.block_id
-                if sender is not None:
-                    self.respond(try_ok, sender)
-                else:
-                    self.receive_paxos_message(try_ok, None)
+                self.send_vote(try_ok, sender)
 
         elif message.msg_type == 'TRY_OK':
             # check if message is not outdated
@@ -222,21 +274,16 @@ class Node(ConnectionManager):
 
                 # write changes to disk (add s_prop_block and s_supp_block)
                 if self.s_prop_block is not None:
-                    block_id_bytes = str(self.s_prop_block.block_id).encode()
-                    self.blocktree.db.put(b's_prop_block', block_id_bytes)
+                    self.blocktree.put_meta(b's_prop_block', self.s_prop_block.block_id)
 
                 if self.s_supp_block is not None:
-                    block_id_bytes = str(self.s_supp_block.block_id).encode()
-                    self.blocktree.db.put(b's_supp_block', block_id_bytes)
+                    self.blocktree.put_meta(b's_supp_block', self.s_supp_block.block_id)
 
                 # create a PROPOSE_ACK message
                 propose_ack = PaxosMessage('PROPOSE_ACK', message.request_seq)
                 propose_ack.com_block = message.com_block
 
-                if sender is not None:
-                    self.respond(propose_ack, sender)
-                else:
-                    self.receive_paxos_message(propose_ack, None)
+                self.send_vote(propose_ack, sender)
 
         elif message.msg_type == 'PROPOSE_ACK':
             # check if message is not outdated
@@ -268,39 +315,72 @@ class Node(ConnectionManager):
                 return
             self.commit(com_block)
 
+    def send_vote(self, vote, sender):
+        """Send `vote` once the paxos state it promises is durable (see `Blocktree.sync_vote`).
+
+        Args:
+            vote (PaxosMessage): TRY_OK or PROPOSE_ACK message.
+            sender (Connection): Connection to the node which requested the vote, None if this node requested it.
+        """
+        d = self.blocktree.sync_vote()
+        if sender is not None:
+            d.addCallback(lambda _: self.respond(vote, sender))
+        else:
+            d.addCallback(lambda _: self.receive_paxos_message(vote, None))
+
     def receive_transaction(self, txn):
         """React on a received `txn` depending on state.
 
         Args:
             txn (Transaction): Transaction received.
         """
-        # check if txn has already been seen
-        if txn.txn_id not in self.known_txs:
-            logger.debug('txn has not yet been seen')
-            # add txn to set of seen txs
-            self.known_txs.add(txn.txn_id)
-
-            # timeout handling
-            self.new_txs.append(txn)
-            if len(self.new_txs) == 1:
-                self.oldest_txn = txn
-                # start a timeout
-                logger.debug('start timeout')
-                deferLater(self.reactor, self.get_patience(), self.timeout_over, txn)
-        else:
-            logger.debug('txn has already been seen')
+        self.receive_transactions([txn])
+
+    def receive_transactions(self, txs):
+        """React on received `txs` (e.g a TransactionBatchMessage) depending on state.
 
+        Args:
+            txs (list): Transactions received.
+        """
+        known_txs = self.known_txs
+        new_txs = self.new_txs
+        was_empty = len(new_txs) == 0
+        for txn in txs:
+            # check if txn has already been seen
+            if txn.txn_id not in known_txs:
+                # add txn to set of seen txs
+                known_txs.add(txn.txn_id)
+                new_txs.append(txn)
+
+        # timeout handling
+        if was_empty and len(new_txs) != 0:
+            self.oldest_txn = new_txs.first()
+            # start a timeout
+            logger.debug('start timeout')
+            deferLater(self.reactor, self.get_patience(), self.timeout_over, self.oldest_txn)
+
+    @atomic
     def receive_block(self, block):
         """React on a received `block`.
 
         Args:
             block (Block): Received block.
         """
+        pending = self.pending_compact_blocks.pop(block.block_id, None)
+        if pending is not None:
+            # complete now (or received as a whole): handle the paxos messages waiting for it afterwards
+            self.receive_block(block)
+            self.resume_waiting(pending)
+            return
+
         # make sure block is reachable
         if not self.reach_genesis_block(block):
             logger.debug('block not reachable')
             return
 
+        if block.creator_state == QUICK:
+            self.quick_node_id = block.creator_id
+
         # demote node if necessary
         if self.blocktree.head_block < block or block.creator_state == QUICK:
             if self.state != SLOW:
@@ -342,16 +422,150 @@ class Node(ConnectionManager):
             respond = RespondBlockMessage(blocks)
             self.respond(respond, sender)
 
+    @atomic
     def receive_respond_blocks_message(self, resp):
         """Receive the blocks that are missing from a peer. Can directly be added to `self.nodes`.
 
         Args:
             resp (RespondBlockMessage): may contain the missing blocks s.t the node can recover.
         """
+        # add the oldest block first s.t the blocks waiting for it are connected to the genesis block incrementally
         blocks = resp.blocks
-        for b in blocks:
+        for b in reversed(blocks):
             self.blocktree.add_block(b)
 
+        # blocks received as compact blocks that were still missing transactions
+        if self.pending_compact_blocks:
+            for b in reversed(blocks):
+                self.release_compact_block(b.block_id)
+
+    def receive_compact_block(self, message, sender):
+        """Rebuild a block from its header and the ids of its transactions (taken from `new_txs`). Missing transactions
+        are requested from the sender.
+
+        Args:
+            message (CompactBlockMessage): Received compact block.
+            sender (Connection): Connection instance from the sender.
+        """
+        block = message.block
+        if block.block_id in self.blocktree.nodes or block.block_id in self.pending_compact_blocks:
+            return
+
+        txs = []
+        missing = []
+        for i, txn_id in enumerate(message.txn_ids):
+            txn = self.new_txs.get(txn_id)
+            if txn is None:
+                missing.append(i)
+            txs.append(txn)
+
+        if not missing:
+            block.txs = txs
+            self.receive_block(block)
+            return
+
+        logger.debug('compact block: request %s missing txs', len(missing))
+        timeout = self.reactor.callLater(2 * self.expected_rtt, self.compact_block_timeout, block.block_id)
+        self.pending_compact_blocks[block.block_id] = [message, txs, missing, [], timeout]
+        if len(self.pending_compact_blocks) > MAX_PENDING_COMPACT_BLOCKS:
+            # the oldest block is requested as a whole
+            block_id = next(iter(self.pending_compact_blocks))
+            self.broadcast(RequestBlockMessage(block_id), 'RQB')
+            self.release_compact_block(block_id)
+        self.respond(RequestTransactionsMessage(block.block_id, missing), sender)
+
+    def receive_request_transactions_message(self, req, sender):
+        """Send the requested transactions of a block to a node that received it as compact block.
+
+        Args:
+            req (RequestTransactionsMessage): Message that requests missing transactions.
+            sender (Connection): Connection instance from the sender.
+        """
+        block = self.blocktree.nodes.get(req.block_id)
+        if block is None:
+            return
+        txs = block.txs
+        if any(i >= len(txs) for i in req.indices):
+            return
+        self.respond(RespondTransactionsMessage(req.block_id, [txs[i] for i in req.indices]), sender)
+
+    def receive_respond_transactions_message(self, resp):
+        """Complete a compact block with the transactions that were missing.
+
+        Args:
+            resp (RespondTransactionsMessage): the missing transactions of a compact block.
+        """
+        pending = self.pending_compact_blocks.get(resp.block_id)
+        if pending is None or pending[0] is None:
+            return
+        message, txs, missing = pending[:3]
+        if len(resp.txs) != len(missing) or \
+                any(txn.txn_id != message.txn_ids[i] for i, txn in zip(missing, resp.txs)):
+            logger.debug('compact block: invalid txs received, request the whole block')
+            self.request_full_block(resp.block_id)
+            return
+        for i, txn in zip(missing, resp.txs):
+            txs[i] = txn
+        message.block.txs = txs
+        del self.pending_compact_blocks[resp.block_id]
+        self.receive_block(message.block)
+
+        # handle the paxos messages that arrived before the block was complete
+        self.resume_waiting(pending)
+
+    def request_full_block(self, block_id):
+        """Give up completing a compact block and request the whole block instead. The paxos messages referring to it
+        keep waiting until it is received.
+
+        Args:
+            block_id (int): id of a block in `pending_compact_blocks`.
+        """
+        pending = self.pending_compact_blocks[block_id]
+        if pending[4].active():
+            pending[4].cancel()
+        pending[:3] = [None, None, None]
+        pending[4] = self.reactor.callLater(2 * self.expected_rtt, self.compact_block_timeout, block_id)
+        self.broadcast(RequestBlockMessage(block_id), 'RQB')
+
+    @atomic
+    def compact_block_timeout(self, block_id):
+        """Called if a compact block is not complete in time: the whole block is requested. If it is not received
+        either, the paxos messages waiting for it are handled anyway (they request the block again if needed).
+
+        Args:
+            block_id (int): id of the block.
+        """
+        pending = self.pending_compact_blocks.get(block_id)
+        if pending is None:
+            return
+        if pending[0] is not None:
+            logger.debug('compact block: missing txs not received, request the whole block')
+            self.request_full_block(block_id)
+        else:
+            self.release_compact_block(block_id)
+
+    def release_compact_block(self, block_id):
+        """Remove a block from `pending_compact_blocks` and handle the paxos messages that were waiting for it.
+
+        Args:
+            block_id (int): id of the block.
+        """
+        pending = self.pending_compact_blocks.pop(block_id, None)
+        if pending is not None:
+            self.resume_waiting(pending)
+
+    def resume_waiting(self, pending):
+        """Cancel the timeout of a block removed from `pending_compact_blocks` and handle the paxos messages that were
+        waiting for it.
+
+        Args:
+            pending (list): entry of the block in `pending_compact_blocks`.
+        """
+        if pending[4].active():
+            pending[4].cancel()
+        for paxos_message, sender in pending[3]:
+            self.receive_paxos_message(paxos_message, sender)
+
     def receive_pong_message(self, message, peer_node_id):
         """Receive PongMessage and update RRT's accordingly.
 
@@ -367,6 +581,7 @@ class Node(ConnectionManager):
         self.rtts.update({peer_node_id: rtt})
         self.expected_rtt = max(self.rtts.values()) + 0.1
 
+    @atomic
     def receive_ack_commit_message(self, message):
         """Check if all nodes acknowledged this block, if true make it the new genesis block and delete the blocks
         below the new genesis block from db and blocktree.
@@ -396,24 +611,23 @@ class Node(ConnectionManager):
             logger.debug('new genesis block id = %s', str(self.blocktree.genesis.block_id))
 
             # write it to db
-            block_id_bytes = str(self.blocktree.genesis.block_id).encode()
-            self.blocktree.db.put(b'genesis', block_id_bytes)
+            self.blocktree.put_meta(b'genesis', self.blocktree.genesis.block_id)
 
             # delete inside blocktree.nodes dict and on disk
             parent = self.blocktree.genesis
             while parent is not None and parent.parent_block_id is not None:
                 parent_block_id = parent.parent_block_id
-                self.blocktree.db.delete(str(parent_block_id).encode())
-                parent = self.blocktree.nodes.pop(parent_block_id, None)
-                # also delete txns
-                if parent is not None:
-                    for txn in parent.txs:
-                        self.known_txs.discard(txn.txn_id)
+                parent = self.blocktree.delete_block(parent_block_id)
 
             self.blocktree.nodes.update({GENESIS.block_id: GENESIS})
+            self.blocktree.index_block(GENESIS)
+            self.blocktree.reset_connected()
 
-            # force deletion in leveldb
-            self.blocktree.db.compact_range()
+            # reclaim the space on disk in the background once enough data has been deleted (not before the deletions
+            # have been written, else the compaction would miss them)
+            deleted_bytes = self.blocktree.deleted_bytes
+            self.blocktree.deleted_bytes = 0
+            self.blocktree.written().addCallback(lambda _: self.compactor.add_deleted_bytes(deleted_bytes))
 
     def move_to_block(self, target):
         """Change to `target` block as new `head_block`. If `target` is found on a forked path, have to broadcast txs
@@ -435,13 +649,14 @@ class Node(ConnectionManager):
                 to_broadcast |= set(b.txs)
                 b = self.blocktree.nodes.get(b.parent_block_id)
             # go from target to common ancestor: remove txs from to_broadcast and new_txs, add to known_txs
+            forwarded_txs = self.forwarded_txs
             b = target
             while b != common_ancestor:
                 for tx in b.txs:
                     self.known_txs.add(tx.txn_id)
-                for tx in b.txs:
-                    if tx in self.new_txs:
-                        self.new_txs.remove(tx)
+                    self.new_txs.discard(tx)
+                    if forwarded_txs:
+                        forwarded_txs.pop(tx.txn_id, None)
                 to_broadcast -= set(b.txs)
                 b = self.blocktree.nodes.get(b.parent_block_id)
 
@@ -449,12 +664,11 @@ class Node(ConnectionManager):
             self.blocktree.head_block = target
 
             # write changes to disk (add headblock)
-            block_id_bytes = str(target.block_id).encode()
-            self.blocktree.db.put(b'head_block', block_id_bytes)
+            self.blocktree.put_meta(b'head_block', target.block_id)
 
             # broadcast txs in to_broadcast
-            for tx in to_broadcast:
-                self.broadcast(tx, 'TXN')
+            if to_broadcast:
+                self.send_txs(list(to_broadcast))
             self.readjust_timeout()
 
     def commit(self, block):
@@ -464,7 +678,7 @@ class Node(ConnectionManager):
             block (Block): Block to be committed.
 
         """
-        if block.block_id in self.blocktree.committed_blocks:
+        if block.block_id in self.blocktree.committed_block_ids:
             return
 
         # make sure block is reachable
@@ -481,8 +695,7 @@ class Node(ConnectionManager):
             self.move_to_block(block)
 
             # write changes to disk (add committed block)
-            block_id_bytes = str(block.block_id).encode()
-            self.blocktree.db.put(b'committed_block', block_id_bytes)
+            self.blocktree.put_meta(b'committed_block', block.block_id)
 
             # broadcast confirmation of committing this block
             acm = AckCommitMessage(block.block_id)
@@ -506,14 +719,11 @@ class Node(ConnectionManager):
                 # write committed block to stdout (-> testing purpose)
                 print('block = %s:', str(b.block_id))
 
-                self.blocktree.committed_blocks.append(b.block_id)
-                # write changes to disk
-                block_ids_str = json.dumps(self.blocktree.committed_blocks)
-                block_ids_bytes = block_ids_str.encode()
-                self.blocktree.db.put(b'committed_blocks', block_ids_bytes)
+                # append block to commit log (also writes changes to disk)
+                self.blocktree.add_committed_block(b.block_id)
 
                 logger.debug('committing a block: with block id = %s', str(b.block_id))
-                logger.debug('committed blocks so far: %s', str(self.blocktree.committed_blocks))
+                logger.debug('committed blocks so far: %s', len(self.blocktree.committed_blocks))
 
                 # call callable of app service
                 commands = []
@@ -529,9 +739,10 @@ class Node(ConnectionManager):
             self.c_commit_running = False
 
             # write changes to disk (delete s_max_block, s_prop_block and s_supp_block)
-            self.blocktree.db.delete(b's_max_block_depth')
-            self.blocktree.db.delete(b's_prop_block')
-            self.blocktree.db.delete(b's_supp_block')
+            self.blocktree.delete_meta(b's_max_block_depth')
+            self.blocktree.delete_meta(b's_prop_block')
+            self.blocktree.delete_meta(b's_supp_block')
+            self.blocktree.sync_commit()
 
     def reach_genesis_block(self, block):
         """Check if there is a path from `block` to `GENESIS` block. If a block on the path is not contained in
@@ -545,14 +756,11 @@ class Node(ConnectionManager):
             bool: True if `GENESIS` block was reached.
         """
         self.blocktree.add_block(block)
-        b = block
-        while b != self.blocktree.genesis:
-            if self.blocktree.nodes.get(b.parent_block_id) is not None:
-                b = self.blocktree.nodes.get(b.parent_block_id)
-            else:
-                req = RequestBlockMessage(b.parent_block_id)
-                self.broadcast(req, 'RQB')
-                return False
+        b = self.blocktree.connect_to_genesis(block)
+        if b is not None:
+            req = RequestBlockMessage(b.parent_block_id)
+            self.broadcast(req, 'RQB')
+            return False
         return True
 
     def create_block(self):
@@ -567,27 +775,16 @@ class Node(ConnectionManager):
         d = self.blocktree.head_block.depth
 
         # create block
-        self.blocktree.counter += 1
-        if len(self.new_txs) < MAX_TXN_COUNT:
-            b = Block(self.id, self.blocktree.head_block.block_id, self.new_txs, self.blocktree.counter)
-            # create a new, empty list (do not use clear!)
-            self.new_txs = []
-        else:
+        txns_include = self.new_txs.pop_front(MAX_TXN_COUNT)
+        b = Block(self.id, self.blocktree.head_block.block_id, txns_include, self.blocktree.next_counter())
+        if len(self.new_txs) != 0:
             logger.debug('Cannot fit all transactions in the block that is beeing created. Remaining transactions '
                          'will be included in the next block.')
-            txns_include = self.new_txs[:MAX_TXN_COUNT]
-            b = Block(self.id, self.blocktree.head_block.block_id, txns_include, self.blocktree.counter)
-            self.new_txs = self.new_txs[MAX_TXN_COUNT:]
             self.readjust_timeout()
 
         # compute its depth (will be fixed -> depth field is only set once)
         b.depth = d + len(b.txs)
 
-        self.blocktree.db.put(b'counter', str(self.blocktree.counter).encode())
-
-        # add block to blocktree
-        self.blocktree.add_block(b)
-
         # promote node
         if self.state != QUICK:
             self.state = max(QUICK, self.state - 1)
@@ -596,6 +793,9 @@ class Node(ConnectionManager):
         # add state of creator node to block
         b.creator_state = self.state
 
+        # add block to blocktree
+        self.blocktree.add_block(b)
+
         logger.debug('created block with block id = %s', str(b.block_id))
 
         return b
@@ -624,6 +824,7 @@ class Node(ConnectionManager):
                 patience = self.slow_timeout
         return patience + ACCUMULATION_TIME
 
+    @atomic
     def timeout_over(self, txn):
         """This function is called once a timeout is over. Will check if in the meantime the node received
         the `txn`. If not it is allowed to ceate a new block and broadcast it.
@@ -641,11 +842,12 @@ class Node(ConnectionManager):
             self.c_current_committable_block = b
             self.start_commit_process()
 
+    @atomic
     def start_commit_process(self):
         """Commit `self.current_committable_block`."""
         self.retry_commit_timeout_queued = False
 
-        if self.c_current_committable_block.block_id in self.blocktree.committed_blocks:
+        if self.c_current_committable_block.block_id in self.blocktree.committed_block_ids:
             # this block has already been committed
             return
 
@@ -688,11 +890,13 @@ class Node(ConnectionManager):
 
     def readjust_timeout(self):
         """Is called if `new_txs` changed and thus the `oldest_txn` may be removed."""
-        if len(self.new_txs) != 0 and self.new_txs[0] != self.oldest_txn:
-                self.oldest_txn = self.new_txs[0]
+        oldest_txn = self.new_txs.first()
+        if oldest_txn is not None and (self.oldest_txn is None or oldest_txn != self.oldest_txn):
+                self.oldest_txn = oldest_txn
                 # start a new timeout
-                deferLater(self.reactor, self.get_patience(), self.timeout_over, self.new_txs[0])
+                deferLater(self.reactor, self.get_patience(), self.timeout_over, self.oldest_txn)
 
+    @atomic
     def commit_timeout(self, commit_counter):
         """Is called once a commit should have been finished. If it is still running, it will be 'terminated'. """
         if self.c_commit_running and self.c_request_seq == commit_counter:
@@ -721,13 +925,101 @@ class Node(ConnectionManager):
 
     # methods used by the app (part of external interface)
 
+    @atomic
     def make_txn(self, command):
-        """This method is called by the app with the command to be committed.
+        """This method is called by the app with the command to be committed. The transaction is broadcast together
+        with the other transactions created within TXN_BATCH_TIME (see `broadcast_txn_batch`).
 
         Args:
             command (str): command to be commited
         """
-        self.blocktree.counter += 1
-        txn = Transaction(self.id, command, self.blocktree.counter)
-        self.blocktree.db.put(b'counter', str(self.blocktree.counter).encode())
-        self.broadcast(txn, 'TXN')
+        txn = Transaction(self.id, command, self.blocktree.next_counter())
+        self.receive_transaction(txn)
+        if TXN_BATCH_TIME <= 0:
+            self.send_txs([txn])
+            return
+
+        self.txn_batch.append(txn)
+        if len(self.txn_batch) >= TXN_BATCH_SIZE:
+            self.broadcast_txn_batch()
+        elif self.txn_batch_call is None:
+            self.txn_batch_call = self.reactor.callLater(TXN_BATCH_TIME, self.broadcast_txn_batch)
+
+    @atomic
+    def make_txns(self, commands):
+        """This method is called by the app with many commands to be committed. They are broadcast at once.
+
+        Args:
+            commands (list): commands (str) to be commited.
+        """
+        txs = [Transaction(self.id, command, self.blocktree.next_counter()) for command in commands]
+        self.receive_transactions(txs)
+        self.txn_batch.extend(txs)
+        self.broadcast_txn_batch()
+
+    def broadcast_txn_batch(self):
+        """Broadcast the transactions in `txn_batch` in messages of up to TXN_BATCH_SIZE transactions."""
+        if self.txn_batch_call is not None:
+            if self.txn_batch_call.active():
+                self.txn_batch_call.cancel()
+            self.txn_batch_call = None
+
+        txn_batch = self.txn_batch
+        self.txn_batch = []
+        self.send_txs(txn_batch)
+
+    def send_txs(self, txs, forward=True):
+        """Broadcast `txs` in messages of up to TXN_BATCH_SIZE transactions. If `txn_forwarding` is set and the quick
+        node is connected, they are sent to the quick node only and broadcast after TXN_FORWARD_TIMEOUT unless they
+        have been included in a block by then (see `forward_timeout`).
+
+        Args:
+            txs (list): Transactions to be sent.
+            forward (bool): if False the transactions are broadcast in any case.
+        """
+        connection = None
+        if forward and self.txn_forwarding and self.quick_node_id is not None:
+            connection = self.peers_connection.get(str(self.quick_node_id))
+
+        for i in range(0, len(txs), TXN_BATCH_SIZE):
+            chunk = txs[i:i + TXN_BATCH_SIZE]
+            if len(chunk) == 1:
+                obj, msg_type = chunk[0], 'TXN'
+            else:
+                obj, msg_type = TransactionBatchMessage(chunk), 'TXB'
+            if connection is None:
+                self.broadcast(obj, msg_type)
+            else:
+                self.respond(obj, connection)
+
+        if connection is not None:
+            for txn in txs:
+                self.forwarded_txs[txn.txn_id] = txn
+            self.reactor.callLater(TXN_FORWARD_TIMEOUT, self.forward_timeout, txs)
+
+    @atomic
+    def forward_timeout(self, txs):
+        """Is called once TXN_FORWARD_TIMEOUT is over after `txs` have been forwarded to the quick node. The txs not
+        included in a block by then are broadcast to all nodes, the quick node is considered unknown until the next
+        block of a quick node is received.
+
+        Args:
+            txs (list): Transactions that were forwarded.
+        """
+        remaining = [txn for txn in txs if self.forwarded_txs.pop(txn.txn_id, None) is not None]
+        if remaining:
+            logger.debug('%s forwarded txs not included in a block, broadcast them', len(remaining))
+            self.quick_node_id = None
+            self.send_txs(remaining, forward=False)
+
+    def start_server(self):
+        """Set up the background tasks of the storage (periodic flush if writes are not synced otherwise, compaction
+        and writer thread), then start the server (see `ConnectionManager.start_server`)."""
+        if self.blocktree.durability == ASYNC and not self.flush_loop.running:
+            self.flush_loop.clock = self.reactor
+            self.flush_loop.start(ASYNC_FLUSH_INTERVAL, now=False)
+        self.compactor.reactor = self.reactor
+        if self.blocktree.writer is not None:
+            self.blocktree.writer.reactor = self.reactor
+            self.reactor.addSystemEventTrigger('before', 'shutdown', self.blocktree.writer.stop)
+        super().start_server()
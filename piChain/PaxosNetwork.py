@@ -5,25 +5,83 @@ import logging
 import json
 import time
 import struct
+import zlib
+from collections import deque
+from contextlib import contextmanager
 
 from twisted.internet.protocol import Factory, connectionDone
-from twisted.protocols.basic import IntNStringReceiver
+from twisted.protocols.basic import IntNStringReceiver, StringTooLongError
 from twisted.internet.endpoints import TCP4ClientEndpoint, TCP4ServerEndpoint, connectProtocol
 from twisted.internet import reactor, task
 from twisted.internet.task import LoopingCall
 from twisted.python import log
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
 
 from piChain.messages import RequestBlockMessage, Transaction, Block, RespondBlockMessage, PaxosMessage, PingMessage, \
-    PongMessage, AckCommitMessage
+    PongMessage, AckCommitMessage, TransactionBatchMessage, CompactBlockMessage, RequestTransactionsMessage, \
+    RespondTransactionsMessage
+from piChain.config import COMPRESSION, COMPRESSION_LEVEL, COMPRESSION_THRESHOLD, TRANSFER_CHUNK_SIZE, \
+    MAX_TRANSFER_SIZE, COMPACT_BLOCKS, WRITE_COALESCING, WRITE_BUFFER_SIZE
 
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+# message types that are compressed on connections which negotiated compression
+COMPRESSED_TYPES = {b'BLK', b'RSB', b'CBK', b'RST'}
 
+# header of a fragment (FRG message): transfer id, size of the whole message
+FRAGMENT_HEADER = struct.Struct('<IQ')
+
+# message types referring to blocks: sent only after the fragmented messages queued before them (see `send_message`)
+ORDERED_TYPES = {b'PAM', b'ACM'}
+
+
+def compress_frame(data, level):
+    """Compress a message (including its type) and wrap it into a ZLB message.
+
+    Args:
+        data (bytes): serialized message.
+        level (int): zlib compression level.
+
+    Returns:
+        bytes: the ZLB message, or `data` itself if compression does not make it smaller.
+    """
+    compressed = b'ZLB' + zlib.compress(data, level)
+    if len(compressed) >= len(data):
+        return data
+    return compressed
+
+
+def decompress_frame(string, max_length):
+    """Unwrap a ZLB message.
+
+    Args:
+        string (bytes): the ZLB message.
+        max_length (int): max size of the decompressed message.
+
+    Returns:
+        bytes: the original message, None if it is larger than `max_length`, not a compressible message type or not
+            a complete zlib stream.
+    """
+    d = zlib.decompressobj()
+    try:
+        data = d.decompress(memoryview(string)[3:], max_length)
+    except zlib.error:
+        return None
+    # a truncated stream decompresses without error but never reaches its end
+    if not d.eof or d.unconsumed_tail or data[:3] not in COMPRESSED_TYPES:
+        return None
+    return data
+
+
+@implementer(IPushProducer)
 class Connection(IntNStringReceiver):
     """This class keeps track of information about a connection with another node. It is a subclass of
     `IntNStringReceiver` i.e each complete message that's received becomes a callback to the method `stringReceived`.
+    It is registered as producer of its transport to send large messages in fragments whenever the transport is ready
+    (see `send_message`).
 
     Args:
         factory (ConnectionManager): Twisted Factory used to keep a shared state among multiple connections.
@@ -34,6 +92,25 @@ class Connection(IntNStringReceiver):
         node_id (str): Unique predefined id of the node on this side of the connection.
         peer_node_id (str): Unique predefined id of the node on the other side of the connection.
         lc_ping (LoopingCall): keeps sending ping messages to other nodes to estimate correct round trip times.
+        compression (bool): True if both nodes support compression (negotiated in the handshake). BLK and RSB messages
+            sent over this connection are then compressed (see `ConnectionManager.compress`).
+        chunked (bool): True if the peer supports fragmented messages (negotiated in the handshake).
+        compact_blocks (bool): True if blocks are sent to the peer as compact blocks (negotiated in the handshake).
+        handlers (dict): Maps from the type (bytes) of a message handled by the connection itself to the method
+            handling it.
+        transfer_id (int): id of the last fragmented message sent.
+        outgoing_transfers (deque): [transfer_id, data, offset] of each message whose fragments are not all sent yet.
+        ordered_messages (deque): [set of transfer ids, data] of each message of ORDERED_TYPES waiting for the
+            fragmented messages queued before it (the ids of the transfers not yet completely sent).
+        paused (bool): True while the transport buffer is full.
+        incoming_transfers (dict): Maps from a transfer id to the fragments (bytearray) of the message received so
+            far.
+        incoming_size (int): total size of the messages in `incoming_transfers`.
+        out_frames (list): length prefixes and messages collected while writes are coalesced (see
+            `ConnectionManager.coalesce_writes`).
+        out_size (int): total size of `out_frames` in bytes.
+        frames_sent (int): number of messages written to the transport.
+        flush_count (int): number of writes to the transport (`frames_sent / flush_count` messages per write).
     """
     # little endian, unsigned int
     structFormat = '<I'
@@ -44,6 +121,23 @@ class Connection(IntNStringReceiver):
         self.node_id = str(self.connection_manager.id)
         self.peer_node_id = None
         self.lc_ping = LoopingCall(self.send_ping)
+        self.compression = False
+        self.chunked = False
+        self.compact_blocks = False
+        self.handlers = {b'HEL': self.receive_hello, b'ACK': self.receive_hello_ack, b'PIN': self.receive_ping,
+                         b'ZLB': self.receive_compressed, b'FRG': self.receive_fragment}
+
+        self.transfer_id = 0
+        self.outgoing_transfers = deque()
+        self.ordered_messages = deque()
+        self.paused = False
+        self.incoming_transfers = {}
+        self.incoming_size = 0
+
+        self.out_frames = []
+        self.out_size = 0
+        self.frames_sent = 0
+        self.flush_count = 0
 
         # init max message size to 10 Megabyte
         self.MAX_LENGTH = 10000000
@@ -51,6 +145,7 @@ class Connection(IntNStringReceiver):
     def connectionMade(self):
         """Called once a connection with another node has been made."""
         logger.debug('Connected to %s.', str(self.transport.getPeer()))
+        self.transport.registerProducer(self, True)
 
     def connectionLost(self, reason=connectionDone):
         """Called once a connection with another node has been lost."""
@@ -68,59 +163,255 @@ class Connection(IntNStringReceiver):
         if self.lc_ping.running:
             self.lc_ping.stop()
 
+        self.outgoing_transfers.clear()
+        self.ordered_messages.clear()
+        self.incoming_transfers.clear()
+        self.incoming_size = 0
+        self.out_frames = []
+        self.out_size = 0
+
+    def dataReceived(self, data):
+        """Called with the data received from the peer. The messages sent while handling the contained messages are
+        coalesced."""
+        with self.connection_manager.coalesce_writes():
+            super().dataReceived(data)
+
+    def sendString(self, string):
+        """Send a message prefixed by its length. While writes are coalesced the message is collected in `out_frames`
+        and written together with the other collected messages.
+
+        Args:
+            string (bytes): the message.
+        """
+        if len(string) >= 2 ** (8 * self.prefixLength):
+            raise StringTooLongError('Try to send %s bytes whereas maximum is %s' %
+                                     (len(string), 2 ** (8 * self.prefixLength)))
+
+        manager = self.connection_manager
+        if not manager.coalescing:
+            self.transport.write(struct.pack(self.structFormat, len(string)) + string)
+            self.frames_sent += 1
+            self.flush_count += 1
+            return
+
+        if not self.out_frames:
+            manager.pending_connections.append(self)
+        self.out_frames.append(struct.pack(self.structFormat, len(string)))
+        self.out_frames.append(string)
+        self.out_size += self.prefixLength + len(string)
+        if self.out_size >= manager.write_buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Write the messages collected in `out_frames` to the transport at once."""
+        if not self.out_frames:
+            return
+        frames = self.out_frames
+        self.out_frames = []
+        self.out_size = 0
+        self.frames_sent += len(frames) // 2
+        self.flush_count += 1
+        self.transport.write(b''.join(frames))
+
     def stringReceived(self, string):
-        """Callback that is called as soon as a complete message is available.
+        """Callback that is called as soon as a complete message is available. Messages concerning the connection
+        itself are handled here (see `handlers`), all others are delegated to the connection manager.
 
         Args:
             string (bytes): The string received.
         """
-        msg_type = string[:3].decode()
+        msg_type = string[:3]
+        handler = self.handlers.get(msg_type)
+        if handler is not None:
+            handler(string)
+        else:
+            self.connection_manager.message_callback(msg_type, string, self)
+
+    def receive_hello(self, string):
+        """Handle a handshake message.
+
+        Args:
+            string (bytes): HEL message.
+        """
+        msg = json.loads(string[3:])
+        peer_node_id = msg['nodeid']
+        logger.debug('Handshake from %s with peer_node_id = %s ', str(self.transport.getPeer()), peer_node_id)
+        self.negotiate_features(msg)
+        self.add_peer(peer_node_id)
 
-        if msg_type == 'HEL':
-            msg = json.loads(string[3:])
-            # handle handshake message
-            peer_node_id = msg['nodeid']
-            logger.debug('Handshake from %s with peer_node_id = %s ', str(self.transport.getPeer()), peer_node_id)
+        # give peer chance to add connection
+        self.send_hello_ack()
 
-            if peer_node_id not in self.connection_manager.peers_connection:
-                self.connection_manager.peers_connection.update({peer_node_id: self})
-                self.peer_node_id = peer_node_id
+    def receive_hello_ack(self, string):
+        """Handle a handshake acknowledgement message.
 
-                # start ping loop
-                if not self.lc_ping.running:
-                    self.lc_ping.start(20, now=True)
+        Args:
+            string (bytes): ACK message.
+        """
+        msg = json.loads(string[3:])
+        peer_node_id = msg['nodeid']
+        logger.debug('Handshake ACK from %s with peer_node_id = %s ', str(self.transport.getPeer()), peer_node_id)
+        self.negotiate_features(msg)
+        self.add_peer(peer_node_id)
+
+    def add_peer(self, peer_node_id):
+        """Register this connection as the connection to `peer_node_id` if there is none yet.
+
+        Args:
+            peer_node_id (str): node id of the peer.
+        """
+        if peer_node_id not in self.connection_manager.peers_connection:
+            self.connection_manager.peers_connection.update({peer_node_id: self})
+            self.peer_node_id = peer_node_id
 
-            # give peer chance to add connection
-            self.send_hello_ack()
+            # start ping loop
+            if not self.lc_ping.running:
+                self.lc_ping.start(20, now=True)
 
-        elif msg_type == 'ACK':
-            msg = json.loads(string[3:])
-            # handle handshake acknowledgement
-            peer_node_id = msg['nodeid']
-            logger.debug('Handshake ACK from %s with peer_node_id = %s ', str(self.transport.getPeer()), peer_node_id)
+    def receive_ping(self, string):
+        """Answer a ping message with a pong message.
 
-            if peer_node_id not in self.connection_manager.peers_connection:
-                self.connection_manager.peers_connection.update({peer_node_id: self})
-                self.peer_node_id = peer_node_id
+        Args:
+            string (bytes): PIN message.
+        """
+        obj = PingMessage.unserialize(string)
+        pong = PongMessage(obj.time)
+        data = pong.serialize()
+        self.sendString(data)
 
-                # start ping loop
-                if not self.lc_ping.running:
-                    self.lc_ping.start(20, now=True)
+    def receive_compressed(self, string):
+        """Decompress a compressed message and handle the original message.
 
-        elif msg_type == 'PIN':
-            obj = PingMessage.unserialize(string)
-            pong = PongMessage(obj.time)
-            data = pong.serialize()
-            self.sendString(data)
+        Args:
+            string (bytes): ZLB message.
+        """
+        data = decompress_frame(string, self.connection_manager.max_transfer_size)
+        if data is None:
+            logger.debug('Invalid compressed message from %s', self.peer_node_id)
+            return
+        self.stringReceived(data)
 
-        else:
-            self.connection_manager.message_callback(msg_type, string, self)
+    def receive_fragment(self, string):
+        """Add a fragment to the message it belongs to. Once all fragments are received, the message is handled.
+
+        Args:
+            string (bytes): FRG message.
+        """
+        transfer_id, size = FRAGMENT_HEADER.unpack_from(string, 3)
+        fragments = self.incoming_transfers.get(transfer_id)
+        if fragments is None:
+            if self.incoming_size + size > self.connection_manager.max_transfer_size:
+                logger.debug('Fragmented messages from %s exceed max size', self.peer_node_id)
+                self.transport.loseConnection()
+                return
+            fragments = bytearray()
+            self.incoming_transfers[transfer_id] = fragments
+            self.incoming_size += size
+
+        fragments += memoryview(string)[3 + FRAGMENT_HEADER.size:]
+        if len(fragments) < size:
+            return
+
+        del self.incoming_transfers[transfer_id]
+        self.incoming_size -= size
+        if len(fragments) > size:
+            logger.debug('Invalid fragmented message from %s', self.peer_node_id)
+            self.transport.loseConnection()
+            return
+        self.stringReceived(bytes(fragments))
+
+    def negotiate_features(self, msg):
+        """Enable compression, fragmented messages and compact blocks on this connection if both nodes support them.
+
+        Args:
+            msg (dict): handshake message of the peer.
+        """
+        self.compression = self.connection_manager.compression and 'zlib' in msg.get('compression', [])
+        self.chunked = msg.get('chunked', False)
+        self.compact_blocks = self.connection_manager.compact_blocks and msg.get('compact_blocks', False)
+
+    def handshake(self):
+        """
+        Returns:
+            dict: content of the handshake messages (HEL and ACK) sent to the peer.
+        """
+        handshake = {'nodeid': self.node_id}
+        if self.connection_manager.compression:
+            handshake['compression'] = ['zlib']
+        handshake['chunked'] = True
+        if self.connection_manager.compact_blocks:
+            handshake['compact_blocks'] = True
+        return handshake
+
+    def send_message(self, data):
+        """Send a serialized message. If it is larger than the chunk size and the peer supports it, the message is sent
+        in fragments (FRG messages). They are sent while the transport is not paused, other messages can be sent in
+        between. Messages of ORDERED_TYPES (paxos messages and commit acknowledgements, which refer to blocks) are held
+        back until the fragmented messages queued before them are sent, s.t the peer receives a block before the
+        messages about it.
+
+        Args:
+            data (bytes): serialized message.
+        """
+        if not self.chunked or len(data) <= self.connection_manager.chunk_size:
+            if self.outgoing_transfers and data[:3] in ORDERED_TYPES:
+                self.ordered_messages.append([{transfer[0] for transfer in self.outgoing_transfers}, data])
+            else:
+                self.sendString(data)
+            return
+
+        self.transfer_id = (self.transfer_id + 1) & 0xffffffff
+        self.outgoing_transfers.append([self.transfer_id, data, 0])
+        self.send_fragments()
+
+    def send_fragments(self):
+        """Send fragments of the messages in `outgoing_transfers` (one fragment of each message in turn) until the
+        transport is paused."""
+        chunk_size = self.connection_manager.chunk_size
+        transfers = self.outgoing_transfers
+        while transfers and not self.paused:
+            transfer = transfers.popleft()
+            transfer_id, data, offset = transfer
+            end = offset + chunk_size
+            self.sendString(b''.join([b'FRG', FRAGMENT_HEADER.pack(transfer_id, len(data)),
+                                      memoryview(data)[offset:end]]))
+            if end < len(data):
+                transfer[2] = end
+                transfers.append(transfer)
+            elif self.ordered_messages:
+                self.release_ordered_messages(transfer_id)
+
+    def release_ordered_messages(self, transfer_id):
+        """Send the messages in `ordered_messages` that no longer wait for a transfer (in the order they were queued).
+
+        Args:
+            transfer_id (int): id of the transfer whose last fragment has been sent.
+        """
+        messages = self.ordered_messages
+        for message in messages:
+            message[0].discard(transfer_id)
+        while messages and not messages[0][0]:
+            self.sendString(messages.popleft()[1])
+
+    def pauseProducing(self):
+        """Called by the transport once its buffer is full."""
+        self.paused = True
+
+    def resumeProducing(self):
+        """Called by the transport once its buffer has been sent."""
+        self.paused = False
+        self.send_fragments()
+
+    def stopProducing(self):
+        """Called by the transport once the connection is closed."""
+        self.outgoing_transfers.clear()
+        self.ordered_messages.clear()
 
     def send_hello(self):
         """ Send hello/handshake message s.t other node gets to know this node.
         """
         # Serialize obj to a JSON formatted str
-        s = json.dumps({'nodeid': self.node_id})
+        s = json.dumps(self.handshake())
 
         # str.encode() returns encoded version of string as a bytes object (utf-8 encoding)
         self.sendString(b'HEL' + s.encode())
@@ -128,7 +419,7 @@ class Connection(IntNStringReceiver):
     def send_hello_ack(self):
         """ Send hello/handshake acknowledgement message s.t other node also has a chance to add connection.
         """
-        s = json.dumps({'nodeid': self.node_id})
+        s = json.dumps(self.handshake())
         self.sendString(b'ACK' + s.encode())
 
     def send_ping(self):
@@ -149,12 +440,25 @@ class ConnectionManager(Factory):
         peers_connection (dict): Maps from str to Connection. The key represents the node_id and the value the
             Connection to the node with this node_id.
         id (int): unique identifier of this factory which represents a node.
-        message_callback (Callable): signature (msg_type, data, sender: Connection). Received strings are delegated
-            to this callback if they are not handled inside Connection itself.
+        message_callback (Callable): signature (msg_type: bytes, data, sender: Connection). Received strings are
+            delegated to this callback if they are not handled inside Connection itself.
+        message_types (dict): Maps from the type (bytes) of a message to a pair (decoder, handler) used by
+            `parse_msg` (see `register_message_type`).
         reconnect_loop (LoopingCall): keeps trying to connect to peers if connection to at least one is lost.
         peers (dict): stores for each node an ip address and port.
         reactor (IReactor): The Twisted reactor event loop waits on and demultiplexes events and dispatches them to
             waiting event handlers. Must be parametrized for testing purpose (default = global reactor).
+        compression (bool): True if this node supports compression (see COMPRESSION in config.py).
+        compression_level (int): zlib compression level (see COMPRESSION_LEVEL in config.py).
+        compression_threshold (int): min size of a compressed message (see COMPRESSION_THRESHOLD in config.py).
+        chunk_size (int): size of the fragments of large messages (see TRANSFER_CHUNK_SIZE in config.py).
+        max_transfer_size (int): max size of the fragmented messages assembled at once per connection (see
+            MAX_TRANSFER_SIZE in config.py).
+        compact_blocks (bool): True if this node supports compact blocks (see COMPACT_BLOCKS in config.py).
+        write_coalescing (bool): see WRITE_COALESCING in config.py.
+        write_buffer_size (int): see WRITE_BUFFER_SIZE in config.py.
+        coalescing (int): depth of the open `coalesce_writes` contexts, 0 if writes are not coalesced.
+        pending_connections (list): Connections with collected messages that are not yet written.
     """
     def __init__(self, index, peer_dict):
         self.peers_connection = {}
@@ -163,6 +467,40 @@ class ConnectionManager(Factory):
         self.reconnect_loop = None
         self.peers = peer_dict
         self.reactor = reactor
+        self.compression = COMPRESSION
+        self.compression_level = COMPRESSION_LEVEL
+        self.compression_threshold = COMPRESSION_THRESHOLD
+        self.chunk_size = TRANSFER_CHUNK_SIZE
+        self.max_transfer_size = MAX_TRANSFER_SIZE
+        self.compact_blocks = COMPACT_BLOCKS
+        self.write_coalescing = WRITE_COALESCING
+        self.write_buffer_size = WRITE_BUFFER_SIZE
+        self.coalescing = 0
+        self.pending_connections = []
+
+        # the handlers look up the receive methods on each call s.t they can be replaced on an instance
+        self.message_types = {}
+        self.register_message_type(b'RQB', RequestBlockMessage.unserialize,
+                                   lambda obj, sender: self.receive_request_blocks_message(obj, sender))
+        self.register_message_type(b'TXN', Transaction.unserialize,
+                                   lambda obj, sender: self.receive_transaction(obj))
+        self.register_message_type(b'TXB', TransactionBatchMessage.unserialize,
+                                   lambda obj, sender: self.receive_transactions(obj.txs))
+        self.register_message_type(b'BLK', Block.unserialize, lambda obj, sender: self.receive_block(obj))
+        self.register_message_type(b'RSB', RespondBlockMessage.unserialize,
+                                   lambda obj, sender: self.receive_respond_blocks_message(obj))
+        self.register_message_type(b'PAM', PaxosMessage.unserialize,
+                                   lambda obj, sender: self.receive_paxos_message(obj, sender))
+        self.register_message_type(b'PON', PongMessage.unserialize,
+                                   lambda obj, sender: self.receive_pong_message(obj, sender.peer_node_id))
+        self.register_message_type(b'ACM', AckCommitMessage.unserialize,
+                                   lambda obj, sender: self.receive_ack_commit_message(obj))
+        self.register_message_type(b'CBK', CompactBlockMessage.unserialize,
+                                   lambda obj, sender: self.receive_compact_block(obj, sender))
+        self.register_message_type(b'RQT', RequestTransactionsMessage.unserialize,
+                                   lambda obj, sender: self.receive_request_transactions_message(obj, sender))
+        self.register_message_type(b'RST', RespondTransactionsMessage.unserialize,
+                                   lambda obj, sender: self.receive_respond_transactions_message(obj))
 
     def buildProtocol(self, addr):
         return Connection(self)
@@ -204,7 +542,7 @@ class ConnectionManager(Factory):
 
     def broadcast(self, obj, msg_type):
         """
-        `obj` will be broadcast to all the peers.
+        `obj` will be broadcast to all the peers. A block is sent as compact block to the peers that support it.
 
         Args:
             obj: an instance of type Message, Block or Transaction.
@@ -212,16 +550,57 @@ class ConnectionManager(Factory):
         """
         logger.debug('broadcast: %s', msg_type)
 
-        # go over all connections in self.peers and call sendString on them
-        data = obj.serialize()
-        for k, v in self.peers_connection.items():
-            v.sendString(data)
+        connections = list(self.peers_connection.values())
+        if msg_type == 'BLK' and self.compact_blocks:
+            compact = [v for v in connections if v.compact_blocks]
+            if compact:
+                connections = [v for v in connections if not v.compact_blocks]
+                self.send_data(CompactBlockMessage(obj).serialize(), compact)
+        if connections:
+            self.send_data(obj.serialize(), connections)
 
         if msg_type == 'TXN':
             self.receive_transaction(obj)
+        elif msg_type == 'TXB':
+            self.receive_transactions(obj.txs)
 
-    @staticmethod
-    def respond(obj, sender):
+    @contextmanager
+    def coalesce_writes(self):
+        """Context manager which collects the messages sent to each connection and writes them to its transport at once
+        when the outermost context exits (or once WRITE_BUFFER_SIZE bytes are collected). Contexts can be nested.
+        """
+        if not self.write_coalescing:
+            yield
+            return
+        self.coalescing += 1
+        try:
+            yield
+        finally:
+            self.coalescing -= 1
+            if self.coalescing == 0:
+                pending_connections = self.pending_connections
+                self.pending_connections = []
+                for connection in pending_connections:
+                    connection.flush()
+
+    def send_data(self, data, connections):
+        """Send a serialized message to each of the `connections`, compressed if the connection supports it.
+
+        Args:
+            data (bytes): serialized message.
+            connections (list): Connections to send the message to.
+        """
+        compressed = None
+        for v in connections:
+            if v.compression:
+                # compressed once for all peers that support it
+                if compressed is None:
+                    compressed = self.compress(data)
+                v.send_message(compressed)
+            else:
+                v.send_message(data)
+
+    def respond(self, obj, sender):
         """
         `obj` will be responded to to the peer which has send the request.
 
@@ -231,33 +610,52 @@ class ConnectionManager(Factory):
         """
         logger.debug('respond')
         data = obj.serialize()
-        sender.sendString(data)
+        if sender.compression:
+            data = self.compress(data)
+        sender.send_message(data)
+
+    def compress(self, data):
+        """Compress `data` if it is a BLK or RSB message of at least `compression_threshold` bytes.
+
+        Args:
+            data (bytes): serialized message.
+
+        Returns:
+            bytes: the ZLB message or `data` itself if it is not compressed.
+        """
+        if data[:3] in COMPRESSED_TYPES and len(data) >= self.compression_threshold:
+            return compress_frame(data, self.compression_level)
+        return data
+
+    def register_message_type(self, msg_type, decoder, handler):
+        """Register a message type handled by `parse_msg`. Replaces the decoder and handler of a registered type.
+
+        Args:
+            msg_type (bytes): 3 byte prefix of the messages.
+            decoder (Callable): signature (msg: bytes) -> object. Decodes a message (including its prefix).
+            handler (Callable): signature (obj, sender: Connection). Called with each decoded message.
+        """
+        self.message_types[msg_type] = (decoder, handler)
 
     def parse_msg(self, msg_type, msg, sender):
+        """Decode `msg` and pass it to the handler registered for its type (see `register_message_type`).
 
-        if msg_type != 'PON':
-            logger.debug('parse_msg called with msg_type = %s', msg_type)
-        if msg_type == 'RQB':
-            obj = RequestBlockMessage.unserialize(msg)
-            self.receive_request_blocks_message(obj, sender)
-        elif msg_type == 'TXN':
-            obj = Transaction.unserialize(msg)
-            self.receive_transaction(obj)
-        elif msg_type == 'BLK':
-            obj = Block.unserialize(msg)
-            self.receive_block(obj)
-        elif msg_type == 'RSB':
-            obj = RespondBlockMessage.unserialize(msg)
-            self.receive_respond_blocks_message(obj)
-        elif msg_type == 'PAM':
-            obj = PaxosMessage.unserialize(msg)
-            self.receive_paxos_message(obj, sender)
-        elif msg_type == 'PON':
-            obj = PongMessage.unserialize(msg)
-            self.receive_pong_message(obj, sender.peer_node_id)
-        elif msg_type == 'ACM':
-            obj = AckCommitMessage.unserialize(msg)
-            self.receive_ack_commit_message(obj)
+        Args:
+            msg_type (bytes): 3 byte prefix of the message.
+            msg (bytes): the message.
+            sender (Connection): The connection the message was received on.
+        """
+        entry = self.message_types.get(msg_type)
+        if entry is None:
+            logger.debug('parse_msg: unknown msg_type = %s', msg_type)
+            return
+        decoder, handler = entry
+        try:
+            obj = decoder(msg)
+        except (ValueError, struct.error):
+            logger.debug('parse_msg: invalid message of type %s', msg_type)
+            return
+        handler(obj, sender)
 
     @staticmethod
     def handle_connection_error(failure, node_id):
@@ -270,12 +668,24 @@ class ConnectionManager(Factory):
     def receive_transaction(self, txn):
         raise NotImplementedError("To be implemented in subclass")
 
+    def receive_transactions(self, txs):
+        raise NotImplementedError("To be implemented in subclass")
+
     def receive_block(self, block):
         raise NotImplementedError("To be implemented in subclass")
 
     def receive_respond_blocks_message(self, resp):
         raise NotImplementedError("To be implemented in subclass")
 
+    def receive_compact_block(self, message, sender):
+        raise NotImplementedError("To be implemented in subclass")
+
+    def receive_request_transactions_message(self, req, sender):
+        raise NotImplementedError("To be implemented in subclass")
+
+    def receive_respond_transactions_message(self, resp):
+        raise NotImplementedError("To be implemented in subclass")
+
     def receive_paxos_message(self, message, sender):
         raise NotImplementedError("To be implemented in subclass")
 
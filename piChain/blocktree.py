@@ -4,15 +4,95 @@
 
 import json
 import os
+import time
+import logging
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
 
-import plyvel
+from twisted.internet import reactor, defer
+from twisted.internet.threads import deferToThreadPool
 
 from piChain.messages import Block
+from piChain.storage import open_storage, SegmentStore, StorageWriter
+from piChain.config import BLOCK_CACHE_SIZE, DURABILITY, STORAGE_BACKEND, STORAGE_DIR, SEGMENT_STORE, \
+    STORAGE_WRITER_THREAD, COMPACTION_THRESHOLD, COMPACTION_INTERVAL, COUNTER_LEASE_SIZE
+
+logger = logging.getLogger(__name__)
 
 # genesis block
 GENESIS = Block(-1, None, [], 0)
 GENESIS.depth = 0
 
+# On-disk layout:
+#   meta:<name>                 metadata entries (ids of special blocks, counter, paxos server variables, ...)
+#   header:<block_id>           header of a block (see Block.serialize_header)
+#   <block_id>                  complete block (unless the blocks are stored in segment files, see SegmentStore)
+#   committed_blocks:<seq>      append-only commit log: one entry per committed block keyed by its zero padded sequence
+#                               number s.t entries are iterated in commit order. The metadata entry
+#                               `committed_blocks_tip` holds the sequence number of the last entry.
+LAYOUT_VERSION = 1
+META_PREFIX = b'meta:'
+HEADER_PREFIX = b'header:'
+COMMIT_LOG_PREFIX = b'committed_blocks:'
+COMMIT_LOG_TIP = b'committed_blocks_tip'
+
+# durability policies (see config.DURABILITY)
+SYNC_ON_VOTE = 'sync_on_vote'
+SYNC_ON_COMMIT = 'sync_on_commit'
+ASYNC = 'async'
+
+# metadata keys used before the metadata was stored under META_PREFIX
+LEGACY_META_KEYS = [b'committed_block', b'head_block', b'counter', b'genesis', b's_max_block_depth', b's_prop_block',
+                    b's_supp_block', COMMIT_LOG_TIP]
+
+# average size of an encoded transaction, used to estimate the size of blocks loaded from disk (see `stored_size`)
+ESTIMATED_TXN_SIZE = 200
+
+
+class MissingBlockError(LookupError):
+    """Raised if the transactions of a block in the blocktree are requested but the block is not stored on disk."""
+
+
+class BlockHeader(Block):
+    """Representation of a block inside `Blocktree.nodes`. Only the header fields are kept in memory, the transactions
+    are loaded on demand through the body cache of the blocktree.
+
+    Args:
+        block (Block): Block whose header fields are copied.
+        blocktree (Blocktree): Blocktree the block belongs to.
+
+    Attributes:
+        stored_size (int): number of bytes the entries of the block use in the key-value store, None if unknown (block
+            loaded from disk).
+        header_size (int): number of bytes of the header entry (known for blocks loaded from disk as well).
+    """
+    def __init__(self, block, blocktree):
+        self.creator_id = block.creator_id
+        self.SEQ = block.SEQ
+        self.block_id = block.block_id
+        self.creator_state = block.creator_state
+        self.parent_block_id = block.parent_block_id
+        self.depth = block.depth
+        self.serialized = None
+        self.stored_size = None
+        self.header_size = 0
+        # weak reference: avoids a reference cycle which would keep the blocktree (and its open db) alive
+        self.blocktree = weakref.proxy(blocktree)
+
+    @property
+    def txs(self):
+        return self.blocktree.get_txs(self.block_id)
+
+    def serialize(self):
+        """
+        Returns (bytes): the block as stored on disk (avoids decoding and encoding the transactions).
+        """
+        block_bytes = self.blocktree.get_block_bytes(self.block_id)
+        if block_bytes is None:
+            return super().serialize()
+        return block_bytes
+
 
 class Blocktree:
     """Tree of blocks.
@@ -20,61 +100,429 @@ class Blocktree:
     Args:
           node_index (int): index of node owning this blocktree (to avoid concurrency problems with multiple local
             nodes).
+          cache_size (int): max number of blocks whose transactions are cached in memory.
+          durability (str): SYNC_ON_VOTE, SYNC_ON_COMMIT or ASYNC. Defines when writes are synced to disk.
+          storage_backend (str): key-value store used to persist the blocktree (see module storage).
+          storage_dir (str): directory containing the storages of the nodes.
+          segment_store (bool): if True the blocks are stored in segment files (see SegmentStore).
+          writer_thread (bool): if True the writes are applied by a dedicated thread (see StorageWriter).
 
     Attributes:
         genesis (Block): the genesis block (adjusted over time to safe memory).
         head_block (Block): deepest block in the blocktree (head of the blockchain).
         committed_block (Block): last committed block.
-        committed_blocks (list): ids of all committed blocks so far.
-        nodes (dict): dictionary from block_id to instance of type Block. Contains all blocks seen so far.
+        committed_blocks (list): ids of all committed blocks so far (in commit order).
+        committed_block_ids (set): same ids as `committed_blocks`, used for O(1) membership checks.
+        nodes (dict): dictionary from block_id to instance of type Block. Contains all blocks seen so far. Blocks
+            added through `add_block` are stored as BlockHeader.
+        cache (OrderedDict): LRU cache from block_id to the list of transactions of the block, or to the received Block
+            itself as long as its transactions have not been decoded (see `Block.unserialize`).
+        cache_size (int): see Args.
+        batch (dict): writes collected by the currently open write batch (see `write_batch`). Maps a key to its new
+            value or to None if the key is deleted. None if no write batch is open.
+        batch_depth (int): number of nested `write_batch` contexts currently open.
+        batch_waiting (list): Deferreds fired once the currently open write batch has been written (see `written`).
+        durability (str): see Args.
+        db (Storage): key-value store the blocktree is persisted to.
+        segments (SegmentStore): store containing the blocks if `segment_store` is True, else None.
+        writer (StorageWriter): thread applying the writes if `writer_thread` is True, else None.
+        segment_deletes (list): ids of blocks to be deleted from `segments` once the deletion of their headers has been
+            written (s.t a header never points to a missing block).
+        pending (dict): writes handed to `writer` which have not been written yet. Maps a key to (sequence number of
+            the write, value), value is None if the key is deleted.
+        write_seq (int): sequence number of the last write handed to `writer`.
+        deleted_bytes (int): size of the entries deleted on disk since the counter has been reset (see
+            `Compactor.add_deleted_bytes`).
         counter (int): gobal counter used for txn_id and block_id
+        counter_lease (int): highest counter value reserved on disk (see `next_counter`).
         ack_commits (dict): dict from block_id to int that counts how many times a block has been committed.
+        heights (dict): dict from block_id to the number of blocks between the block and the root of the tree. Only
+            contains indexed blocks (see `index_block`).
+        jumps (dict): dict from block_id to the list of jump pointers of the block (binary lifting), the k-th entry is
+            the id of the ancestor 2^k levels above the block.
+        connected (set): ids of the blocks known to be connected to the current genesis block.
+        orphans (dict): dict from the id of a missing block to the set of block ids that are connected to the genesis
+            block once the missing block is connected.
     """
-    def __init__(self, node_index):
+    def __init__(self, node_index, cache_size=BLOCK_CACHE_SIZE, durability=DURABILITY, storage_backend=STORAGE_BACKEND,
+                 storage_dir=STORAGE_DIR, segment_store=SEGMENT_STORE, writer_thread=STORAGE_WRITER_THREAD):
         self.genesis = GENESIS
         self.head_block = GENESIS
         self.committed_block = GENESIS
         self.committed_blocks = [GENESIS.block_id]
+        self.committed_block_ids = {GENESIS.block_id}
         self.nodes = {}
         self.nodes.update({GENESIS.block_id: GENESIS})
         self.counter = 0
+        self.counter_lease = 0
         self.ack_commits = {}
+        self.heights = {GENESIS.block_id: 0}
+        self.jumps = {GENESIS.block_id: []}
+        self.connected = {GENESIS.block_id}
+        self.orphans = {}
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.batch = None
+        self.batch_depth = 0
+        self.batch_waiting = []
+        self.durability = durability
+        self.deleted_bytes = 0
 
         # create a db instance (s.t blocks can be recovered after a crash)
-        base_path = os.path.expanduser('~/.pichain')
-        path = base_path + '/node_' + str(node_index)
-        if not os.path.exists(path):
-            os.makedirs(path)
-        self.db = plyvel.DB(path, create_if_missing=True)
-
-        # first load all the blocks
-        for key, value in self.db:
-                # block_id -> block
-                if key.decode().isdigit():
-                    block_id = int(key.decode())
-                    block = Block.unserialize(value)
-                    self.nodes.update({block_id: block})
-
-        # load all block ids and counter
-        for key, value in self.db:
-            if key == b'committed_block':
-                block = self.nodes.get(int(value.decode()))
-                self.committed_block = block
-            elif key == b'head_block':
-                block = self.nodes.get(int(value.decode()))
-                self.head_block = block
-            elif key == b'counter':
-                self.counter = int(value.decode())
-            elif key == b'genesis':
-                block = self.nodes.get(int(value.decode()))
-                self.genesis = block
-            elif key == b'committed_blocks':
-                block_ids = json.loads(value.decode())
-                self.committed_blocks = block_ids
+        path = os.path.expanduser(storage_dir) + '/node_' + str(node_index)
+        self.db = open_storage(storage_backend, path)
+        self.segments = None
+        if segment_store:
+            self.segments = SegmentStore(path + '_segments')
+        self.writer = None
+        self.pending = {}
+        self.write_seq = 0
+        self.segment_deletes = []
+
+        # metadata and block headers are stored under dedicated key prefixes s.t both can be loaded with a range scan
+        # each (the transactions of the blocks are loaded on demand)
+        meta = self.load_meta()
+        if meta.get(b'version') is None:
+            meta = self.migrate_layout()
+
+        for key, value in self.db.iterator(prefix=HEADER_PREFIX):
+            block = BlockHeader(Block.unserialize_header(value), self)
+            block.header_size = len(key) + len(value)
+            self.nodes.update({block.block_id: block})
+
+        if self.segments is not None:
+            # blocks whose header was never written or has been deleted (interrupted writes)
+            for block_id in self.segments:
+                if block_id not in self.nodes:
+                    self.segments.delete(block_id)
+
+        if meta.get(b'committed_block') is not None:
+            self.committed_block = self.nodes.get(meta.get(b'committed_block'))
+        if meta.get(b'head_block') is not None:
+            self.head_block = self.nodes.get(meta.get(b'head_block'))
+        if meta.get(b'genesis') is not None:
+            self.genesis = self.nodes.get(meta.get(b'genesis'))
+        if meta.get(b'counter') is not None:
+            # skip the values which may have been used before a crash
+            self.counter = meta.get(b'counter')
+            self.counter_lease = self.counter
+
+        self.reset_connected()
+        self.load_commit_log(meta.get(COMMIT_LOG_TIP))
+
+        # started after loading s.t the writer thread is the only one writing to the storage from now on
+        if writer_thread:
+            self.writer = StorageWriter(self.db)
+
+    @contextmanager
+    def write_batch(self):
+        """Context manager which collects all writes done through this blocktree and writes them to disk as a single
+        atomic batch once the outermost context exits. Contexts can be nested. If an exception is raised inside the
+        context, the collected writes are discarded s.t no partially applied step is persisted.
+        """
+        self.batch_depth += 1
+        if self.batch is None:
+            self.batch = {}
+        try:
+            yield
+        except BaseException:
+            self.batch_depth -= 1
+            if self.batch_depth == 0:
+                self.batch = None
+                self.batch_waiting = []
+                self.segment_deletes = []
+            raise
+        self.batch_depth -= 1
+        if self.batch_depth == 0:
+            d = self.flush()
+            self.batch = None
+            waiting, self.batch_waiting = self.batch_waiting, []
+            for w in waiting:
+                d.addCallback(self.fire_waiting, w)
+
+    @staticmethod
+    def fire_waiting(result, d):
+        d.callback(None)
+        return result
+
+    def written(self):
+        """
+        Returns:
+            Deferred: fires once all writes done so far (including the ones of the open write batch) have been written
+                to the storage.
+        """
+        if self.batch is not None:
+            d = defer.Deferred()
+            self.batch_waiting.append(d)
+            return d
+        if self.writer is not None and self.pending:
+            # queued behind the pending writes
+            return self.write([])
+        return defer.succeed(None)
+
+    def flush(self, sync=False):
+        """Write the writes collected by the currently open write batch to disk (as a single batch).
+
+        Args:
+            sync (bool): if True the write is synced to disk (fsync). This also makes all previous writes durable.
+
+        Returns:
+            Deferred: fires once the batch has been written (immediately unless the writes are applied by `writer`).
+        """
+        if not self.batch and not sync:
+            return defer.succeed(None)
+        ops = list((self.batch or {}).items())
+        if self.batch is not None:
+            self.batch = {}
+        return self.write(ops, sync)
+
+    def write(self, ops, sync=False):
+        """Write a batch to disk. The blocks appended to the segment files are written before the headers referring to
+        them.
+
+        Args:
+            ops (list): list of (key, value) tuples, value is None if the key is deleted.
+            sync (bool): see `flush`.
+
+        Returns:
+            Deferred: see `flush`.
+        """
+        segment_deletes, self.segment_deletes = self.segment_deletes, []
+        if self.writer is None:
+            if self.segments is not None:
+                if sync:
+                    self.segments.sync()
+                else:
+                    self.segments.flush()
+            with self.db.write_batch(sync=sync) as wb:
+                for key, value in ops:
+                    if value is None:
+                        wb.delete(key)
+                    else:
+                        wb.put(key, value)
+            self.delete_segment_blocks(None, segment_deletes)
+            return defer.succeed(None)
+
+        fds = []
+        if self.segments is not None:
+            if sync:
+                # synced by the writer thread (the active segment may be sealed in the meantime)
+                fds = self.segments.sync_fds()
+            else:
+                self.segments.flush()
+        self.write_seq += 1
+        for key, value in ops:
+            self.pending[key] = (self.write_seq, value)
+        d = self.writer.submit(ops, sync, fds)
+        d.addCallback(self.write_done, self.write_seq, ops)
+        d.addCallback(self.delete_segment_blocks, segment_deletes)
+        return d
+
+    def write_done(self, result, seq, ops):
+        """Remove the written entries from `pending` (unless they have been overwritten in the meantime)."""
+        for key, value in ops:
+            entry = self.pending.get(key)
+            if entry is not None and entry[0] == seq:
+                del self.pending[key]
+        return result
+
+    def delete_segment_blocks(self, result, block_ids):
+        """Delete blocks from `segments` once the deletion of their headers has been written."""
+        for block_id in block_ids:
+            self.segments.delete(block_id)
+        return result
+
+    def sync_vote(self):
+        """Called before a vote (TRY_OK or PROPOSE_ACK) is sent. Makes the promised paxos state durable if required by
+        the durability policy.
+
+        Returns:
+            Deferred: fires once the vote can be sent.
+        """
+        if self.durability == SYNC_ON_VOTE:
+            return self.flush(sync=True)
+        return defer.succeed(None)
+
+    def sync_commit(self):
+        """Called once a block has been committed. Makes the commit durable if required by the durability policy.
+
+        Returns:
+            Deferred: fires once the commit is durable (as required by the policy).
+        """
+        if self.durability in (SYNC_ON_VOTE, SYNC_ON_COMMIT):
+            return self.flush(sync=True)
+        return defer.succeed(None)
+
+    def put(self, key, value):
+        """Write `value` under `key` to disk (as part of the current write batch if one is open).
+
+        Args:
+            key (bytes): key.
+            value (bytes): value.
+        """
+        if self.batch is not None:
+            self.batch[key] = value
+        elif self.writer is not None:
+            self.write([(key, value)])
+        else:
+            self.db.put(key, value)
+
+    def delete(self, key):
+        """Delete `key` on disk (as part of the current write batch if one is open).
+
+        Args:
+            key (bytes): key.
+        """
+        if self.batch is not None:
+            self.batch[key] = None
+        elif self.writer is not None:
+            self.write([(key, None)])
+        else:
+            self.db.delete(key)
+
+    def get(self, key):
+        """Read the value stored under `key`, takes the writes of the current write batch and the pending writes of the
+        writer thread into account.
+
+        Args:
+            key (bytes): key.
+
+        Returns:
+            bytes: the value or None if `key` does not exist.
+        """
+        if self.batch is not None and key in self.batch:
+            return self.batch.get(key)
+        entry = self.pending.get(key)
+        if entry is not None:
+            return entry[1]
+        return self.db.get(key)
+
+    def next_counter(self):
+        """Increment the counter and return it. The counter values are reserved on disk in leases of
+        COUNTER_LEASE_SIZE values, i.e only the upper bound of the current lease is written (once per lease) and a node
+        continues after it when restarted.
+
+        Returns:
+            int: the new counter value.
+        """
+        self.counter += 1
+        if self.counter > self.counter_lease:
+            self.counter_lease = self.counter + COUNTER_LEASE_SIZE - 1
+            # written separately from the open write batch and in the calling thread (not by `writer`): the lease must
+            # be on disk before its values are used
+            key = META_PREFIX + b'counter'
+            self.pending.pop(key, None)
+            with self.db.write_batch(sync=self.durability != ASYNC) as wb:
+                wb.put(key, str(self.counter_lease).encode())
+        return self.counter
+
+    def load_meta(self):
+        """
+        Returns:
+            dict: all metadata entries stored on disk. Maps the key (without prefix) to an int.
+        """
+        meta = {}
+        for key, value in self.db.iterator(prefix=META_PREFIX):
+            meta.update({key[len(META_PREFIX):]: int(value.decode())})
+        return meta
+
+    def get_meta(self, key):
+        """
+        Args:
+            key (bytes): key of a metadata entry (e.g b'head_block').
+
+        Returns:
+            int: value of the metadata entry or None if it does not exist.
+        """
+        value = self.get(META_PREFIX + key)
+        if value is None:
+            return None
+        return int(value.decode())
+
+    def put_meta(self, key, value):
+        """Write a metadata entry to disk.
+
+        Args:
+            key (bytes): key of the metadata entry (e.g b'head_block').
+            value (int): value of the entry (e.g a block id).
+        """
+        self.put(META_PREFIX + key, str(value).encode())
+
+    def delete_meta(self, key):
+        """Delete a metadata entry on disk.
+
+        Args:
+            key (bytes): key of the metadata entry.
+        """
+        self.delete(META_PREFIX + key)
+
+    def migrate_layout(self):
+        """Convert a database written by an older version (blocks and metadata stored in the same key space) to the
+        current layout. Does nothing but writing the layout version for a new database.
+
+        Returns:
+            dict: metadata entries after the migration (see `load_meta`).
+        """
+        legacy_committed_blocks = None
+        with self.db.write_batch() as wb:
+            for key, value in self.db:
+                if key.isdigit():
+                    wb.put(HEADER_PREFIX + key, Block.unserialize(value).serialize_header())
+                elif key in LEGACY_META_KEYS:
+                    wb.put(META_PREFIX + key, value)
+                    wb.delete(key)
+                elif key == b'committed_blocks':
+                    legacy_committed_blocks = json.loads(value.decode())
+                    wb.delete(key)
+
+            if legacy_committed_blocks is not None and len(legacy_committed_blocks) > 1:
+                for seq, block_id in enumerate(legacy_committed_blocks):
+                    if seq > 0:
+                        wb.put(COMMIT_LOG_PREFIX + b'%016d' % seq, str(block_id).encode())
+                wb.put(META_PREFIX + COMMIT_LOG_TIP, str(len(legacy_committed_blocks) - 1).encode())
+
+            wb.put(META_PREFIX + b'version', str(LAYOUT_VERSION).encode())
+
+        return self.load_meta()
+
+    def load_commit_log(self, tip):
+        """Load the ids of the committed blocks from the append-only commit log on disk. Entries written after the tip
+        pointer stem from an interrupted commit and are ignored.
+
+        Args:
+            tip (int): sequence number of the last valid entry (None if nothing has been committed yet).
+        """
+        if tip is None:
+            return
+
+        for key, value in self.db.iterator(prefix=COMMIT_LOG_PREFIX):
+            if int(key[len(COMMIT_LOG_PREFIX):].decode()) > tip:
+                break
+            block_id = int(value.decode())
+            self.committed_blocks.append(block_id)
+            self.committed_block_ids.add(block_id)
+
+    def add_committed_block(self, block_id):
+        """Append `block_id` to the committed blocks and persist it as a new entry of the commit log. The cost is
+        independent of the number of blocks committed so far.
+
+        Args:
+            block_id (int): id of the committed block.
+        """
+        seq = len(self.committed_blocks)
+        self.committed_blocks.append(block_id)
+        self.committed_block_ids.add(block_id)
+
+        # write the entry first and then advance the tip pointer
+        self.put(COMMIT_LOG_PREFIX + b'%016d' % seq, str(block_id).encode())
+        self.put_meta(COMMIT_LOG_TIP, seq)
 
     def ancestor(self, block_a, block_b):
         """Check if `block_a` is ancestor of `block_b`. Both blocks must be included in `self.nodes`.
 
+        Note: Uses the jump pointer index (O(log n)) if the ancestry of both blocks is known, otherwise the path from
+        `block_b` to the genesis block is walked.
+
         Args:
             block_a (Block): First block.
             block_b (Block): Second block.
@@ -83,6 +531,15 @@ class Blocktree:
             bool: True if `block_a` is ancestor of `block_b`.
 
         """
+        if self.index_block(block_a) and self.index_block(block_b) and self.index_block(self.genesis):
+            height_a = self.heights.get(block_a.block_id)
+            if height_a >= self.heights.get(block_b.block_id):
+                return False
+            # the walk of the original definition stops at the genesis block
+            if height_a < self.heights.get(self.genesis.block_id):
+                return False
+            return self.level_ancestor(block_b.block_id, height_a) == block_a.block_id
+
         b = block_b
         while b != self.genesis:
             if block_a.block_id == b.parent_block_id:
@@ -93,6 +550,8 @@ class Blocktree:
     def common_ancestor(self, block_a, block_b):
         """Return common ancestor of `block_a` and `block_b`.
 
+        Note: Uses the jump pointer index (O(log n)) if the ancestry of both blocks is known.
+
         Args:
             block_a (Block): First block.
             block_b (Block): Second block.
@@ -100,6 +559,33 @@ class Blocktree:
         Returns:
             Block: common ancestor of `block_a` and `block_b`.
         """
+        if self.index_block(block_a) and self.index_block(block_b):
+            a = block_a.block_id
+            b = block_b.block_id
+
+            # bring both blocks to the same height
+            height = min(self.heights.get(a), self.heights.get(b))
+            a = self.level_ancestor(a, height)
+            b = self.level_ancestor(b, height)
+
+            if a == b:
+                return self.nodes.get(a)
+
+            # climb as long as the ancestors differ s.t a and b end up as children of the common ancestor
+            jumps_a = self.jumps.get(a)
+            jumps_b = self.jumps.get(b)
+            k = min(len(jumps_a), len(jumps_b)) - 1
+            while k >= 0 and jumps_a is not None and jumps_b is not None:
+                if k < len(jumps_a) and k < len(jumps_b) and jumps_a[k] != jumps_b[k]:
+                    a = jumps_a[k]
+                    b = jumps_b[k]
+                    jumps_a = self.jumps.get(a)
+                    jumps_b = self.jumps.get(b)
+                k -= 1
+
+            if jumps_a and jumps_b and jumps_a[0] == jumps_b[0]:
+                return self.nodes.get(jumps_a[0])
+
         while (block_a != self.genesis or block_b != self.genesis) and block_a != block_b:
             if block_a.depth > block_b.depth:
                 block_a = self.nodes.get(block_a.parent_block_id)
@@ -107,6 +593,185 @@ class Blocktree:
                 block_b = self.nodes.get(block_b.parent_block_id)
         return block_a
 
+    def index_block(self, block):
+        """Make sure `block` is contained in the jump pointer index. The ancestors of `block` that are not yet indexed
+        are indexed first. Every block is indexed only once, thus the amortized cost is O(log n).
+
+        Args:
+            block (Block): Block to be indexed.
+
+        Returns:
+            bool: True if `block` is indexed, False if an ancestor of it is missing.
+        """
+        if block.block_id in self.heights:
+            return True
+
+        # go up until an indexed block (or a root of the index) is reached
+        path = []
+        b = block
+        while b.block_id not in self.heights:
+            path.append(b)
+            if b.parent_block_id is None or (b == self.genesis and b.parent_block_id not in self.heights):
+                # b is the root of the tree
+                self.heights.update({b.block_id: 0})
+                self.jumps.update({b.block_id: []})
+                path.pop()
+                break
+            b = self.nodes.get(b.parent_block_id)
+            if b is None:
+                return False
+
+        for b in reversed(path):
+            self.build_jumps(b)
+        return True
+
+    def build_jumps(self, block):
+        """Add `block` to the jump pointer index. Its parent must already be indexed. The k-th jump pointer of a block
+        points to its ancestor 2^k levels above it. Pointers reaching below the genesis block are not stored.
+
+        Args:
+            block (Block): Block to be indexed.
+        """
+        parent_id = block.parent_block_id
+        jumps = [parent_id]
+        k = 0
+        while True:
+            ancestor_jumps = self.jumps.get(jumps[k])
+            if ancestor_jumps is None or len(ancestor_jumps) <= k:
+                break
+            jumps.append(ancestor_jumps[k])
+            k += 1
+
+        self.heights.update({block.block_id: self.heights.get(parent_id) + 1})
+        self.jumps.update({block.block_id: jumps})
+
+    def level_ancestor(self, block_id, height):
+        """Return the id of the ancestor of the block with id `block_id` at the given `height` in O(log n). The block
+        must be indexed.
+
+        Args:
+            block_id (int): id of an indexed block.
+            height (int): height of the requested ancestor (must not be larger than the height of the block).
+
+        Returns:
+            int: block id of the ancestor.
+        """
+        while self.heights.get(block_id) > height:
+            jumps = self.jumps.get(block_id)
+            k = min((self.heights.get(block_id) - height).bit_length(), len(jumps)) - 1
+            block_id = jumps[k]
+        return block_id
+
+    def remove_block(self, block_id):
+        """Remove a block from `self.nodes` and from the jump pointer index.
+
+        Args:
+            block_id (int): id of block to be removed.
+
+        Returns:
+            Block: the removed block or None if it was not contained.
+        """
+        self.heights.pop(block_id, None)
+        self.jumps.pop(block_id, None)
+        self.cache.pop(block_id, None)
+        return self.nodes.pop(block_id, None)
+
+    def delete_block(self, block_id):
+        """Delete a block on disk and inside the blocktree.
+
+        Args:
+            block_id (int): id of block to be deleted.
+
+        Returns:
+            Block: the removed block or None if it was not contained in `self.nodes`.
+        """
+        block_id_bytes = str(block_id).encode()
+        keys = [HEADER_PREFIX + block_id_bytes]
+        if self.segments is not None and block_id in self.segments:
+            self.segment_deletes.append(block_id)
+        else:
+            keys.append(block_id_bytes)
+        with self.write_batch():
+            for key in keys:
+                self.delete(key)
+        block = self.nodes.get(block_id)
+        if block is not None:
+            self.deleted_bytes += self.stored_size(block, len(keys) > 1)
+        return self.remove_block(block_id)
+
+    def stored_size(self, block, body_in_db):
+        """Return the number of bytes `block` uses in the key-value store without reading it (the size is recorded when
+        the block is written, it is estimated from its number of transactions for blocks loaded from disk).
+
+        Args:
+            block (Block): Block contained in `self.nodes`.
+            body_in_db (bool): True if the complete block is stored in the key-value store (not in `segments`).
+
+        Returns:
+            int: number of bytes.
+        """
+        size = getattr(block, 'stored_size', None)
+        if size is not None:
+            return size
+        size = getattr(block, 'header_size', 0)
+        parent = self.nodes.get(block.parent_block_id)
+        if body_in_db and parent is not None and block.depth is not None and parent.depth is not None:
+            size += (block.depth - parent.depth) * ESTIMATED_TXN_SIZE
+        return size
+
+    def get_txs(self, block_id):
+        """Return the transactions of the block with id `block_id`. They are loaded from disk if they are not cached.
+
+        Args:
+            block_id (int): id of a block added through `add_block`.
+
+        Returns:
+            list: Transactions of the block.
+
+        Raises:
+            MissingBlockError: if the block is not stored on disk (e.g it has been deleted).
+        """
+        txs = self.cache.get(block_id)
+        if txs is not None:
+            self.cache.move_to_end(block_id)
+            if isinstance(txs, Block):
+                # decoded on first access, only the transactions are kept
+                txs = txs.txs
+                self.cache[block_id] = txs
+            return txs
+
+        block_bytes = self.get_block_bytes(block_id)
+        if block_bytes is None:
+            logger.error('block %s is not stored on disk', block_id)
+            raise MissingBlockError(block_id)
+        txs = Block.unserialize(block_bytes).txs
+        self.cache_txs(block_id, txs)
+        return txs
+
+    def get_block_bytes(self, block_id):
+        """
+        Args:
+            block_id (int): id of a block added through `add_block`.
+
+        Returns:
+            bytes: the serialized block as stored on disk or None if it is not stored.
+        """
+        if self.segments is not None and block_id in self.segments:
+            return self.segments.get(block_id)
+        return self.get(str(block_id).encode())
+
+    def cache_txs(self, block_id, txs):
+        """Add the transactions of a block to the LRU cache and evict the least recently used entries if necessary.
+
+        Args:
+            block_id (int): id of the block.
+            txs: Transactions of the block (list) or the Block whose transactions are not yet decoded.
+        """
+        self.cache[block_id] = txs
+        self.cache.move_to_end(block_id)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
     def valid_block(self, block):
         """Reject the `block` argument if it is on a discarded fork (i.e `self.commited_block` is not ancestor of it) or
         if it is not deeper than the `head_block`.
@@ -129,7 +794,7 @@ class Blocktree:
         return True
 
     def add_block(self, block):
-        """Add `block` to `self.nodes`.
+        """Add `block` to `self.nodes` (as BlockHeader) and write it to disk.
 
         Note: Every node has a depth once created, but to facilitate testing depth of a block is computed based on its
         parent if available.
@@ -143,10 +808,178 @@ class Blocktree:
             block.depth = parent.depth + len(block.txs)
 
         if self.nodes.get(block.block_id) is None:
-            self.nodes.update({block.block_id: block})
+            header = BlockHeader(block, self)
+            self.nodes.update({block.block_id: header})
+            if getattr(block, 'encoded_txs', None) is not None:
+                # the transactions of a received block are decoded on first access (not at all if it is rejected)
+                self.cache_txs(block.block_id, block)
+            else:
+                self.cache_txs(block.block_id, block.txs)
+
+            # extend the jump pointer index incrementally (blocks with missing ancestors are indexed lazily)
+            if block.parent_block_id in self.heights:
+                self.build_jumps(block)
+
+            if block.parent_block_id in self.connected:
+                self.mark_connected(block.block_id)
 
             # write block to disk
             block_id_str = str(block.block_id)
             block_id_bytes = block_id_str.encode()
             block_bytes = block.serialize()
-            self.db.put(block_id_bytes, block_bytes)
+            header_key = HEADER_PREFIX + block_id_bytes
+            header_bytes = block.serialize_header()
+            header.header_size = len(header_key) + len(header_bytes)
+            header.stored_size = header.header_size
+            if self.segments is not None:
+                self.segments.put(block.block_id, block_bytes)
+                if self.batch is None and self.writer is None:
+                    self.segments.flush()
+            else:
+                self.put(block_id_bytes, block_bytes)
+                header.stored_size += len(block_id_bytes) + len(block_bytes)
+            self.put(header_key, header_bytes)
+
+    def connect_to_genesis(self, block):
+        """Check if there is a path from `block` to the genesis block. The blocks on the path are remembered as connected
+        s.t each block is walked only once (amortized O(1)).
+
+        Args:
+            block (Block): Block contained in `self.nodes`.
+
+        Returns:
+            Block: None if `block` is connected to the genesis block, else the block on the path whose parent is missing.
+        """
+        path = []
+        b = block
+        while b.block_id not in self.connected:
+            path.append(b.block_id)
+            parent = self.nodes.get(b.parent_block_id)
+            if parent is None:
+                # the path is connected as soon as the missing block is
+                self.orphans.setdefault(b.parent_block_id, set()).update(path)
+                return b
+            b = parent
+
+        self.connected.update(path)
+        return None
+
+    def mark_connected(self, block_id):
+        """Mark the block with id `block_id` as connected to the genesis block together with all blocks that were
+        waiting for it.
+
+        Args:
+            block_id (int): id of a block whose parent is connected to the genesis block.
+        """
+        to_mark = [block_id]
+        while to_mark:
+            block_id = to_mark.pop()
+            self.connected.add(block_id)
+            to_mark.extend(self.orphans.pop(block_id, ()))
+
+    def reset_connected(self):
+        """Forget which blocks are connected to the genesis block. Must be called once the genesis block changed."""
+        self.connected = {self.genesis.block_id}
+        self.orphans = {}
+
+
+class Compactor:
+    """Reclaims the space of deleted entries of the storage of a blocktree in a background thread s.t the reactor is
+    not blocked. A compaction starts once at least `threshold` bytes have been deleted since the last one and at most
+    once per `interval` seconds.
+
+    Args:
+        blocktree (Blocktree): blocktree whose storage (`blocktree.db`) is compacted.
+        threshold (int): number of deleted bytes which triggers a compaction.
+        interval (float): min time in seconds between the start of two compactions.
+
+    Attributes:
+        blocktree (Blocktree): see Args.
+        threshold (int): see Args.
+        interval (float): see Args.
+        reactor (IReactor): reactor used to schedule the compactions and to run them in its thread pool.
+        deleted_bytes (int): number of bytes deleted since the last compaction has been started.
+        running (bool): True while a compaction is running.
+        last_start (float): time (see `reactor.seconds`) the last compaction has been started (None if never).
+        delayed_call (IDelayedCall): compaction scheduled because of the rate limit (None if not scheduled).
+        duration (float): duration of the last compaction in seconds.
+        reclaimed_bytes (int): number of bytes reclaimed on disk by the last compaction.
+    """
+    def __init__(self, blocktree, threshold=COMPACTION_THRESHOLD, interval=COMPACTION_INTERVAL):
+        self.blocktree = blocktree
+        self.threshold = threshold
+        self.interval = interval
+        self.reactor = reactor
+        self.deleted_bytes = 0
+        self.running = False
+        self.last_start = None
+        self.delayed_call = None
+        self.duration = None
+        self.reclaimed_bytes = None
+
+    def add_deleted_bytes(self, deleted_bytes):
+        """Account for entries deleted on disk and start or schedule a compaction if the threshold is reached.
+
+        Args:
+            deleted_bytes (int): size of the deleted entries.
+        """
+        self.deleted_bytes += deleted_bytes
+        self.schedule()
+
+    def schedule(self):
+        """Start a compaction if the threshold is reached, delay it if the last one was started less than `interval`
+        seconds ago."""
+        if self.running or self.delayed_call is not None or self.deleted_bytes < self.threshold:
+            return
+
+        delay = 0
+        if self.last_start is not None:
+            delay = self.last_start + self.interval - self.reactor.seconds()
+        if delay > 0:
+            self.delayed_call = self.reactor.callLater(delay, self.start)
+        else:
+            self.start()
+
+    def start(self):
+        """Start a compaction in the thread pool of the reactor.
+
+        Returns:
+            Deferred: fires once the compaction is done.
+        """
+        self.delayed_call = None
+        self.running = True
+        self.deleted_bytes = 0
+        self.last_start = self.reactor.seconds()
+        d = deferToThreadPool(self.reactor, self.reactor.getThreadPool(), self.compact)
+        d.addCallbacks(self.compaction_done, self.compaction_failed)
+        return d
+
+    def compact(self):
+        """Compact the storage. Runs in a worker thread.
+
+        Returns:
+            tuple: duration in seconds and number of bytes reclaimed.
+        """
+        db = self.blocktree.db
+        size = db.size()
+        start = time.perf_counter()
+        db.compact_range()
+        duration = time.perf_counter() - start
+        return duration, size - db.size()
+
+    def compaction_done(self, result):
+        self.running = False
+        self.duration, self.reclaimed_bytes = result
+        logger.info('compaction took %.3f s and reclaimed %s bytes', self.duration, self.reclaimed_bytes)
+        # data deleted in the meantime
+        self.schedule()
+
+    def compaction_failed(self, failure):
+        self.running = False
+        logger.error('compaction failed: %s', failure.getErrorMessage())
+
+    def stop(self):
+        """Cancel a scheduled compaction."""
+        if self.delayed_call is not None and self.delayed_call.active():
+            self.delayed_call.cancel()
+        self.delayed_call = None
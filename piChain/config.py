@@ -42,6 +42,196 @@ dependencies: depends on number of transactions send per second and how long cra
 default = 5
 """
 
+BLOCK_CACHE_SIZE = 50
+"""int: Max number of blocks whose transactions are kept in memory. The transactions of other blocks are loaded from disk
+on demand.
+
+dependencies: depends on block size and on the number of blocks between the genesis block and the head block.
+default = 50 blocks (up to 75 MB with MAX_TXN_COUNT transactions of size = 200 bytes)
+"""
+
+TXN_WINDOW_SIZE = 65536
+"""int: Number of the most recent transaction sequence numbers per creator that are tracked individually to detect
+duplicate transactions. Transactions of a creator that are older than the window count as already seen.
+
+dependencies: must cover the number of transactions a node creates while one of its transactions is in flight.
+default = 65536 (uses 8 KB per creator)
+"""
+
+TXN_BATCH_TIME = 0.005
+"""float: Time transactions created by `make_txn` are collected before they are broadcast together in a single
+message. Set it to 0 to broadcast each transaction on its own.
+
+dependencies: should be small compared to ACCUMULATION_TIME.
+default = 0.005 seconds
+"""
+
+TXN_BATCH_SIZE = 1000
+"""int: Max number of transactions broadcast in a single message. A batch is broadcast as soon as it is full.
+
+dependencies: depends on transaction size, a batch must not exceed the max message size (10 MB).
+default = 1000 transactions
+"""
+
+TXN_FORWARDING = False
+"""bool: If True transactions are sent only to the node believed to be QUICK (the creator of the latest block received
+from a quick node) instead of being broadcast to all nodes. The other nodes get them through the blocks (see
+COMPACT_BLOCKS). Transactions not included in a block within TXN_FORWARD_TIMEOUT are broadcast to all nodes.
+
+Note: reduces the messages per transaction from O(n) to O(1), use it for larger clusters.
+default = False
+"""
+
+TXN_FORWARD_TIMEOUT = 1
+"""float: Time after which forwarded transactions that are not yet included in a block are broadcast to all nodes.
+
+dependencies: must be larger than ACCUMULATION_TIME plus the expected round trip time.
+default = 1 second
+"""
+
+COUNTER_LEASE_SIZE = 10000
+"""int: Number of counter values (used for txn and block ids) reserved on disk at once. A restarted node skips the
+unused values of its last lease.
+
+default = 10000
+"""
+
+#
+# Networking
+#
+
+
+COMPRESSION = True
+"""bool: If True BLK and RSB messages are compressed with zlib on connections to peers that support it as well. Whether
+both sides support it is negotiated in the handshake (HEL/ACK).
+
+Note: compression trades CPU time of the sender for bandwidth, set it to False if the nodes are connected by a LAN.
+default = True
+"""
+
+COMPRESSION_LEVEL = 1
+"""int: zlib compression level (1 = fastest, 9 = smallest).
+
+default = 1 (typical transactions compress well even at the lowest level)
+"""
+
+COMPRESSION_THRESHOLD = 1024
+"""int: Min size of a message in bytes to be compressed. Smaller messages are sent uncompressed.
+
+default = 1024 bytes
+"""
+
+WRITE_COALESCING = True
+"""bool: If True the messages a node sends while handling an event (received data, timer) are collected per connection
+and written to the transport at once when the handling is done.
+
+default = True
+"""
+
+WRITE_BUFFER_SIZE = 64 * 1024
+"""int: Size in bytes after which the collected messages of a connection are written without waiting for the end of the
+event (see WRITE_COALESCING).
+
+default = 64 KB
+"""
+
+COMPACT_BLOCKS = True
+"""bool: If True blocks are broadcast to peers that support it (negotiated in the handshake) as compact blocks: the
+header and the ids of the transactions. The receivers take the transactions from their pool of pending transactions and
+request only the missing ones from the creator of the block. If they are not received (in time), the whole block is
+requested instead.
+
+default = True
+"""
+
+TRANSFER_CHUNK_SIZE = 1024 * 1024
+"""int: Messages larger than this are sent in fragments of this size to peers that support it (negotiated in the
+handshake). Fragments are only sent while the TCP send buffer is not full, other messages are sent in between.
+
+Note: paxos messages and commit acknowledgements are sent only after the fragmented messages queued before them on the
+same connection, s.t a block arrives before the messages referring to it. Other messages may overtake a fragmented one.
+default = 1 MB (typical blocks are sent in a single message)
+"""
+
+MAX_TRANSFER_SIZE = 100 * 1024 * 1024
+"""int: Max total size of the fragmented messages a node assembles at once per connection. A peer exceeding it is
+disconnected.
+
+dependencies: must be larger than the largest RSB message (RECOVERY_BLOCKS_COUNT + 1 blocks).
+default = 100 MB
+"""
+
+#
+# Storage
+#
+
+
+STORAGE_BACKEND = 'leveldb'
+"""str: Key-value store the blocktree is persisted to.
+
+'leveldb': LevelDB (requires plyvel).
+'sqlite': SQLite, needs no native dependency.
+'memory': nothing is written to disk, a crashed node loses all its data. Use it for tests and load tests only.
+default = 'leveldb'
+"""
+
+STORAGE_DIR = '~/.pichain'
+"""str: Directory containing the storage of each node (in subdirectory node_<index>).
+
+default = '~/.pichain'
+"""
+
+SEGMENT_STORE = False
+"""bool: If True the blocks are appended to segment files (see `storage.SegmentStore`) instead of being stored in the
+key-value store. Reads are served from memory mapped files and pruned blocks are deleted a whole file at a time.
+
+default = False
+"""
+
+SEGMENT_SIZE = 64 * 1024 * 1024
+"""int: Size after which a new segment file is started if SEGMENT_STORE is True.
+
+dependencies: the smaller the segments, the sooner the disk space of pruned blocks is released.
+default = 64 MB
+"""
+
+STORAGE_WRITER_THREAD = False
+"""bool: If True the writes are applied to the storage by a dedicated thread instead of the reactor thread. Votes
+(TRY_OK, PROPOSE_ACK) are sent once the writes they depend on are durable (see DURABILITY), other writes complete in
+the background.
+
+default = False
+"""
+
+DURABILITY = 'sync_on_vote'
+"""str: Defines when the writes of the blocktree are synced to disk (fsync).
+
+'sync_on_vote': before a TRY_OK or PROPOSE_ACK message is sent and once a block is committed. Safe: a node never
+    forgets a promise it made.
+'sync_on_commit': only once a block is committed. A crashing node may forget a promise and thus break safety.
+'async': never, writes are synced periodically (see ASYNC_FLUSH_INTERVAL). Fastest, use it if the data is expendable.
+default = 'sync_on_vote'
+"""
+
+ASYNC_FLUSH_INTERVAL = 1
+"""float: Interval in which the writes are synced to disk if DURABILITY is set to 'async'.
+
+default = 1 second
+"""
+
+COMPACTION_THRESHOLD = 16 * 1024 * 1024
+"""int: Number of bytes deleted on disk (blocks pruned by genesis block changes) after which the storage is compacted in
+a background thread.
+
+default = 16 MB
+"""
+
+COMPACTION_INTERVAL = 60
+"""float: Min time between the start of two compactions (rate limit).
+
+default = 60 seconds
+"""
+
 #
 # Logging and Debug
 #
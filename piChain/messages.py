@@ -1,8 +1,174 @@
 """This module defines the representation of all objects that need to be sent over the network and thus need to be
 serialized and unserialized."""
 
+import io
+import struct
+
 import cbor
 
+# version byte of the flat block format (see `Block.serialize`), blocks in the previous format start with a CBOR array
+BLOCK_FORMAT_VERSION = 1
+# version, flags, creator_id, SEQ, parent_block_id, depth, creator_state, number of transactions
+BLOCK_HEADER = struct.Struct('<BBqqqqBI')
+# flags marking the header fields which are None
+PARENT_NONE = 1
+DEPTH_NONE = 2
+STATE_NONE = 4
+
+
+# version byte of the flat transaction batch format (see `TransactionBatchMessage.serialize`), batches containing other
+# content than strings are encoded as CBOR array
+TXN_BATCH_FORMAT_VERSION = 1
+# version, number of transactions
+TXN_BATCH_HEADER = struct.Struct('<BI')
+
+
+# version byte of the binary paxos message format (see `PaxosMessage.serialize`), messages in the previous format start
+# with a CBOR array
+PAXOS_FORMAT_VERSION = 1
+PAXOS_MSG_TYPES = ['TRY', 'TRY_OK', 'PROPOSE', 'PROPOSE_ACK', 'COMMIT']
+PAXOS_MSG_TYPE_CODES = {msg_type: code for code, msg_type in enumerate(PAXOS_MSG_TYPES)}
+# b'PAM', version, msg type, flags (bit i set if the i-th block id is None), request_seq, last_committed_block,
+# com_block, supp_block, prop_block, new_block
+PAXOS_MESSAGE = struct.Struct('<3sBBBqqqqqq')
+
+
+def load_payload(msg):
+    """Decode the CBOR payload following the 3 byte message type without copying the payload first (as `msg[3:]`
+    would). Used for messages containing few large byte strings, `cbor.loads` is faster for small or nested
+    payloads.
+
+    Args:
+        msg (bytes): message represented in bytes.
+
+    Returns:
+        the decoded payload.
+    """
+    f = io.BytesIO(msg)
+    f.seek(3)
+    return cbor.load(f)
+
+
+def encode_txs(txs):
+    """Encode transactions in the flat format: the columns of the transactions (txn ids, creator ids, content lengths)
+    followed by their concatenated contents.
+
+    Args:
+        txs (list): Transactions to encode.
+
+    Returns:
+        list: byte strings to be joined, None if the content of a transaction is not a string.
+    """
+    contents = []
+    for txn in txs:
+        if type(txn.content) is not str:
+            return None
+        contents.append(txn.content.encode())
+
+    n = len(txs)
+    columns = struct.pack('<%dq%di%dI' % (n, n, n), *[txn.txn_id for txn in txs],
+                          *[txn.creator_id for txn in txs], *[len(c) for c in contents])
+    return [columns] + contents
+
+
+def check_txs(msg, n, offset=3 + BLOCK_HEADER.size):
+    """Check that `n` transactions in the flat format (see `encode_txs`) exactly fill `msg` from `offset` on, without
+    decoding them.
+
+    Args:
+        msg (bytes): Block or TransactionBatchMessage represented in bytes.
+        n (int): number of transactions.
+        offset (int): position of the transactions in `msg` (default: after the header of a block).
+
+    Raises:
+        ValueError: if the columns do not fit into `msg` or the content lengths do not add up to the size of the
+            contents.
+    """
+    if offset + 16 * n > len(msg):
+        raise ValueError('message too short for %d transactions' % n)
+    lengths = struct.unpack_from('<%dI' % n, msg, offset + 12 * n)
+    if sum(lengths) != len(msg) - offset - 16 * n:
+        raise ValueError('transaction lengths do not match the size of the message')
+
+
+def decode_txs(msg, n, offset=3 + BLOCK_HEADER.size):
+    """Decode transactions in the flat format (see `encode_txs`).
+
+    Args:
+        msg (bytes): Block or TransactionBatchMessage represented in bytes.
+        n (int): number of transactions.
+        offset (int): position of the transactions in `msg` (default: after the header of a block).
+
+    Returns:
+        list: the Transactions.
+
+    Raises:
+        ValueError: if the columns do not fit into `msg` or the content lengths do not add up to the size of the
+            contents.
+    """
+    if offset + 16 * n > len(msg):
+        raise ValueError('message too short for %d transactions' % n)
+    columns = struct.unpack_from('<%dq%di%dI' % (n, n, n), msg, offset)
+    offset += 16 * n
+    txn_ids = columns[:n]
+    creator_ids = columns[n:2 * n]
+    lengths = columns[2 * n:]
+
+    # decoded directly from the buffer of the message
+    blob = memoryview(msg)[offset:]
+    if sum(lengths) != len(blob):
+        raise ValueError('transaction lengths do not match the size of the message')
+    text = str(blob, 'utf-8')
+    if len(text) != len(blob):
+        # not ASCII: character offsets differ from byte offsets
+        text = None
+
+    txs = []
+    start = 0
+    for txn_id, txn_creator_id, length in zip(txn_ids, creator_ids, lengths):
+        end = start + length
+        txn = Transaction.__new__(Transaction)
+        txn.creator_id = txn_creator_id
+        txn.SEQ = txn_id >> 16
+        txn.txn_id = txn_id
+        txn.content = text[start:end] if text is not None else str(blob[start:end], 'utf-8')
+        txs.append(txn)
+        start = end
+    return txs
+
+
+def encode_txn_list(txs):
+    """Encode a list of transactions: a header (version, number of transactions) followed by the transactions in the
+    flat format (see `encode_txs`). Falls back to a CBOR array of serialized transactions if a transaction content is
+    not a string.
+
+    Args:
+        txs (list): Transactions to encode.
+
+    Returns:
+        bytes: the encoded transactions.
+    """
+    encoded_txs = encode_txs(txs)
+    if encoded_txs is None:
+        return cbor.dumps([txn.serialize() for txn in txs])
+    return b''.join([TXN_BATCH_HEADER.pack(TXN_BATCH_FORMAT_VERSION, len(txs))] + encoded_txs)
+
+
+def decode_txn_list(msg, offset):
+    """Decode a list of transactions (see `encode_txn_list`).
+
+    Args:
+        msg (bytes): message containing the transactions.
+        offset (int): position of the transactions in `msg`.
+
+    Returns:
+        list: the Transactions.
+    """
+    if msg[offset] != TXN_BATCH_FORMAT_VERSION:
+        return [Transaction.unserialize(txn) for txn in cbor.loads(msg[offset:])]
+    _, n = TXN_BATCH_HEADER.unpack_from(msg, offset)
+    return decode_txs(msg, n, offset + TXN_BATCH_HEADER.size)
+
 
 class PaxosMessage:
     """ A paxos message used to commit a block.
@@ -30,7 +196,48 @@ class PaxosMessage:
         self.last_committed_block = None
 
     def serialize(self):
+        """Encode the message with a fixed layout: version, message type code, a flag per block id which is None, the
+        request sequence number and the five block ids (64 bit each).
+
+        Returns (bytes): bytes representing the object.
+        """
+        lcb, cb, sb, pb, nb = self.last_committed_block, self.com_block, self.supp_block, self.prop_block, self.new_block
+        flags = (lcb is None) | (cb is None) << 1 | (sb is None) << 2 | (pb is None) << 3 | (nb is None) << 4
+        return PAXOS_MESSAGE.pack(b'PAM', PAXOS_FORMAT_VERSION, PAXOS_MSG_TYPE_CODES[self.msg_type], flags,
+                                  self.request_seq, lcb or 0, cb or 0, sb or 0, pb or 0, nb or 0)
+
+    @staticmethod
+    def unserialize(msg):
+        """
+        Args:
+            msg (bytes): PaxosMessage represented in bytes (binary or CBOR format).
+
+        Returns:
+             PaxosMessage: original PaxosMessage instance.
         """
+        if msg[3] != PAXOS_FORMAT_VERSION:
+            return PaxosMessage.unserialize_cbor(msg)
+
+        _, _, code, flags, request_seq, lcb, cb, sb, pb, nb = PAXOS_MESSAGE.unpack(msg)
+        if flags:
+            if flags & 1:
+                lcb = None
+            if flags & 2:
+                cb = None
+            if flags & 4:
+                sb = None
+            if flags & 8:
+                pb = None
+            if flags & 16:
+                nb = None
+        obj = PaxosMessage.__new__(PaxosMessage)
+        obj.__dict__ = {'msg_type': PAXOS_MSG_TYPES[code], 'request_seq': request_seq, 'new_block': nb,
+                        'prop_block': pb, 'supp_block': sb, 'com_block': cb, 'last_committed_block': lcb}
+        return obj
+
+    def serialize_cbor(self):
+        """Encode the message in the CBOR format used before the binary format.
+
         Returns (bytes): bytes representing the object.
         """
         obj_list = [self.last_committed_block, self.com_block, self.supp_block, self.prop_block, self.new_block,
@@ -39,10 +246,10 @@ class PaxosMessage:
         return b'PAM' + obj_bytes
 
     @staticmethod
-    def unserialize(msg):
+    def unserialize_cbor(msg):
         """
         Args:
-            msg (bytes): PaxosMessage represented in bytes.
+            msg (bytes): PaxosMessage represented in bytes (see `serialize_cbor`).
 
         Returns:
              PaxosMessage: original PaxosMessage instance.
@@ -116,7 +323,7 @@ class RespondBlockMessage:
         Returns:
              RespondBlockMessage: original RespondBlockMessage instance.
         """
-        obj_list = cbor.loads(msg[3:])
+        obj_list = load_payload(msg)
         blocks = []
         for b in obj_list:
             blocks.append(Block.unserialize(b))
@@ -169,6 +376,12 @@ class Block:
         SEQ (int): sequence number used to create unique block id.
         creator_state (int): 0,1 or 2 translates to QUICK, MEDIUM or SLOW.
         depth (int): Total number of transactions the block and all ist ancestor blocks contain.
+        serialized (tuple): (depth, creator_state, bytes) the block has been encoded or received as, None if not
+            available. Reused by `serialize` as long as `depth` and `creator_state` (the only fields set after the
+            creation of a block) are unchanged.
+        decoded_txs (list): Transactions of the block (see `txs`), None if not yet decoded.
+        encoded_txs (tuple): (bytes, number of transactions) of a received block whose transactions are not yet
+            decoded, else None.
     """
     def __init__(self, creator_id, parent_block_id, txs, counter):
         self.creator_id = creator_id
@@ -178,6 +391,20 @@ class Block:
         self.parent_block_id = parent_block_id
         self.depth = None
         self.txs = txs
+        self.serialized = None
+
+    @property
+    def txs(self):
+        """list: Transactions of the block."""
+        if self.decoded_txs is None and self.encoded_txs is not None:
+            self.decoded_txs = decode_txs(*self.encoded_txs)
+            self.encoded_txs = None
+        return self.decoded_txs
+
+    @txs.setter
+    def txs(self, txs):
+        self.decoded_txs = txs
+        self.encoded_txs = None
 
     def __lt__(self, other):
         """Compare two blocks by depth` and `creator_id`."""
@@ -196,7 +423,103 @@ class Block:
         return hash(self.block_id)
 
     def serialize(self):
+        """Return the encoding of the block (see `encode`). It is computed once and then reused for the broadcast, the
+        storage and the recovery of other nodes. A received block is never encoded again.
+
+        Returns (bytes): bytes representing the object.
         """
+        serialized = self.serialized
+        if serialized is not None and serialized[0] == self.depth and serialized[1] == self.creator_state:
+            return serialized[2]
+        msg = self.encode()
+        self.serialized = (self.depth, self.creator_state, msg)
+        return msg
+
+    def encode(self):
+        """Encode the block in a single pass: a fixed size header followed by the columns of the transactions (txn ids,
+        creator ids, content lengths) and their concatenated contents. Falls back to the CBOR format (see
+        `serialize_cbor`) if a transaction content is not a string.
+
+        Returns (bytes): bytes representing the object.
+        """
+        txs = self.txs
+        encoded_txs = encode_txs(txs)
+        if encoded_txs is None:
+            return self.serialize_cbor()
+        return b''.join([b'BLK', self.pack_header(len(txs))] + encoded_txs)
+
+    def pack_header(self, n):
+        """
+        Args:
+            n (int): number of transactions of the block.
+
+        Returns (bytes): the fixed size header of the flat format (see `encode`).
+        """
+        flags = 0
+        parent_block_id = self.parent_block_id
+        if parent_block_id is None:
+            flags |= PARENT_NONE
+            parent_block_id = 0
+        depth = self.depth
+        if depth is None:
+            flags |= DEPTH_NONE
+            depth = 0
+        creator_state = self.creator_state
+        if creator_state is None:
+            flags |= STATE_NONE
+            creator_state = 0
+
+        return BLOCK_HEADER.pack(BLOCK_FORMAT_VERSION, flags, self.creator_id, self.SEQ, parent_block_id, depth,
+                                 creator_state, n)
+
+    @staticmethod
+    def unserialize(msg):
+        """
+        Args:
+            msg (bytes): Block represented in bytes (flat or CBOR format).
+
+        Returns:
+             Block: original Block instance. Only the header fields are decoded, the transactions are decoded on first
+                access of `txs`.
+
+        Raises:
+            ValueError: if the size of the transactions does not match the message (see `check_txs`).
+        """
+        if msg[3] != BLOCK_FORMAT_VERSION:
+            return Block.unserialize_cbor(msg)
+
+        obj, n = Block.unpack_header(msg)
+        # checked up front so that a truncated block is rejected on receipt rather than on first access of `txs`
+        check_txs(msg, n)
+        # the transactions are decoded on first access (not at all if the block is rejected)
+        obj.decoded_txs = None
+        obj.encoded_txs = (msg, n)
+        obj.serialized = (obj.depth, obj.creator_state, msg)
+        return obj
+
+    @staticmethod
+    def unpack_header(msg):
+        """
+        Args:
+            msg (bytes): message starting with a 3 byte type and the header of the flat format (see `pack_header`).
+
+        Returns:
+            tuple: (Block, number of transactions), the fields of the block except the transactions are set.
+        """
+        _, flags, creator_id, seq, parent_block_id, depth, creator_state, n = BLOCK_HEADER.unpack_from(msg, 3)
+
+        obj = Block.__new__(Block)
+        obj.creator_id = creator_id
+        obj.SEQ = seq
+        obj.block_id = creator_id | (seq << 16)
+        obj.creator_state = None if flags & STATE_NONE else creator_state
+        obj.parent_block_id = None if flags & PARENT_NONE else parent_block_id
+        obj.depth = None if flags & DEPTH_NONE else depth
+        return obj, n
+
+    def serialize_cbor(self):
+        """Encode the block in the CBOR format used before the flat format (each transaction encoded separately).
+
         Returns (bytes): bytes representing the object.
         """
         txs = []
@@ -207,10 +530,10 @@ class Block:
         return b'BLK' + obj_bytes
 
     @staticmethod
-    def unserialize(msg):
+    def unserialize_cbor(msg):
         """
         Args:
-            msg (bytes): Block represented in bytes.
+            msg (bytes): Block represented in bytes (see `serialize_cbor`).
 
         Returns:
              Block: original Block instance.
@@ -228,6 +551,37 @@ class Block:
         for txn in obj_list.pop():
             txs.append(Transaction.unserialize(txn))
         setattr(obj, 'txs', txs)
+        setattr(obj, 'serialized', (obj.depth, obj.creator_state, msg))
+        return obj
+
+    def serialize_header(self):
+        """
+        Returns (bytes): bytes representing the header of the block (all fields except the transactions).
+        """
+        obj_list = [self.depth, self.parent_block_id, self.creator_state, self.block_id, self.SEQ, self.creator_id]
+        obj_bytes = cbor.dumps(obj_list)
+        return b'BLH' + obj_bytes
+
+    @staticmethod
+    def unserialize_header(msg):
+        """
+        Args:
+            msg (bytes): Block header represented in bytes (see `serialize_header`).
+
+        Returns:
+             Block: Block instance with `txs` set to None.
+        """
+        obj_list = cbor.loads(msg[3:])
+
+        obj = Block.__new__(Block)
+        setattr(obj, 'creator_id', obj_list.pop())
+        setattr(obj, 'SEQ', obj_list.pop())
+        setattr(obj, 'block_id', obj_list.pop())
+        setattr(obj, 'creator_state', obj_list.pop())
+        setattr(obj, 'parent_block_id', obj_list.pop())
+        setattr(obj, 'depth', obj_list.pop())
+        setattr(obj, 'txs', None)
+        setattr(obj, 'serialized', None)
         return obj
 
 
@@ -282,6 +636,141 @@ class Transaction:
         return obj
 
 
+class TransactionBatchMessage:
+    """Carries many transactions in a single message.
+
+    Args:
+        txs (list): list of Transaction instances.
+    """
+    def __init__(self, txs):
+        self.txs = txs
+
+    def serialize(self):
+        """Encode the transactions in the flat format of blocks (see `encode_txn_list`).
+
+        Returns (bytes): bytes representing the object.
+        """
+        return b'TXB' + encode_txn_list(self.txs)
+
+    @staticmethod
+    def unserialize(msg):
+        """
+        Args:
+            msg (bytes): TransactionBatchMessage represented in bytes.
+
+        Returns:
+             TransactionBatchMessage: original TransactionBatchMessage instance.
+        """
+        obj = TransactionBatchMessage.__new__(TransactionBatchMessage)
+        obj.txs = decode_txn_list(msg, 3)
+        return obj
+
+
+class CompactBlockMessage:
+    """Announces a block by its header and the ids of its transactions, which the receivers usually already hold.
+
+    Args:
+        block (Block): the announced block.
+
+    Attributes:
+        block (Block): header of the announced block, `txs` is None on the receiving side.
+        txn_ids (list): ids of the transactions of the block in order.
+    """
+    def __init__(self, block):
+        self.block = block
+        self.txn_ids = [txn.txn_id for txn in block.txs]
+
+    def serialize(self):
+        """
+        Returns (bytes): bytes representing the object.
+        """
+        n = len(self.txn_ids)
+        return b''.join([b'CBK', self.block.pack_header(n), struct.pack('<%dq' % n, *self.txn_ids)])
+
+    @staticmethod
+    def unserialize(msg):
+        """
+        Args:
+            msg (bytes): CompactBlockMessage represented in bytes.
+
+        Returns:
+             CompactBlockMessage: original CompactBlockMessage instance.
+        """
+        block, n = Block.unpack_header(msg)
+        block.decoded_txs = None
+        block.encoded_txs = None
+        block.serialized = None
+        obj = CompactBlockMessage.__new__(CompactBlockMessage)
+        obj.block = block
+        obj.txn_ids = list(struct.unpack_from('<%dq' % n, msg, 3 + BLOCK_HEADER.size))
+        return obj
+
+
+class RequestTransactionsMessage:
+    """Is sent to the creator of a compact block if some of its transactions are missing.
+
+    Args:
+        block_id (int): block id of the compact block.
+        indices (list): positions of the missing transactions in the block.
+    """
+    def __init__(self, block_id, indices):
+        self.block_id = block_id
+        self.indices = indices
+
+    def serialize(self):
+        """
+        Returns (bytes): bytes representing the object.
+        """
+        return b'RQT' + cbor.dumps([self.indices, self.block_id])
+
+    @staticmethod
+    def unserialize(msg):
+        """
+        Args:
+            msg (bytes): RequestTransactionsMessage represented in bytes.
+
+        Returns:
+             RequestTransactionsMessage: original RequestTransactionsMessage instance.
+        """
+        obj_list = cbor.loads(msg[3:])
+        obj = RequestTransactionsMessage.__new__(RequestTransactionsMessage)
+        setattr(obj, 'block_id', obj_list.pop())
+        setattr(obj, 'indices', obj_list.pop())
+        return obj
+
+
+class RespondTransactionsMessage:
+    """Is sent as a response to a `RequestTransactionsMessage`.
+
+    Args:
+        block_id (int): block id of the compact block.
+        txs (list): the requested transactions in the order they were requested.
+    """
+    def __init__(self, block_id, txs):
+        self.block_id = block_id
+        self.txs = txs
+
+    def serialize(self):
+        """
+        Returns (bytes): bytes representing the object.
+        """
+        return b''.join([b'RST', struct.pack('<q', self.block_id), encode_txn_list(self.txs)])
+
+    @staticmethod
+    def unserialize(msg):
+        """
+        Args:
+            msg (bytes): RespondTransactionsMessage represented in bytes.
+
+        Returns:
+             RespondTransactionsMessage: original RespondTransactionsMessage instance.
+        """
+        obj = RespondTransactionsMessage.__new__(RespondTransactionsMessage)
+        obj.block_id = struct.unpack_from('<q', msg, 3)[0]
+        obj.txs = decode_txn_list(msg, 11)
+        return obj
+
+
 class PingMessage:
     """Is sent to estimate RTT.
 
@@ -0,0 +1,622 @@
+"""This module implements the key-value stores a blocktree can be persisted to. All backends provide the same interface
+(modeled after the one of plyvel): `get`, `put`, `delete`, `write_batch`, `iterator`, `compact_range` and `close`. Keys
+and values are bytes, iteration is in lexicographic key order.
+
+Backends:
+    'leveldb': LevelDB through plyvel (default).
+    'sqlite': a single table in a SQLite database, needs no native dependency.
+    'memory': a dict, nothing is written to disk. Useful for tests, benchmarks and large in-process clusters.
+
+Optionally the blocks themselves are kept in a `SegmentStore` (append-only segment files) instead, and the writes are
+applied by a `StorageWriter` running in a dedicated thread.
+"""
+
+import os
+import mmap
+import queue
+import struct
+import sqlite3
+import threading
+import logging
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
+
+from piChain.config import SEGMENT_SIZE
+
+logger = logging.getLogger(__name__)
+
+LEVELDB = 'leveldb'
+SQLITE = 'sqlite'
+MEMORY = 'memory'
+
+
+def open_storage(backend, path):
+    """Open (or create) the storage of type `backend` located in directory `path`.
+
+    Args:
+        backend (str): LEVELDB, SQLITE or MEMORY.
+        path (str): directory of the storage (ignored by MEMORY).
+
+    Returns:
+        Storage: the opened storage.
+    """
+    if backend == LEVELDB:
+        return LevelDBStorage(path)
+    elif backend == SQLITE:
+        return SQLiteStorage(path)
+    elif backend == MEMORY:
+        return MemoryStorage()
+    raise ValueError('unknown storage backend: %s' % backend)
+
+
+def prefix_end(prefix):
+    """
+    Args:
+        prefix (bytes): a key prefix.
+
+    Returns:
+        bytes: smallest key that is greater than all keys starting with `prefix` or None if there is no such key.
+    """
+    end = bytearray(prefix)
+    while end and end[-1] == 0xFF:
+        end.pop()
+    if not end:
+        return None
+    end[-1] += 1
+    return bytes(end)
+
+
+class Storage:
+    """Interface of a key-value store.
+
+    Attributes:
+        closed (bool): True once `close` has been called.
+    """
+    closed = False
+
+    def get(self, key):
+        """
+        Args:
+            key (bytes): key.
+
+        Returns:
+            bytes: the value stored under `key` or None if `key` does not exist.
+        """
+        raise NotImplementedError
+
+    def put(self, key, value):
+        """Store `value` under `key`.
+
+        Args:
+            key (bytes): key.
+            value (bytes): value.
+        """
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Delete `key` if it exists.
+
+        Args:
+            key (bytes): key.
+        """
+        raise NotImplementedError
+
+    def write_batch(self, sync=False):
+        """Create a write batch to be used as context manager. The writes done through the batch are applied atomically
+        once the context exits without an exception.
+
+        Args:
+            sync (bool): if True the batch is synced to disk (fsync). This also makes all previous writes durable.
+
+        Returns:
+            WriteBatch: the write batch.
+        """
+        return WriteBatch(self, sync)
+
+    def write(self, ops, sync):
+        """Atomically apply the writes collected by a `WriteBatch`.
+
+        Args:
+            ops (list): list of (key, value) tuples, value is None if the key is deleted.
+            sync (bool): see `write_batch`.
+        """
+        raise NotImplementedError
+
+    def iterator(self, prefix=b''):
+        """
+        Args:
+            prefix (bytes): only keys starting with `prefix` are returned.
+
+        Returns:
+            iterator: (key, value) tuples in lexicographic key order.
+        """
+        raise NotImplementedError
+
+    def __iter__(self):
+        return self.iterator()
+
+    def compact_range(self):
+        """Reclaim the space of deleted and overwritten entries. Can be called from another thread."""
+        pass
+
+    def size(self):
+        """Can be called from another thread.
+
+        Returns:
+            int: number of bytes the storage uses on disk.
+        """
+        return 0
+
+    def close(self):
+        """Close the storage."""
+        self.closed = True
+
+
+class WriteBatch:
+    """Writes collected to be applied atomically by `Storage.write`.
+
+    Args:
+        storage (Storage): storage the writes are applied to.
+        sync (bool): see `Storage.write_batch`.
+
+    Attributes:
+        storage (Storage): see Args.
+        sync (bool): see Args.
+        ops (list): list of (key, value) tuples, value is None if the key is deleted.
+    """
+    def __init__(self, storage, sync):
+        self.storage = storage
+        self.sync = sync
+        self.ops = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.storage.write(self.ops, self.sync)
+
+    def put(self, key, value):
+        self.ops.append((key, value))
+
+    def delete(self, key):
+        self.ops.append((key, None))
+
+
+class LevelDBStorage(Storage):
+    """LevelDB database accessed through plyvel.
+
+    Args:
+        path (str): directory of the database (created if missing).
+
+    Attributes:
+        path (str): see Args.
+        db (plyvel.DB): the database.
+    """
+    def __init__(self, path):
+        import plyvel
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self.db = plyvel.DB(path, create_if_missing=True)
+
+    @property
+    def closed(self):
+        return self.db.closed
+
+    def get(self, key):
+        return self.db.get(key)
+
+    def put(self, key, value):
+        self.db.put(key, value)
+
+    def delete(self, key):
+        self.db.delete(key)
+
+    def write_batch(self, sync=False):
+        return self.db.write_batch(transaction=True, sync=sync)
+
+    def iterator(self, prefix=b''):
+        return self.db.iterator(prefix=prefix)
+
+    def compact_range(self):
+        self.db.compact_range()
+
+    def size(self):
+        return sum(entry.stat().st_size for entry in os.scandir(self.path) if entry.is_file())
+
+    def close(self):
+        self.db.close()
+
+
+class SQLiteStorage(Storage):
+    """Table `kv` in the SQLite database `blocktree.sqlite3` inside the given directory. The database runs in WAL mode,
+    commits are only synced to disk if requested (see `write_batch`). Free pages are released by `compact_range`
+    (incremental vacuum).
+
+    Args:
+        path (str): directory of the database (created if missing).
+
+    Attributes:
+        path (str): path of the database file.
+        conn (sqlite3.Connection): connection to the database (in autocommit mode, transactions are explicit).
+        lock (threading.Lock): serializes the use of `conn` (`compact_range` is called from another thread).
+    """
+    def __init__(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = os.path.join(path, 'blocktree.sqlite3')
+        self.conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        # only has an effect on a new database
+        self.conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS kv (key BLOB PRIMARY KEY, value BLOB NOT NULL) WITHOUT ROWID')
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM kv WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def put(self, key, value):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO kv VALUES (?, ?)', (key, value))
+
+    def delete(self, key):
+        with self.lock:
+            self.conn.execute('DELETE FROM kv WHERE key = ?', (key,))
+
+    def write(self, ops, sync):
+        with self.lock:
+            if ops:
+                if sync:
+                    self.conn.execute('PRAGMA synchronous = FULL')
+                self.conn.execute('BEGIN')
+                try:
+                    for key, value in ops:
+                        if value is None:
+                            self.conn.execute('DELETE FROM kv WHERE key = ?', (key,))
+                        else:
+                            self.conn.execute('INSERT OR REPLACE INTO kv VALUES (?, ?)', (key, value))
+                    self.conn.execute('COMMIT')
+                except Exception:
+                    self.conn.execute('ROLLBACK')
+                    raise
+                finally:
+                    if sync:
+                        self.conn.execute('PRAGMA synchronous = NORMAL')
+            elif sync:
+                # nothing to commit: sync the log written by previous commits instead
+                self.conn.execute('PRAGMA wal_checkpoint(FULL)')
+
+    def iterator(self, prefix=b''):
+        end = prefix_end(prefix)
+        with self.lock:
+            if end is None:
+                cursor = self.conn.execute('SELECT key, value FROM kv WHERE key >= ? ORDER BY key', (prefix,))
+            else:
+                cursor = self.conn.execute('SELECT key, value FROM kv WHERE key >= ? AND key < ? ORDER BY key',
+                                           (prefix, end))
+            # fetch all rows s.t the table can be modified while iterating
+            rows = cursor.fetchall()
+        return iter(rows)
+
+    def compact_range(self):
+        with self.lock:
+            self.conn.execute('PRAGMA incremental_vacuum')
+            self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def size(self):
+        size = 0
+        for path in [self.path, self.path + '-wal']:
+            if os.path.exists(path):
+                size += os.path.getsize(path)
+        return size
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+        self.closed = True
+
+
+class MemoryStorage(Storage):
+    """Storage keeping all entries in a dict. The entries are lost once the storage is closed.
+
+    Attributes:
+        data (dict): dict from key to value.
+    """
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def put(self, key, value):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def write(self, ops, sync):
+        for key, value in ops:
+            if value is None:
+                self.data.pop(key, None)
+            else:
+                self.data[key] = value
+
+    def iterator(self, prefix=b''):
+        keys = sorted(key for key in self.data if key.startswith(prefix))
+        return iter([(key, self.data[key]) for key in keys])
+
+
+class SegmentStore:
+    """Log-structured store for blocks. Blocks are appended to segment files (`segment_<number>.log`), a new segment is
+    started once the current one (active segment) exceeds `segment_size` bytes. An in-memory index maps each block id
+    to the location of the block, it is rebuilt at startup by reading the record headers only. Reads are served from a
+    read-only memory mapping of the segment (i.e from the page cache). A segment file is deleted as a whole once all
+    the blocks it contains have been deleted, thus no tombstones are written and no compaction is needed.
+
+    Record format: block id (int64), length of the data (uint32), data (serialized block).
+
+    Args:
+        path (str): directory of the segment files (created if missing).
+        segment_size (int): size in bytes after which a new segment is started.
+
+    Attributes:
+        path (str): see Args.
+        segment_size (int): see Args.
+        index (dict): dict from block id to (segment number, offset of the data, length of the data).
+        live (dict): dict from segment number to the number of blocks in the segment that are not deleted.
+        maps (dict): dict from segment number to the memory mapping of the segment (created on the first read).
+        active_number (int): number of the segment blocks are appended to.
+        active (file): the active segment opened for appending.
+        active_size (int): size of the active segment in bytes.
+        unsynced (set): numbers of the segments sealed since the last sync (their data may not be on disk yet).
+    """
+    record_header = struct.Struct('<qI')
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self.segment_size = segment_size
+        self.index = {}
+        self.live = {}
+        self.maps = {}
+        self.unsynced = set()
+
+        numbers = sorted(int(name[8:-4]) for name in os.listdir(path)
+                         if name.startswith('segment_') and name.endswith('.log'))
+        for number in numbers:
+            self.load_segment(number)
+
+        self.active_number = numbers[-1] if numbers else 0
+        self.active = open(self.segment_path(self.active_number), 'ab')
+        self.active_size = self.active.tell()
+        self.live.setdefault(self.active_number, 0)
+
+    def segment_path(self, number):
+        return os.path.join(self.path, 'segment_%016d.log' % number)
+
+    def load_segment(self, number):
+        """Add the blocks of a segment to the index. A record which has not been written completely (crash) is cut
+        off.
+
+        Args:
+            number (int): number of the segment.
+        """
+        path = self.segment_path(number)
+        size = os.path.getsize(path)
+        offset = 0
+        with open(path, 'rb') as f:
+            while offset + self.record_header.size <= size:
+                block_id, length = self.record_header.unpack(f.read(self.record_header.size))
+                if offset + self.record_header.size + length > size:
+                    break
+                self.remove_from_index(block_id)
+                self.index[block_id] = (number, offset + self.record_header.size, length)
+                self.live[number] = self.live.get(number, 0) + 1
+                offset += self.record_header.size + length
+                f.seek(offset)
+        if offset < size:
+            os.truncate(path, offset)
+        self.live.setdefault(number, 0)
+
+    def __contains__(self, block_id):
+        return block_id in self.index
+
+    def __iter__(self):
+        return iter(list(self.index))
+
+    def put(self, block_id, data):
+        """Append a block to the active segment.
+
+        Args:
+            block_id (int): id of the block.
+            data (bytes): serialized block.
+        """
+        if self.active_size >= self.segment_size:
+            self.start_segment()
+        self.remove_from_index(block_id)
+        self.active.write(self.record_header.pack(block_id, len(data)))
+        self.active.write(data)
+        self.index[block_id] = (self.active_number, self.active_size + self.record_header.size, len(data))
+        self.live[self.active_number] += 1
+        self.active_size += self.record_header.size + len(data)
+
+    def get(self, block_id):
+        """
+        Args:
+            block_id (int): id of the block.
+
+        Returns:
+            bytes: the serialized block or None if it is not contained.
+        """
+        entry = self.index.get(block_id)
+        if entry is None:
+            return None
+        number, offset, length = entry
+        m = self.maps.get(number)
+        if m is None or len(m) < offset + length:
+            # the mapping of the active segment is extended once it is read beyond its end
+            if number == self.active_number:
+                self.active.flush()
+            if m is not None:
+                m.close()
+            with open(self.segment_path(number), 'rb') as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[number] = m
+        return m[offset:offset + length]
+
+    def delete(self, block_id):
+        """Delete a block. The segment containing it is deleted if it contains no other blocks and is not active.
+
+        Args:
+            block_id (int): id of the block.
+        """
+        number = self.remove_from_index(block_id)
+        if number is not None and self.live[number] == 0 and number != self.active_number:
+            self.delete_segment(number)
+
+    def remove_from_index(self, block_id):
+        """
+        Returns:
+            int: number of the segment which contained the block or None if the block is not contained.
+        """
+        entry = self.index.pop(block_id, None)
+        if entry is None:
+            return None
+        self.live[entry[0]] -= 1
+        return entry[0]
+
+    def start_segment(self):
+        """Seal the active segment and start a new one. The sealed segment is synced by the next `sync`."""
+        self.active.close()
+        if self.live[self.active_number] == 0:
+            self.delete_segment(self.active_number)
+        else:
+            self.unsynced.add(self.active_number)
+        self.active_number += 1
+        self.active = open(self.segment_path(self.active_number), 'ab')
+        self.active_size = 0
+        self.live[self.active_number] = 0
+
+    def delete_segment(self, number):
+        m = self.maps.pop(number, None)
+        if m is not None:
+            m.close()
+        del self.live[number]
+        self.unsynced.discard(number)
+        os.remove(self.segment_path(number))
+
+    def flush(self):
+        """Hand the appended data over to the operating system."""
+        self.active.flush()
+
+    def sync(self):
+        """Sync the appended data to disk (fsync), including the data of the segments sealed since the last sync."""
+        for fd in self.sync_fds():
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def sync_fds(self):
+        """Hand the appended data over to the operating system and return file descriptors of all segment files that
+        need to be synced s.t the data appended so far is durable. The sealed segments are considered synced from now
+        on, the caller is responsible for syncing and closing the file descriptors (e.g in another thread).
+
+        Returns:
+            list: file descriptors (int) of the sealed segments not yet synced and of the active segment.
+        """
+        self.active.flush()
+        fds = [os.open(self.segment_path(number), os.O_RDONLY) for number in sorted(self.unsynced)]
+        fds.append(os.dup(self.active.fileno()))
+        self.unsynced = set()
+        return fds
+
+    def size(self):
+        """
+        Returns:
+            int: number of bytes used by the segment files.
+        """
+        return sum(os.path.getsize(self.segment_path(number)) for number in self.live)
+
+    def close(self):
+        for m in self.maps.values():
+            m.close()
+        self.maps = {}
+        self.active.close()
+
+
+class StorageWriter:
+    """Applies write batches to a storage in a dedicated thread s.t disk latency does not block the reactor. Batches are
+    written in the order they are submitted and their Deferreds fire in the same order (in the reactor thread).
+
+    Args:
+        storage (Storage): storage the batches are written to.
+
+    Attributes:
+        storage (Storage): see Args.
+        reactor (IReactor): reactor the Deferreds are fired in.
+        queue (queue.Queue): submitted batches not yet written, None stops the thread.
+        thread (threading.Thread): the writer thread.
+    """
+    def __init__(self, storage):
+        self.storage = storage
+        self.reactor = reactor
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='storage-writer', daemon=True)
+        self.thread.start()
+
+    def submit(self, ops, sync, fds=()):
+        """Queue a batch of writes.
+
+        Args:
+            ops (list): list of (key, value) tuples, value is None if the key is deleted.
+            sync (bool): if True the batch is synced to disk (fsync).
+            fds (list): file descriptors to be synced (and closed) before the batch is written (optional).
+
+        Returns:
+            Deferred: fires with None once the batch has been written.
+        """
+        d = Deferred()
+        self.queue.put((ops, sync, fds, d))
+        return d
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            ops, sync, fds, d = job
+            try:
+                try:
+                    for fd in fds:
+                        os.fsync(fd)
+                finally:
+                    for fd in fds:
+                        os.close(fd)
+                with self.storage.write_batch(sync=sync) as wb:
+                    for key, value in ops:
+                        if value is None:
+                            wb.delete(key)
+                        else:
+                            wb.put(key, value)
+            except Exception:
+                logger.exception('writing to the storage failed')
+                self.reactor.callFromThread(d.errback, Failure())
+            else:
+                self.reactor.callFromThread(d.callback, None)
+
+    def stop(self):
+        """Write the queued batches and stop the thread."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
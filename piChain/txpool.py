@@ -0,0 +1,157 @@
+"""This module implements the data structures a node uses to keep track of the transactions it has seen and of the
+transactions that are not yet included in a block."""
+
+from collections import OrderedDict
+
+from piChain.config import TXN_WINDOW_SIZE
+
+
+class TransactionQueue:
+    """Queue of transactions that are not yet included in a block. Transactions are kept in insertion order and are
+    indexed by their `txn_id`, thus membership tests and removals are O(1) and taking the k oldest transactions is O(k).
+
+    Args:
+        txs (iterable): Transactions initially contained in the queue (optional).
+
+    Attributes:
+        txs (OrderedDict): dict from txn_id to Transaction, ordered by insertion time.
+    """
+    def __init__(self, txs=()):
+        self.txs = OrderedDict()
+        for txn in txs:
+            self.append(txn)
+
+    def __len__(self):
+        return len(self.txs)
+
+    def __contains__(self, txn):
+        return txn.txn_id in self.txs
+
+    def __iter__(self):
+        return iter(self.txs.values())
+
+    def get(self, txn_id):
+        """
+        Args:
+            txn_id (int): id of the transaction.
+
+        Returns:
+            Transaction: the transaction with id `txn_id` or None if the queue does not contain it.
+        """
+        return self.txs.get(txn_id)
+
+    def append(self, txn):
+        """Add `txn` to the end of the queue. Has no effect if the queue already contains it.
+
+        Args:
+            txn (Transaction): Transaction to be added.
+        """
+        if txn.txn_id not in self.txs:
+            self.txs[txn.txn_id] = txn
+
+    def discard(self, txn):
+        """Remove `txn` from the queue if it is contained.
+
+        Args:
+            txn (Transaction): Transaction to be removed.
+        """
+        self.txs.pop(txn.txn_id, None)
+
+    def first(self):
+        """
+        Returns:
+            Transaction: the oldest transaction in the queue or None if the queue is empty.
+        """
+        if not self.txs:
+            return None
+        return next(iter(self.txs.values()))
+
+    def pop_front(self, count):
+        """Remove the `count` oldest transactions from the queue and return them.
+
+        Args:
+            count (int): Max number of transactions to be removed.
+
+        Returns:
+            list: the removed transactions in insertion order.
+        """
+        if count >= len(self.txs):
+            txs = list(self.txs.values())
+            self.txs = OrderedDict()
+            return txs
+
+        txs = []
+        for _ in range(count):
+            txs.append(self.txs.popitem(last=False)[1])
+        return txs
+
+
+class TransactionFilter:
+    """Set of the txn ids seen so far with bounded memory. A txn id is composed of the id of its creator and a sequence
+    number which is monotonically increasing per creator. For each creator a sliding window of the `window_size` most
+    recent sequence numbers is kept, all sequence numbers below the window (low watermark) count as seen. Inside the
+    window the sequence numbers are kept as the bits of two integers, which stay 0 as long as the transactions of a
+    creator are seen in order. Memory usage is thus O(number of creators * window_size / 8) bytes.
+
+    Args:
+        window_size (int): number of sequence numbers per creator tracked individually.
+
+    Attributes:
+        window_size (int): see Args.
+        mask (int): the lowest `window_size - 1` bits set.
+        windows (dict): dict from creator id to [highest, missing, start, seen]. `highest` is the highest sequence
+            number seen and `start` the first one seen since the window last jumped (the sequence numbers of the window
+            below `start` are not seen unless marked in `seen`). Bit `i` of `missing` is set if sequence number
+            `highest - 1 - i` >= `start` has not been seen yet, bit `i` of `seen` is set if sequence number
+            `start - 1 - i` has been seen.
+    """
+    def __init__(self, window_size=TXN_WINDOW_SIZE):
+        self.window_size = window_size
+        self.mask = (1 << (window_size - 1)) - 1
+        self.windows = {}
+
+    def __contains__(self, txn_id):
+        window = self.windows.get(txn_id & 0xFFFF)
+        if window is None:
+            return False
+        seq = txn_id >> 16
+        distance = window[0] - seq
+        if distance <= 0:
+            return distance == 0
+        if distance >= self.window_size:
+            return True
+        if seq < window[2]:
+            return bool(window[3] >> (window[2] - 1 - seq) & 1)
+        return not window[1] >> (distance - 1) & 1
+
+    def add(self, txn_id):
+        """Mark `txn_id` as seen. If its sequence number lies above the window of its creator, the window slides
+        forward and the sequence numbers dropping out of it count as seen.
+
+        Args:
+            txn_id (int): id of the transaction.
+        """
+        creator_id = txn_id & 0xFFFF
+        seq = txn_id >> 16
+        window = self.windows.get(creator_id)
+        if window is None or seq - window[0] >= self.window_size:
+            # the window ends at the first sequence number seen s.t older transactions are still accepted
+            self.windows[creator_id] = [seq, 0, seq, 0]
+            return
+
+        highest, missing = window[0], window[1]
+        if seq == highest + 1 and not missing:
+            # in order and nothing missing: the window slides by one
+            window[0] = seq
+            return
+
+        distance = seq - highest
+        if distance > 0:
+            # slide the window: the skipped sequence numbers are missing, the previous highest one is not
+            window[0] = seq
+            window[1] = ((missing << distance) | ((1 << (distance - 1)) - 1)) & self.mask
+        elif 0 < -distance < self.window_size:
+            if seq >= window[2]:
+                window[1] = missing & ~(1 << (-distance - 1))
+            else:
+                window[3] |= 1 << (window[2] - 1 - seq)
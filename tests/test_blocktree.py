@@ -121,3 +121,63 @@ class TestBlocktree(TestCase):
         block_set.add(b2)
 
         assert len(block_set) == 2
+
+    def test_jump_pointer_index(self):
+        """Compare the indexed ancestor queries against a walk along the parent pointers on a long forked chain."""
+        bt = Blocktree(0)
+        bt.db = MagicMock()
+
+        # main chain of 300 blocks with a fork every 50 blocks
+        main = [GENESIS]
+        forks = []
+        for i in range(1, 301):
+            b = Block(0, main[-1].block_id, [Transaction(0, 'c', i)], i)
+            bt.add_block(b)
+            main.append(b)
+            if i % 50 == 0:
+                fork = Block(1, main[i - 10].block_id, [Transaction(1, 'c', i)], i)
+                bt.add_block(fork)
+                forks.append(fork)
+
+        def walk_ancestors(block):
+            ancestors = set()
+            while block.parent_block_id is not None:
+                block = bt.nodes.get(block.parent_block_id)
+                ancestors.add(block.block_id)
+            return ancestors
+
+        for b in [main[1], main[77], main[128], main[300]] + forks:
+            ancestors = walk_ancestors(b)
+            for a in main[::7] + forks:
+                assert bt.ancestor(a, b) == (a.block_id in ancestors)
+
+        assert bt.common_ancestor(main[300], forks[0]) == main[40]
+        assert bt.common_ancestor(forks[5], forks[2]) == main[140]
+        assert bt.common_ancestor(main[123], main[200]) == main[123]
+        assert bt.heights.get(main[300].block_id) == 300
+
+    def test_jump_pointer_index_out_of_order(self):
+        """Blocks whose parent arrives later are indexed lazily."""
+        bt = Blocktree(0)
+        bt.db = MagicMock()
+        b1 = Block(1, GENESIS.block_id, [Transaction(0, 'c', 0)], 1)
+        b2 = Block(2, b1.block_id, [Transaction(0, 'c', 1)], 2)
+        b3 = Block(3, b2.block_id, [Transaction(0, 'c', 2)], 3)
+
+        bt.add_block(b3)
+        bt.add_block(b2)
+        assert b3.block_id not in bt.heights
+        assert not bt.index_block(b3)
+
+        bt.add_block(b1)
+        assert bt.ancestor(b1, b3)
+        assert bt.heights.get(b3.block_id) == 3
+
+        # a new genesis block without known parent is the root of the index
+        bt.remove_block(b1.block_id)
+        bt.remove_block(GENESIS.block_id)
+        bt.heights.clear()
+        bt.jumps.clear()
+        bt.genesis = b2
+        assert bt.ancestor(b2, b3)
+        assert bt.common_ancestor(b3, b2) == b2
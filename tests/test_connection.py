@@ -3,6 +3,7 @@ in the PaxosNetwork module. """
 
 import json
 import time
+import struct
 import logging
 
 from twisted.trial import unittest
@@ -11,7 +12,9 @@ from unittest.mock import MagicMock
 
 from piChain.PaxosLogic import Node
 from piChain.messages import Transaction, RequestBlockMessage, Block, RespondBlockMessage, PaxosMessage, PongMessage, \
-    PingMessage
+    PingMessage, TransactionBatchMessage, AckCommitMessage, CompactBlockMessage, RequestTransactionsMessage, \
+    RespondTransactionsMessage
+from piChain.PaxosNetwork import FRAGMENT_HEADER
 
 logging.disable(logging.CRITICAL)
 
@@ -45,7 +48,9 @@ class TestConnection(unittest.TestCase):
         self.assertEqual(self.proto.peer_node_id, peer_node_id)
         self.assertIn(peer_node_id, self.proto.connection_manager.peers)
 
-        self.assertEqual(b'ACK{"nodeid": "0"}', self.transport.value()[4:])
+        self.assertEqual(b'ACK{"nodeid": "0", "compression": ["zlib"], "chunked": true, "compact_blocks": true}',
+                         self.transport.value()[4:])
+        self.assertFalse(self.proto.compression)
 
     def test_handshake_ack(self):
         """ Test receipt of a handshake acknowledgement message.
@@ -59,6 +64,154 @@ class TestConnection(unittest.TestCase):
 
         self.assertEqual(self.transport.value(), b'')
 
+    def test_compression(self):
+        """Test the negotiation of compression in the handshake and the receipt of a compressed block.
+        """
+        s = json.dumps({'nodeid': '1', 'compression': ['zlib']})
+        self.proto.stringReceived(b'HEL' + s.encode())
+        self.assertTrue(self.proto.compression)
+        self.transport.clear()
+
+        self.node.receive_block = MagicMock()
+        txs = [Transaction(0, 'put k12_%s v' % i, i) for i in range(100)]
+        block = Block(0, 0, txs, 1)
+        self.node.broadcast(block, 'BLK')
+
+        data = self.transport.value()[4:]
+        self.assertEqual(data[:3], b'ZLB')
+        self.assertLess(len(data), len(block.serialize()))
+
+        self.proto.stringReceived(data)
+        obj = self.node.receive_block.call_args[0][0]
+        self.assertEqual(obj.txs, txs)
+
+        # small messages are sent uncompressed
+        self.transport.clear()
+        self.node.respond(RespondBlockMessage([Block(0, 0, [], 2)]), self.proto)
+        self.assertEqual(self.transport.value()[4:7], b'RSB')
+
+        # a malformed compressed message is dropped without closing the connection
+        self.node.receive_block.reset_mock()
+        self.proto.stringReceived(b'ZLB' + b'not zlib data')
+        self.assertFalse(self.node.receive_block.called)
+        self.assertFalse(self.transport.disconnecting)
+
+        # so is a truncated one, even if only the checksum at the end of the stream is missing
+        self.proto.stringReceived(data[:-4])
+        self.assertFalse(self.node.receive_block.called)
+        self.assertFalse(self.transport.disconnecting)
+
+    def test_compression_disabled(self):
+        """Test that a node with compression disabled does not negotiate it.
+        """
+        self.node.compression = False
+        s = json.dumps({'nodeid': '1', 'compression': ['zlib']})
+        self.proto.stringReceived(b'HEL' + s.encode())
+
+        self.assertFalse(self.proto.compression)
+        self.assertEqual(b'ACK{"nodeid": "0", "chunked": true, "compact_blocks": true}', self.transport.value()[4:])
+
+    def test_fragments(self):
+        """Test that a large block is sent in fragments, interleaved with other messages while the transport is paused.
+        """
+        s = json.dumps({'nodeid': '1', 'chunked': True})
+        self.proto.stringReceived(b'HEL' + s.encode())
+        self.assertTrue(self.proto.chunked)
+        self.transport.clear()
+
+        self.node.chunk_size = 100
+        self.node.compression = False
+        self.proto.compression = False
+        txs = [Transaction(0, 'put k12_%s v' % i, i) for i in range(100)]
+        block = Block(0, 0, txs, 1)
+
+        self.proto.pauseProducing()
+        self.node.broadcast(block, 'BLK')
+        self.assertEqual(self.transport.value(), b'')
+        self.node.broadcast(AckCommitMessage(block.block_id), 'ACM')
+        self.proto.resumeProducing()
+
+        # deliver the written data to a connection of another node
+        self.node.receive_block = MagicMock()
+        self.node.receive_ack_commit_message = MagicMock()
+        receiver = self.node.buildProtocol(('localhost', 1))
+        receiver.makeConnection(proto_helpers.StringTransport())
+        receiver.dataReceived(self.transport.value())
+
+        self.assertTrue(self.node.receive_ack_commit_message.called)
+        obj = self.node.receive_block.call_args[0][0]
+        self.assertEqual(obj.txs, txs)
+        self.assertEqual(receiver.incoming_transfers, {})
+        self.assertEqual(receiver.incoming_size, 0)
+
+    def test_fragments_ordered(self):
+        """Test that a paxos message sent after a fragmented block is held back until the block is sent, while other
+        messages are sent in between.
+        """
+        s = json.dumps({'nodeid': '1', 'chunked': True})
+        self.proto.stringReceived(b'HEL' + s.encode())
+        self.transport.clear()
+
+        self.node.chunk_size = 100
+        self.node.compression = False
+        self.proto.compression = False
+        txs = [Transaction(0, 'put k12_%s v' % i, i) for i in range(100)]
+        block = Block(0, 0, txs, 1)
+
+        self.proto.pauseProducing()
+        self.node.broadcast(block, 'BLK')
+        self.node.broadcast(PaxosMessage('TRY', 1), 'PAM')
+        self.node.broadcast(RequestBlockMessage(block.block_id), 'RQB')
+        self.assertEqual(len(self.proto.ordered_messages), 1)
+        self.proto.resumeProducing()
+        self.assertEqual(len(self.proto.ordered_messages), 0)
+
+        received = []
+        self.node.receive_block = lambda obj: received.append('BLK')
+        self.node.receive_paxos_message = lambda obj, sender: received.append('PAM')
+        self.node.receive_request_blocks_message = lambda obj, sender: received.append('RQB')
+        receiver = self.node.buildProtocol(('localhost', 1))
+        receiver.makeConnection(proto_helpers.StringTransport())
+        receiver.dataReceived(self.transport.value())
+
+        self.assertEqual(received, ['RQB', 'BLK', 'PAM'])
+
+    def test_fragments_max_size(self):
+        """Test that a peer sending fragmented messages larger than the max transfer size is disconnected.
+        """
+        self.node.max_transfer_size = 1000
+        self.proto.stringReceived(b'FRG' + FRAGMENT_HEADER.pack(1, 1001) + b'BLK')
+
+        self.assertTrue(self.transport.disconnecting)
+        self.assertEqual(self.proto.incoming_transfers, {})
+
+    def test_write_coalescing(self):
+        """Test that the messages sent while handling received data are written to the transport at once.
+        """
+        frames = b''
+        for i in range(3):
+            ping = PingMessage(float(i)).serialize()
+            frames += struct.pack('<I', len(ping)) + ping
+        self.proto.dataReceived(frames)
+
+        self.assertEqual((self.proto.frames_sent, self.proto.flush_count), (3, 1))
+        self.assertEqual(self.proto.out_frames, [])
+        receiver = self.node.buildProtocol(('localhost', 1))
+        receiver.makeConnection(proto_helpers.StringTransport())
+        self.node.receive_pong_message = MagicMock()
+        receiver.dataReceived(self.transport.value())
+        self.assertEqual([c[0][0].time for c in self.node.receive_pong_message.call_args_list], [0.0, 1.0, 2.0])
+
+        # the collected messages are written once they exceed the write buffer size
+        self.node.write_buffer_size = 1
+        self.proto.dataReceived(frames)
+        self.assertEqual((self.proto.frames_sent, self.proto.flush_count), (6, 4))
+
+        # without coalescing every message is written on its own
+        self.node.write_coalescing = False
+        self.proto.dataReceived(frames)
+        self.assertEqual((self.proto.frames_sent, self.proto.flush_count), (9, 7))
+
     def test_rqb(self):
         """Test receipt of a RequestBlockMessage.
         """
@@ -87,6 +240,21 @@ class TestConnection(unittest.TestCase):
         self.assertEqual(type(obj), Transaction)
         self.assertEqual(obj, txn)
 
+    def test_txb(self):
+        """Test receipt of a TransactionBatchMessage in the flat and the CBOR format.
+        """
+        self.node.receive_transactions = MagicMock()
+
+        txs = [Transaction(0, 'command1', 1), Transaction(2, 'cömmänd2', 2)]
+        for s in [TransactionBatchMessage(txs).serialize(),
+                  TransactionBatchMessage(txs + [Transaction(0, b'bytes', 3)]).serialize()]:
+            self.proto.stringReceived(s)
+
+            obj = self.node.receive_transactions.call_args[0][0]
+            self.assertEqual(obj[:2], txs)
+            self.assertEqual([(t.creator_id, t.SEQ, t.content) for t in obj[:2]],
+                             [(t.creator_id, t.SEQ, t.content) for t in txs])
+
     def test_blk(self):
         """Test receipt of a Block.
         """
@@ -103,6 +271,112 @@ class TestConnection(unittest.TestCase):
         self.assertEqual(type(obj), Block)
         self.assertEqual(obj.txs[0], txn1)
 
+    def test_blk_formats(self):
+        """Test the flat block format and the decoding of blocks in the previous CBOR format.
+        """
+        txs = [Transaction(0, 'command1', 1), Transaction(2, 'cömmänd2', 2), Transaction(1, '', 3)]
+        block = Block(1, None, txs, 4)
+        block.depth = 3
+        block.creator_state = 2
+
+        for s in [block.serialize(), block.serialize_cbor()]:
+            obj = Block.unserialize(s)
+            self.assertEqual(obj.block_id, block.block_id)
+            self.assertEqual(obj.SEQ, 4)
+            self.assertIsNone(obj.parent_block_id)
+            self.assertEqual(obj.depth, 3)
+            self.assertEqual(obj.creator_state, 2)
+            self.assertEqual([(t.txn_id, t.creator_id, t.SEQ, t.content) for t in obj.txs],
+                             [(t.txn_id, t.creator_id, t.SEQ, t.content) for t in txs])
+
+        # transactions with other content than strings are encoded in the CBOR format
+        block = Block(1, 0, [Transaction(0, b'bytes', 1)], 1)
+        self.assertEqual(Block.unserialize(block.serialize()).txs[0].content, b'bytes')
+
+    def test_blk_serialize_once(self):
+        """Test that a block is encoded once and that the bytes of a received block are reused.
+        """
+        block = Block(0, 0, [Transaction(0, 'command1', 1)], 1)
+        block.depth = 1
+        s = block.serialize()
+        self.assertIs(block.serialize(), s)
+
+        # the creator state is set after the creation of a block
+        block.creator_state = 0
+        s2 = block.serialize()
+        self.assertIsNot(s2, s)
+        self.assertEqual(Block.unserialize(s2).creator_state, 0)
+
+        received = Block.unserialize(s2)
+        self.assertIs(received.serialize(), s2)
+        rsp = RespondBlockMessage.unserialize(RespondBlockMessage([block]).serialize())
+        self.assertEqual(rsp.blocks[0].serialize(), s2)
+
+    def test_blk_lazy(self):
+        """Test that the transactions of a received block are decoded on first access only.
+        """
+        block = Block(0, 0, [Transaction(0, 'command1', 1), Transaction(0, 'command2', 2)], 1)
+        block.depth = 2
+        obj = Block.unserialize(block.serialize())
+        self.assertIsNone(obj.decoded_txs)
+        self.assertEqual(obj.depth, 2)
+
+        self.assertEqual(obj.txs, block.txs)
+        self.assertEqual(obj.txs[1].content, 'command2')
+        self.assertIsNone(obj.encoded_txs)
+
+    def test_truncated_txs(self):
+        """Test that blocks and transaction batches whose transactions do not fill the message are dropped.
+        """
+        txs = [Transaction(0, 'command1', 1), Transaction(0, 'command2', 2)]
+        block = Block(0, 0, txs, 1)
+        block.depth = 2
+        data = block.serialize()
+        self.assertRaises(ValueError, Block.unserialize, data[:-1])
+        self.assertRaises(ValueError, Block.unserialize, data[:-20])
+        self.assertRaises(ValueError, Block.unserialize, data + b'x')
+        batch = TransactionBatchMessage(txs).serialize()
+        self.assertRaises(ValueError, TransactionBatchMessage.unserialize, batch[:-1])
+
+        self.node.receive_block = MagicMock()
+        self.proto.stringReceived(data[:-1])
+        self.assertFalse(self.node.receive_block.called)
+        self.assertFalse(self.transport.disconnecting)
+
+    def test_cbk(self):
+        """Test that a block is broadcast as compact block to peers that support it and the receipt of the messages
+        used to complete a compact block.
+        """
+        s = json.dumps({'nodeid': '1', 'compact_blocks': True})
+        self.proto.stringReceived(b'HEL' + s.encode())
+        self.assertTrue(self.proto.compact_blocks)
+        self.transport.clear()
+
+        txs = [Transaction(0, 'command1', 1), Transaction(2, 'command2', 2)]
+        block = Block(0, 0, txs, 1)
+        block.depth = 2
+        block.creator_state = 0
+        self.node.broadcast(block, 'BLK')
+
+        self.node.receive_compact_block = MagicMock()
+        self.proto.stringReceived(self.transport.value()[4:])
+        obj = self.node.receive_compact_block.call_args[0][0]
+        self.assertEqual(type(obj), CompactBlockMessage)
+        self.assertEqual(obj.txn_ids, [txn.txn_id for txn in txs])
+        self.assertEqual((obj.block.block_id, obj.block.parent_block_id, obj.block.depth, obj.block.creator_state),
+                         (block.block_id, 0, 2, 0))
+
+        self.node.receive_request_transactions_message = MagicMock()
+        self.proto.stringReceived(RequestTransactionsMessage(block.block_id, [1]).serialize())
+        obj = self.node.receive_request_transactions_message.call_args[0][0]
+        self.assertEqual((obj.block_id, obj.indices), (block.block_id, [1]))
+
+        self.node.receive_respond_transactions_message = MagicMock()
+        self.proto.stringReceived(RespondTransactionsMessage(block.block_id, txs[1:]).serialize())
+        obj = self.node.receive_respond_transactions_message.call_args[0][0]
+        self.assertEqual(obj.block_id, block.block_id)
+        self.assertEqual(obj.txs[0].content, 'command2')
+
     def test_rsp(self):
         """Test receipt of a RespondBlockMessage.
         """
@@ -150,6 +424,37 @@ class TestConnection(unittest.TestCase):
         self.assertEqual(obj.new_block, block.block_id)
         self.assertEqual(obj.last_committed_block, block2.block_id)
 
+    def test_pam_formats(self):
+        """Test the binary paxos message format and the decoding of messages in the previous CBOR format.
+        """
+        for msg_type in ['TRY', 'TRY_OK', 'PROPOSE', 'PROPOSE_ACK', 'COMMIT']:
+            pam = PaxosMessage(msg_type, 7)
+            pam.com_block = -1
+            pam.prop_block = 5 | (2 ** 40 << 16)
+
+            for s in [pam.serialize(), pam.serialize_cbor()]:
+                obj = PaxosMessage.unserialize(s)
+                self.assertEqual(obj.msg_type, msg_type)
+                self.assertEqual(obj.request_seq, 7)
+                self.assertEqual(obj.com_block, -1)
+                self.assertEqual(obj.prop_block, pam.prop_block)
+                self.assertIsNone(obj.new_block)
+                self.assertIsNone(obj.supp_block)
+                self.assertIsNone(obj.last_committed_block)
+
+    def test_register_message_type(self):
+        """Test receipt of a message type registered by the application.
+        """
+        handler = MagicMock()
+        self.node.register_message_type(b'APP', lambda msg: msg[3:].decode(), handler)
+        self.proto.stringReceived(b'APPhello')
+
+        handler.assert_called_once_with('hello', self.proto)
+
+        # unknown message types are ignored
+        self.proto.stringReceived(b'XYZhello')
+        self.assertEqual(handler.call_count, 1)
+
     def test_PON(self):
         """Test receipt of a PongMessage.
         """
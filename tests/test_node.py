@@ -6,11 +6,14 @@ import os
 import shutil
 
 from unittest.mock import MagicMock
-from twisted.internet import task
+from twisted.internet import task, defer
 from twisted.trial.unittest import TestCase
 
 from piChain.PaxosLogic import Node, GENESIS
-from piChain.messages import PaxosMessage, Block, Transaction, RequestBlockMessage, PongMessage
+from piChain.messages import PaxosMessage, Block, Transaction, RequestBlockMessage, PongMessage, \
+    RespondBlockMessage, CompactBlockMessage, RequestTransactionsMessage, RespondTransactionsMessage, AckCommitMessage
+from piChain.txpool import TransactionQueue
+from piChain.config import MAX_TXN_COUNT, TXN_BATCH_TIME, TXN_BATCH_SIZE, TXN_FORWARD_TIMEOUT
 
 logging.disable(logging.CRITICAL)
 
@@ -127,6 +130,55 @@ class TestNode(TestCase):
         assert self.node.s_prop_block.block_id == propose.com_block
         assert self.node.s_supp_block.block_id == propose.new_block
 
+    def test_receive_paxos_message_single_write_batch(self):
+        propose = PaxosMessage('PROPOSE', 1)
+        propose.new_block = GENESIS.block_id
+        propose.com_block = GENESIS.block_id
+
+        self.node.respond = MagicMock()
+        self.node.receive_paxos_message(propose, 1)
+
+        # s_prop_block and s_supp_block are written in one batch
+        assert self.node.blocktree.db.write_batch.call_count == 1
+        assert not self.node.blocktree.db.put.called
+
+    def test_durability(self):
+        propose = PaxosMessage('PROPOSE', 1)
+        propose.new_block = GENESIS.block_id
+        propose.com_block = GENESIS.block_id
+        self.node.respond = MagicMock()
+
+        # default: the promise is synced to disk before PROPOSE_ACK is sent
+        self.node.receive_paxos_message(propose, 1)
+        self.node.blocktree.db.write_batch.assert_called_once_with(sync=True)
+
+        # sync only on commit
+        self.node.blocktree.db = MagicMock()
+        self.node.blocktree.durability = 'sync_on_commit'
+        self.node.receive_paxos_message(propose, 1)
+        self.node.blocktree.db.write_batch.assert_called_once_with(sync=False)
+
+        b = Block(1, GENESIS.block_id, [Transaction(1, 'a', 1)], 1)
+        self.node.blocktree.add_block(b)
+        self.node.broadcast = MagicMock()
+        self.node.blocktree.db = MagicMock()
+        self.node.commit(b)
+        self.node.blocktree.db.write_batch.assert_called_once_with(sync=True)
+
+    def test_send_vote(self):
+        propose = PaxosMessage('PROPOSE', 1)
+        propose.new_block = GENESIS.block_id
+        propose.com_block = GENESIS.block_id
+        self.node.respond = MagicMock()
+
+        # the vote is sent once the writes it depends on are done
+        d = defer.Deferred()
+        self.node.blocktree.sync_vote = MagicMock(return_value=d)
+        self.node.receive_paxos_message(propose, 1)
+        assert not self.node.respond.called
+        d.callback(None)
+        assert self.node.respond.call_args[0][0].msg_type == 'PROPOSE_ACK'
+
     def test_receive_paxos_message_propose_ack(self):
         propose_ack = PaxosMessage('PROPOSE_ACK', 1)
 
@@ -164,12 +216,23 @@ class TestNode(TestCase):
 
         self.node.blocktree.head_block = b4
 
-        self.node.new_txs = [Transaction(1, 'a', 6)]
+        self.node.new_txs = TransactionQueue([Transaction(1, 'a', 6)])
 
         c = self.node.create_block()
         assert len(self.node.new_txs) == 0
         assert self.node.blocktree.nodes.get(c.block_id) == c
 
+    def test_create_block_max_txn_count(self):
+        self.node.new_txs = TransactionQueue(Transaction(1, 'a', i) for i in range(MAX_TXN_COUNT + 10))
+        self.node.readjust_timeout = MagicMock()
+
+        c = self.node.create_block()
+        assert len(c.txs) == MAX_TXN_COUNT
+        assert c.txs[0].SEQ == 0
+        assert len(self.node.new_txs) == 10
+        assert self.node.new_txs.first().SEQ == MAX_TXN_COUNT
+        assert self.node.readjust_timeout.called
+
     def test_reach_genesis_block(self):
 
         b1 = Block(1, GENESIS.block_id, [Transaction(1, 'a', 1)], 1)
@@ -193,6 +256,26 @@ class TestNode(TestCase):
 
         assert self.node.broadcast.called
 
+    def test_reach_genesis_block_after_recovery(self):
+        b1 = Block(1, GENESIS.block_id, [Transaction(1, 'a', 1)], 1)
+        b2 = Block(2, b1.block_id, [Transaction(1, 'a', 2)], 2)
+        b3 = Block(3, b2.block_id, [Transaction(1, 'a', 3)], 3)
+
+        self.node.broadcast = MagicMock()
+        assert not self.node.reach_genesis_block(b3)
+        req = self.node.broadcast.call_args[0][0]
+        assert req.block_id == b2.block_id
+        assert b3.block_id not in self.node.blocktree.connected
+
+        # retrying does not register the waiting block again
+        self.node.reach_genesis_block(b3)
+        assert self.node.blocktree.orphans == {b2.block_id: {b3.block_id}}
+
+        # the missing blocks arrive: b3 is connected without walking its path again
+        self.node.receive_respond_blocks_message(RespondBlockMessage([b2, b1]))
+        assert b3.block_id in self.node.blocktree.connected
+        assert self.node.reach_genesis_block(b3)
+
     def test_receive_request_blocks_message(self):
         b1 = Block(1, GENESIS.block_id, [Transaction(1, 'a', 1)], 1)
         b2 = Block(2, GENESIS.block_id, [Transaction(1, 'a', 2)], 2)
@@ -236,8 +319,13 @@ class TestNode(TestCase):
         self.node.move_to_block(b4)
         assert self.node.blocktree.head_block == old
 
+        self.node.reactor = task.Clock()
+        self.node.new_txs = TransactionQueue([b5.txs[0], b6.txs[0], Transaction(1, 'b', 7)])
         self.node.move_to_block(b6)
         assert self.node.blocktree.head_block == b6
+        assert b6.txs[0] not in self.node.new_txs
+        assert b5.txs[0] in self.node.new_txs
+        assert len(self.node.new_txs) == 2
 
         self.node.broadcast = MagicMock()
         self.node.move_to_block(b1)
@@ -258,6 +346,196 @@ class TestNode(TestCase):
 
         assert self.node.timeout_over.called
 
+    def test_receive_transactions(self):
+        txs = [Transaction(1, 'a', 1), Transaction(1, 'b', 2), Transaction(1, 'a', 1)]
+
+        clock = task.Clock()
+        self.node.reactor = clock
+        self.node.timeout_over = MagicMock()
+        self.node.receive_transactions(txs)
+
+        assert len(self.node.new_txs) == 2
+        assert self.node.oldest_txn == txs[0]
+        clock.advance(50)
+        assert self.node.timeout_over.call_count == 1
+
+    def test_make_txn(self):
+        clock = task.Clock()
+        self.node.reactor = clock
+        self.node.broadcast = MagicMock()
+
+        self.node.make_txn('a')
+        self.node.make_txn('b')
+        assert len(self.node.new_txs) == 2
+        assert not self.node.broadcast.called
+
+        # the transactions are broadcast together once TXN_BATCH_TIME is over
+        clock.advance(TXN_BATCH_TIME)
+        assert self.node.broadcast.call_count == 1
+        obj, msg_type = self.node.broadcast.call_args[0]
+        assert msg_type == 'TXB'
+        assert [txn.content for txn in obj.txs] == ['a', 'b']
+
+        # a full batch is broadcast immediately
+        for i in range(TXN_BATCH_SIZE):
+            self.node.make_txn(str(i))
+        assert self.node.broadcast.call_count == 2
+        assert len(self.node.broadcast.call_args[0][0].txs) == TXN_BATCH_SIZE
+        assert self.node.txn_batch_call is None
+
+    def test_make_txns(self):
+        self.node.reactor = task.Clock()
+        self.node.broadcast = MagicMock()
+        self.node.make_txns(['a', 'b', 'c'])
+
+        assert self.node.broadcast.call_count == 1
+        obj = self.node.broadcast.call_args[0][0]
+        assert [txn.content for txn in obj.txs] == ['a', 'b', 'c']
+        assert len(self.node.new_txs) == 3
+
+    def test_txn_forwarding(self):
+        clock = task.Clock()
+        self.node.reactor = clock
+        self.node.broadcast = MagicMock()
+        self.node.respond = MagicMock()
+        self.node.txn_forwarding = True
+
+        # the creator of a block of a quick node is believed to be quick
+        b = Block(1, GENESIS.block_id, [Transaction(1, 'a', 1)], 1)
+        b.depth = 1
+        b.creator_state = 0
+        self.node.receive_block(b)
+        assert self.node.quick_node_id == 1
+
+        connection = MagicMock()
+        self.node.peers_connection = {'1': connection}
+        self.node.make_txns(['b', 'c'])
+        assert not self.node.broadcast.called
+        obj, sender = self.node.respond.call_args[0]
+        assert sender is connection
+        assert [txn.content for txn in obj.txs] == ['b', 'c']
+
+        # the txs not included in a block in time are broadcast to all nodes
+        txs = obj.txs
+        b2 = Block(1, b.block_id, [txs[0]], 2)
+        b2.depth = 2
+        b2.creator_state = 0
+        self.node.receive_block(b2)
+        clock.advance(TXN_FORWARD_TIMEOUT)
+        obj, msg_type = self.node.broadcast.call_args[0]
+        assert msg_type == 'TXN'
+        assert obj == txs[1]
+        assert self.node.quick_node_id is None
+        assert self.node.forwarded_txs == {}
+
+    def test_receive_compact_block(self):
+        txs = [Transaction(1, 'a', 1), Transaction(1, 'b', 2), Transaction(1, 'c', 3)]
+        b = Block(1, GENESIS.block_id, txs, 1)
+        b.depth = 3
+        message = CompactBlockMessage.unserialize(CompactBlockMessage(b).serialize())
+
+        self.node.reactor = task.Clock()
+        self.node.new_txs = TransactionQueue([txs[0], txs[2]])
+        self.node.receive_block = MagicMock()
+        self.node.respond = MagicMock()
+        self.node.receive_compact_block(message, 'sender')
+
+        # the missing transaction is requested from the sender
+        assert not self.node.receive_block.called
+        req, sender = self.node.respond.call_args[0]
+        assert type(req) == RequestTransactionsMessage
+        assert (req.block_id, req.indices, sender) == (b.block_id, [1], 'sender')
+
+        # a paxos message referring to the incomplete block is handled once the block is complete
+        self.node.receive_paxos_message = MagicMock(wraps=self.node.receive_paxos_message)
+        try_msg = PaxosMessage('TRY', 1)
+        try_msg.new_block = b.block_id
+        self.node.receive_paxos_message(try_msg, 'sender')
+        assert self.node.pending_compact_blocks[b.block_id][3] == [(try_msg, 'sender')]
+
+        self.node.receive_respond_transactions_message(RespondTransactionsMessage(b.block_id, [txs[1]]))
+        assert self.node.receive_paxos_message.call_count == 2
+        block = self.node.receive_block.call_args[0][0]
+        assert block.block_id == b.block_id
+        assert block.txs == txs
+        assert block.serialize() == b.serialize()
+        assert self.node.pending_compact_blocks == {}
+        assert self.node.reactor.getDelayedCalls() == []
+
+    def test_compact_block_fallback(self):
+        txs = [Transaction(1, 'a', 1), Transaction(1, 'b', 2)]
+        b = Block(1, GENESIS.block_id, txs, 1)
+        b.depth = 2
+        message = CompactBlockMessage.unserialize(CompactBlockMessage(b).serialize())
+
+        clock = task.Clock()
+        self.node.reactor = clock
+        self.node.respond = MagicMock()
+        self.node.broadcast = MagicMock()
+        self.node.receive_compact_block(message, 'sender')
+        try_msg = PaxosMessage('TRY', 1)
+        try_msg.new_block = b.block_id
+        try_msg.last_committed_block = GENESIS.block_id
+        self.node.receive_paxos_message(try_msg, 'sender')
+
+        # a response with wrong transactions: the whole block is requested, the paxos message keeps waiting
+        self.node.receive_respond_transactions_message(RespondTransactionsMessage(b.block_id, [txs[0], txs[0]]))
+        req, msg_type = self.node.broadcast.call_args[0]
+        assert (type(req), req.block_id, msg_type) == (RequestBlockMessage, b.block_id, 'RQB')
+        assert self.node.pending_compact_blocks[b.block_id][3] == [(try_msg, 'sender')]
+
+        # the block is received as a whole: the paxos message is handled
+        self.node.receive_paxos_message = MagicMock(wraps=self.node.receive_paxos_message)
+        self.node.receive_respond_blocks_message(RespondBlockMessage([b]))
+        self.node.receive_paxos_message.assert_called_once_with(try_msg, 'sender')
+        assert self.node.pending_compact_blocks == {}
+        assert clock.getDelayedCalls() == []
+
+        # no response at all: the whole block is requested after a timeout
+        b2 = Block(1, b.block_id, [Transaction(1, 'c', 3)], 2)
+        b2.depth = 3
+        message = CompactBlockMessage.unserialize(CompactBlockMessage(b2).serialize())
+        self.node.broadcast.reset_mock()
+        self.node.receive_compact_block(message, 'sender')
+        clock.advance(2 * self.node.expected_rtt)
+        req = self.node.broadcast.call_args[0][0]
+        assert req.block_id == b2.block_id
+        assert self.node.pending_compact_blocks[b2.block_id][0] is None
+
+        # the whole block is not received either: the entry is dropped
+        clock.advance(2 * self.node.expected_rtt)
+        assert self.node.pending_compact_blocks == {}
+
+    def test_receive_request_transactions_message(self):
+        txs = [Transaction(1, 'a', 1), Transaction(1, 'b', 2)]
+        b = Block(1, GENESIS.block_id, txs, 1)
+        self.node.blocktree.nodes.update({b.block_id: b})
+        self.node.respond = MagicMock()
+
+        self.node.receive_request_transactions_message(RequestTransactionsMessage(b.block_id, [1]), 'sender')
+        resp = self.node.respond.call_args[0][0]
+        assert type(resp) == RespondTransactionsMessage
+        assert resp.txs == [txs[1]]
+
+    def test_receive_ack_commit_message(self):
+        b1 = Block(1, GENESIS.block_id, [Transaction(1, 'a', 1)], 1)
+        b2 = Block(2, b1.block_id, [Transaction(1, 'a', 2)], 2)
+        bt = self.node.blocktree
+        bt.add_block(b1)
+        bt.add_block(b2)
+
+        calls = []
+        write = bt.write
+        bt.write = lambda ops, sync=False: calls.append('write') or write(ops, sync)
+        self.node.compactor.add_deleted_bytes = lambda deleted_bytes: calls.append('compact')
+
+        # all nodes committed b2: genesis block change, the compaction is started once the deletions are written
+        for _ in range(self.node.n):
+            self.node.receive_ack_commit_message(AckCommitMessage(b2.block_id))
+        assert bt.genesis == b2
+        assert b1.block_id not in bt.nodes
+        assert calls == ['write', 'compact']
+
     def test_receive_pong_message(self):
         pong = PongMessage(time.time())
         self.node.receive_pong_message(pong, 'a')
@@ -281,7 +559,7 @@ class TestNode(TestCase):
         self.node.blocktree.head_block = b4
 
         txn = Transaction(1, 'a', 1)
-        self.node.new_txs = [txn]
+        self.node.new_txs = TransactionQueue([txn])
         self.node.broadcast = MagicMock()
         self.node.state = 0
 
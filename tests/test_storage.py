@@ -1,14 +1,21 @@
 """Test the underlying plyvel database which stores the relevant data s.t nodes can recover after a crash. """
 
+import json
 import logging
 import os
+import queue
 import shutil
+import tempfile
 
 import plyvel
 from unittest import TestCase
+from unittest.mock import MagicMock
+from twisted.internet import task
 
 from piChain.PaxosLogic import Blocktree, GENESIS
+from piChain.blocktree import Compactor, MissingBlockError, ESTIMATED_TXN_SIZE
 from piChain.messages import Block, Transaction
+from piChain.storage import open_storage, LEVELDB, SQLITE, MEMORY, SegmentStore
 
 logging.disable(logging.CRITICAL)
 
@@ -87,3 +94,372 @@ class TestBlocktree(TestCase):
         assert bt2.db.get(str(b5.block_id).encode()) == b5.serialize()
 
         bt2.db.close()
+
+    def test_commit_log(self):
+        self.bt.add_committed_block(1)
+        self.bt.add_committed_block(2)
+
+        assert self.bt.db.get(b'meta:committed_blocks_tip') == b'2'
+        assert self.bt.db.get(b'committed_blocks:0000000000000001') == b'1'
+
+        self.bt.db.close()
+
+        # the commit log is loaded again after a restart
+        bt2 = Blocktree(0)
+        assert bt2.committed_blocks == [GENESIS.block_id, 1, 2]
+        assert 2 in bt2.committed_block_ids
+
+        # an entry written after the tip pointer (interrupted commit) is ignored
+        bt2.db.put(b'committed_blocks:0000000000000003', b'3')
+        bt2.db.close()
+        bt3 = Blocktree(0)
+        assert 3 not in bt3.committed_block_ids
+
+        bt3.db.close()
+
+    def test_counter_lease(self):
+        assert self.bt.next_counter() == 1
+        assert self.bt.db.get(b'meta:counter') == b'10000'
+        self.bt.db = MagicMock()
+        assert self.bt.next_counter() == 2
+        assert not self.bt.db.write_batch.called
+        self.bt.counter = 10000
+        assert self.bt.next_counter() == 10001
+        assert self.bt.counter_lease == 20000
+        assert self.bt.db.write_batch.called
+
+    def test_counter_lease_restart(self):
+        self.bt.next_counter()
+        self.bt.next_counter()
+        self.bt.db.close()
+
+        # the values of the lease are skipped after a restart
+        bt2 = Blocktree(0)
+        assert bt2.next_counter() == 10001
+        assert bt2.get_meta(b'counter') == 20000
+        bt2.db.close()
+
+    def test_commit_log_migration(self):
+        # database written by an older version
+        self.bt.db.delete(b'meta:version')
+        self.bt.db.put(b'committed_blocks', json.dumps([GENESIS.block_id, 5, 6]).encode())
+        self.bt.db.close()
+
+        bt2 = Blocktree(0)
+        assert bt2.committed_blocks == [GENESIS.block_id, 5, 6]
+        assert bt2.db.get(b'committed_blocks') is None
+        assert bt2.db.get(b'meta:committed_blocks_tip') == b'2'
+
+        bt2.db.close()
+
+    def test_lazy_block_loading(self):
+        b1 = Block(1, GENESIS.block_id, [Transaction(0, 'c', 0)], 1)
+        b2 = Block(2, b1.block_id, [Transaction(0, 'c', 1), Transaction(0, 'c', 2)], 2)
+        self.bt.add_block(b1)
+        self.bt.add_block(b2)
+        self.bt.db.close()
+
+        # only headers are loaded at startup
+        bt2 = Blocktree(0, cache_size=1)
+        assert len(bt2.cache) == 0
+        header = bt2.nodes.get(b2.block_id)
+        assert header.parent_block_id == b1.block_id
+        assert header.depth == 3
+
+        # the transactions are loaded from disk on demand and cached
+        assert header.txs == b2.txs
+        assert bt2.nodes.get(b1.block_id).txs == b1.txs
+        assert list(bt2.cache.keys()) == [b1.block_id]
+        assert header.serialize() == b2.serialize()
+
+        # the size of a block loaded from disk is estimated from its number of transactions
+        bt2.delete_block(b2.block_id)
+        assert bt2.deleted_bytes == header.header_size + 2 * ESTIMATED_TXN_SIZE
+
+        bt2.db.close()
+
+    def test_received_block_not_decoded(self):
+        b1 = Block(1, GENESIS.block_id, [Transaction(0, 'c', 0)], 1)
+        b1.depth = 1
+        received = Block.unserialize(b1.serialize())
+
+        # adding a received block does not decode its transactions
+        self.bt.add_block(received)
+        assert received.decoded_txs is None
+        assert self.bt.db.get(str(b1.block_id).encode()) == b1.serialize()
+
+        assert self.bt.nodes.get(b1.block_id).txs == b1.txs
+        assert self.bt.cache.get(b1.block_id) == b1.txs
+
+    def test_layout_migration(self):
+        b1 = Block(1, GENESIS.block_id, [Transaction(0, 'c', 0)], 1)
+        b1.depth = 1
+        b2 = Block(2, b1.block_id, [Transaction(0, 'c', 1)], 2)
+        b2.depth = 2
+
+        # database written by an older version: blocks and metadata in the same key space
+        self.bt.db.delete(b'meta:version')
+        self.bt.db.put(str(b1.block_id).encode(), b1.serialize())
+        self.bt.db.put(str(b2.block_id).encode(), b2.serialize())
+        self.bt.db.put(b'head_block', str(b2.block_id).encode())
+        self.bt.db.put(b'committed_block', str(b1.block_id).encode())
+        self.bt.db.put(b'counter', b'7')
+        self.bt.db.close()
+
+        bt2 = Blocktree(0)
+        assert bt2.head_block == b2
+        assert bt2.committed_block == b1
+        assert bt2.counter == 7
+        assert bt2.nodes.get(b2.block_id).txs == b2.txs
+        assert bt2.db.get(b'head_block') is None
+        assert bt2.get_meta(b'head_block') == b2.block_id
+        assert bt2.db.get(b'header:' + str(b1.block_id).encode()) == b1.serialize_header()
+
+        bt2.db.close()
+
+    def test_write_batch(self):
+        b1 = Block(1, GENESIS.block_id, [Transaction(0, 'c', 0)], 1)
+
+        with self.bt.write_batch():
+            self.bt.add_block(b1)
+            with self.bt.write_batch():
+                self.bt.put_meta(b'head_block', b1.block_id)
+
+            # nothing is written before the outermost batch is closed, reads see the pending writes
+            assert self.bt.db.get(str(b1.block_id).encode()) is None
+            assert self.bt.db.get(b'meta:head_block') is None
+            assert self.bt.get_meta(b'head_block') == b1.block_id
+
+            self.bt.delete_meta(b'head_block')
+            assert self.bt.get_meta(b'head_block') is None
+
+        assert self.bt.db.get(str(b1.block_id).encode()) == b1.serialize()
+        assert self.bt.db.get(b'meta:head_block') is None
+        assert self.bt.batch is None
+
+        # the writes of a batch are discarded if an exception occurs
+        try:
+            with self.bt.write_batch():
+                self.bt.put_meta(b'head_block', b1.block_id)
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        assert self.bt.db.get(b'meta:head_block') is None
+        assert self.bt.batch is None
+        assert self.bt.batch_depth == 0
+
+    def test_storage_backends(self):
+        storage_dir = tempfile.mkdtemp()
+        try:
+            for backend in [LEVELDB, SQLITE, MEMORY]:
+                db = open_storage(backend, storage_dir + '/' + backend)
+                db.put(b'b:2', b'2')
+                db.put(b'a', b'0')
+                db.put(b'b:1', b'1')
+                db.put(b'c', b'3')
+                assert db.get(b'b:1') == b'1'
+                db.delete(b'c')
+                assert db.get(b'c') is None
+
+                with db.write_batch(sync=True) as wb:
+                    wb.put(b'b:3', b'3')
+                    wb.delete(b'a')
+                assert list(db.iterator(prefix=b'b:')) == [(b'b:1', b'1'), (b'b:2', b'2'), (b'b:3', b'3')]
+                assert [key for key, value in db] == [b'b:1', b'b:2', b'b:3']
+
+                # a batch is not applied if an exception occurs
+                try:
+                    with db.write_batch() as wb:
+                        wb.put(b'd', b'4')
+                        raise RuntimeError
+                except RuntimeError:
+                    pass
+                assert db.get(b'd') is None
+
+                db.compact_range()
+                db.close()
+                assert db.closed
+        finally:
+            shutil.rmtree(storage_dir)
+
+    def test_sqlite_backend(self):
+        storage_dir = tempfile.mkdtemp()
+        try:
+            bt = Blocktree(0, storage_backend=SQLITE, storage_dir=storage_dir)
+            b1 = Block(1, GENESIS.block_id, [Transaction(0, 'c', 0)], 1)
+            with bt.write_batch():
+                bt.add_block(b1)
+                bt.put_meta(b'head_block', b1.block_id)
+                bt.add_committed_block(b1.block_id)
+            bt.db.close()
+
+            bt2 = Blocktree(0, storage_backend=SQLITE, storage_dir=storage_dir)
+            assert bt2.head_block == b1
+            assert bt2.nodes.get(b1.block_id).txs == b1.txs
+            assert bt2.committed_blocks == [GENESIS.block_id, b1.block_id]
+            bt2.db.close()
+        finally:
+            shutil.rmtree(storage_dir)
+
+    def test_compactor(self):
+        class ThreadPool:
+            """Runs the work in the calling thread."""
+            @staticmethod
+            def callInThreadWithCallback(on_result, f, *args, **kwargs):
+                on_result(True, f(*args, **kwargs))
+
+        clock = task.Clock()
+        clock.getThreadPool = lambda: ThreadPool
+        clock.callFromThread = lambda f, *args, **kwargs: f(*args, **kwargs)
+
+        b1 = Block(1, GENESIS.block_id, [Transaction(0, 'c' * 1000, 0)], 1)
+        self.bt.add_block(b1)
+        # the size of a deleted block is known without reading it from disk
+        self.bt.db.get = MagicMock(side_effect=AssertionError)
+        self.bt.delete_block(b1.block_id)
+        assert self.bt.deleted_bytes > 1000
+        del self.bt.db.get
+
+        compactor = Compactor(self.bt, threshold=2000, interval=10)
+        compactor.reactor = clock
+
+        # below the threshold
+        compactor.add_deleted_bytes(self.bt.deleted_bytes)
+        assert compactor.last_start is None
+
+        compactor.add_deleted_bytes(1000)
+        assert compactor.last_start == 0
+        assert compactor.deleted_bytes == 0
+        assert not compactor.running
+        assert compactor.duration is not None
+        assert compactor.reclaimed_bytes is not None
+
+        # rate limit: the next compaction is delayed
+        compactor.add_deleted_bytes(2000)
+        assert compactor.delayed_call is not None
+        clock.advance(10)
+        assert compactor.last_start == 10
+        assert compactor.delayed_call is None
+
+    def test_segment_store(self):
+        path = tempfile.mkdtemp()
+        try:
+            store = SegmentStore(path, segment_size=50)
+            store.put(1, b'a' * 60)
+            store.put(2, b'b' * 60)
+            store.put(3, b'c' * 10)
+            assert store.get(1) == b'a' * 60
+            assert store.get(3) == b'c' * 10
+            assert store.get(4) is None
+
+            # each of the large blocks fills a segment
+            assert sorted(store.live) == [0, 1, 2]
+            store.delete(1)
+            assert sorted(store.live) == [1, 2]
+            assert sorted(os.listdir(path)) == ['segment_0000000000000001.log', 'segment_0000000000000002.log']
+
+            # sealed segments are synced by the next sync
+            assert store.unsynced == {1}
+            store.sync()
+            assert store.unsynced == set()
+
+            # the index is rebuilt from the segment files, a partially written record is cut off
+            store.put(4, b'd' * 10)
+            store.sync()
+            store.close()
+            with open(os.path.join(path, 'segment_0000000000000002.log'), 'ab') as f:
+                f.write(SegmentStore.record_header.pack(5, 10) + b'e')
+            store = SegmentStore(path, segment_size=50)
+            assert sorted(store) == [2, 3, 4]
+            assert store.get(2) == b'b' * 60
+            assert store.get(4) == b'd' * 10
+            assert store.active_number == 2
+            assert store.active_size == 2 * (SegmentStore.record_header.size + 10)
+            store.close()
+        finally:
+            shutil.rmtree(path)
+
+    def test_segment_store_blocktree(self):
+        storage_dir = tempfile.mkdtemp()
+        try:
+            bt = Blocktree(0, storage_dir=storage_dir, segment_store=True)
+            b1 = Block(1, GENESIS.block_id, [Transaction(0, 'c', 0)], 1)
+            b2 = Block(2, b1.block_id, [Transaction(0, 'c', 1)], 2)
+            with bt.write_batch():
+                bt.add_block(b1)
+                bt.add_block(b2)
+            assert bt.db.get(str(b1.block_id).encode()) is None
+            bt.db.close()
+            bt.segments.close()
+
+            bt2 = Blocktree(0, cache_size=0, storage_dir=storage_dir, segment_store=True)
+            assert bt2.nodes.get(b2.block_id).txs == b2.txs
+            # the stored bytes are sent as they are
+            assert bt2.nodes.get(b1.block_id).serialize() == b1.serialize()
+
+            # the block is deleted from the segments once the deletion of its header has been written
+            with bt2.write_batch():
+                bt2.delete_block(b1.block_id)
+                assert b1.block_id in bt2.segments
+            assert b1.block_id not in bt2.segments
+            assert bt2.db.get(b'header:' + str(b1.block_id).encode()) is None
+
+            # a missing block is reported instead of being treated as a block without transactions
+            header = bt2.nodes.get(b2.block_id)
+            bt2.segments.delete(b2.block_id)
+            bt2.cache.clear()
+            with self.assertRaises(MissingBlockError):
+                header.txs
+            bt2.db.close()
+            bt2.segments.close()
+        finally:
+            shutil.rmtree(storage_dir)
+
+    def test_storage_writer(self):
+        class Reactor:
+            """Collects the calls of the writer thread s.t they can be run in the test thread."""
+            def __init__(self):
+                self.calls = queue.Queue()
+
+            def callFromThread(self, f, *args):
+                self.calls.put((f, args))
+
+            def run_calls(self, count):
+                for _ in range(count):
+                    f, args = self.calls.get(timeout=5)
+                    f(*args)
+
+        storage_dir = tempfile.mkdtemp()
+        try:
+            bt = Blocktree(0, storage_dir=storage_dir, segment_store=True, writer_thread=True)
+            bt.writer.reactor = Reactor()
+            b1 = Block(1, GENESIS.block_id, [Transaction(0, 'c', 0)], 1)
+            results = []
+
+            with bt.write_batch():
+                bt.add_block(b1)
+                bt.put_meta(b'head_block', b1.block_id)
+            bt.put_meta(b'counter', 1)
+            bt.sync_vote().addCallback(lambda _: results.append('vote'))
+
+            # pending writes are visible before they are written
+            assert bt.get_meta(b'head_block') == b1.block_id
+            assert bt.get_meta(b'counter') == 1
+
+            bt.writer.reactor.run_calls(3)
+            assert results == ['vote']
+            assert bt.pending == {}
+            assert bt.db.get(b'meta:head_block') == str(b1.block_id).encode()
+            assert bt.db.get(b'meta:counter') == b'1'
+
+            # a new counter lease is written by the calling thread, i.e it is on disk once the value is returned
+            bt.counter = bt.counter_lease = 1
+            assert bt.next_counter() == 2
+            assert bt.db.get(b'meta:counter') == b'10001'
+            assert bt.pending == {}
+
+            bt.writer.stop()
+            bt.db.close()
+            bt.segments.close()
+        finally:
+            shutil.rmtree(storage_dir)
@@ -0,0 +1,73 @@
+"""Unit tests of the data structures defined in the txpool module."""
+
+from unittest import TestCase
+
+from piChain.messages import Transaction
+from piChain.txpool import TransactionQueue, TransactionFilter
+
+
+class TestTransactionQueue(TestCase):
+
+    def test_queue(self):
+        txs = [Transaction(0, 'c', i) for i in range(10)]
+        queue = TransactionQueue(txs)
+
+        assert len(queue) == 10
+        assert txs[3] in queue
+        assert queue.first() == txs[0]
+
+        # equal transactions are only queued once
+        queue.append(Transaction(0, 'c', 3))
+        assert len(queue) == 10
+
+        queue.discard(txs[0])
+        queue.discard(txs[5])
+        assert txs[5] not in queue
+        assert queue.first() == txs[1]
+
+        assert queue.pop_front(3) == txs[1:4]
+        assert list(queue) == txs[4:5] + txs[6:]
+
+        assert queue.pop_front(100) == txs[4:5] + txs[6:]
+        assert len(queue) == 0
+        assert queue.first() is None
+
+
+class TestTransactionFilter(TestCase):
+
+    def test_filter(self):
+        known_txs = TransactionFilter(window_size=16)
+        txn = Transaction(3, 'c', 100)
+
+        assert txn.txn_id not in known_txs
+        known_txs.add(txn.txn_id)
+        assert txn.txn_id in known_txs
+
+        # older transactions inside the window and transactions of other creators are not yet seen
+        assert Transaction(3, 'c', 90).txn_id not in known_txs
+        assert Transaction(4, 'c', 100).txn_id not in known_txs
+        assert Transaction(3, 'c', 101).txn_id not in known_txs
+
+        # the window slides forward, transactions below it count as seen
+        known_txs.add(Transaction(3, 'c', 110).txn_id)
+        assert txn.txn_id in known_txs
+        assert Transaction(3, 'c', 94).txn_id in known_txs
+        assert Transaction(3, 'c', 95).txn_id not in known_txs
+        assert Transaction(3, 'c', 109).txn_id not in known_txs
+
+        known_txs.add(Transaction(3, 'c', 1000).txn_id)
+        assert Transaction(3, 'c', 110).txn_id in known_txs
+        assert Transaction(3, 'c', 990).txn_id not in known_txs
+        assert known_txs.windows.get(3)[1] == 0
+
+        # transactions older than the first one seen can still be added
+        known_txs.add(Transaction(3, 'c', 990).txn_id)
+        assert Transaction(3, 'c', 990).txn_id in known_txs
+        assert Transaction(3, 'c', 991).txn_id not in known_txs
+
+        # in order and out of order within the window
+        for seq in [1001, 1002, 1005, 1003]:
+            known_txs.add(Transaction(3, 'c', seq).txn_id)
+        assert [seq for seq in range(999, 1007) if Transaction(3, 'c', seq).txn_id in known_txs] == \
+            [1000, 1001, 1002, 1003, 1005]
+        assert known_txs.windows.get(3)[1].bit_length() < 16